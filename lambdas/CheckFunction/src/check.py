@@ -1,20 +1,43 @@
 import requests
 from datetime import datetime, timedelta, date
+import datetime as dt
+import os
 import loneworker_utils as utils
+import calendar_sync
+import due_scheduler
+import state_store
+import subscriptions
 
 METRIC_MEETINGS_CHECKED = "MeetingsChecked"
 METRIC_CHECKINS_MISSED = "CheckinsMissed"
 METRIC_CHECKOUTS_MISSED = "CheckoutsMissed"
 METRIC_CLIENT_SECRET_DAYS_TO_EXPIRY = "ClientSecretDaysToExpiry"
+METRIC_WARNINGS_DEFERRED = "WarningsDeferred"
 
 ALL_METRICS = [METRIC_MEETINGS_CHECKED, METRIC_CHECKINS_MISSED, METRIC_CHECKOUTS_MISSED,
-               METRIC_CLIENT_SECRET_DAYS_TO_EXPIRY]
+               METRIC_CLIENT_SECRET_DAYS_TO_EXPIRY, METRIC_WARNINGS_DEFERRED]
 
 # Sentinel days-to-expiry value reported when the SSM parameter is missing or
 # unparseable. Chosen to breach the > 366 alarm threshold without overflowing
 # any sensible chart range.
 INVALID_DAYS_TO_EXPIRY = 1000
 
+# Modes the handler runs in, given by the "mode" key of the event. A due run reads the
+# calendar only if the (notification-maintained) sweep state shows something is due.
+MODE_SWEEP = "sweep"
+MODE_DUE = "due"
+
+# A warning mail is only sent if at least this many seconds remain before the deadline, so
+# that the appointments already warned about can still be flagged. Any left are warned
+# about by the next run.
+WARNING_MIN_SEC = 5
+
+# Sweep state stores, by store type, kept for the life of the container.
+_sweep_stores = {}
+
+# Due run schedulers, by scheduler type, kept for the life of the container.
+_due_schedulers = {}
+
 logger = utils.get_logger()
 
 
@@ -101,6 +124,32 @@ def send_warning_mail(manager, checkin, appointment):
 
     manager.send_email("overdue", subject, content)
 
+def sweep_filters(manager):
+    """
+    Builds the TimeFilters for missed check-ins and missed check-outs.
+
+    Args:
+        manager (LoneWorkerManager): Manager instance, for the app configuration
+
+    Returns:
+        tuple: (checkin_filters, checkout_filters)
+    """
+    app_cfg = manager.get_app_cfg()
+    grace_min = app_cfg["grace_min"]
+    ignore_after_min = app_cfg["ignore_after_min"]
+
+    # Checkin filter finds events starting between 75 and 15 minutes ago
+    checkin_filters = []
+    checkin_filters.append(utils.TimeFilter(minutes=-ignore_after_min, before_or_after=utils.AFTER, start_or_end=utils.START))
+    checkin_filters.append(utils.TimeFilter(minutes=-grace_min, before_or_after=utils.BEFORE, start_or_end=utils.START))
+
+    # Checkout filter finds those that ended between 15 minutes ago, and 75 minutes ago - as above, but end time
+    checkout_filters = []
+    checkout_filters.append(utils.TimeFilter(minutes=-ignore_after_min, before_or_after=utils.AFTER, start_or_end=utils.END))
+    checkout_filters.append(utils.TimeFilter(minutes=-grace_min, before_or_after=utils.BEFORE, start_or_end=utils.END))
+
+    return checkin_filters, checkout_filters
+
 def get_calendar_items(manager):
     """
     Retrieves two sets of calendar events from MS Graph API that need attention.
@@ -122,30 +171,102 @@ def get_calendar_items(manager):
     For example, with defaults:
     - Check-ins: Finds events starting between 75 and 15 minutes ago
     - Check-outs: Finds events ending between 75 and 15 minutes ago
+
+    The calendar window is read once, and both sets of filters are applied to it.
     """
     logger.info("Get calendar events")
 
-    app_cfg = manager.get_app_cfg()
-    grace_min = app_cfg["grace_min"]
-    ignore_after_min = app_cfg["ignore_after_min"]
+    checkin_filters, checkout_filters = sweep_filters(manager)
+
+    # Send the calendar request. We query /calendarView, so each occurrence of a
+    # recurring series is visible, over the one window that covers both sets of
+    # filters, then filter the result twice in memory. Only the fields used here and
+    # in the warning mail are read.
+    now = datetime.now(dt.timezone.utc)
+    window = manager.query_window([checkin_filters, checkout_filters], now)
+    appointments = manager.get_calendar_window(*window, select=utils.SELECT_CHECK) if window else []
+    checkin_appointments = utils.filter_events(appointments, checkin_filters, now)
+    checkout_appointments = utils.filter_events(appointments, checkout_filters, now)
+    logger.info("Returning %d checkin and %d checkout appointments", len(checkin_appointments), len(checkout_appointments))
+    return checkin_appointments, checkout_appointments
 
-    # Checkin filter finds events starting between 75 and 15 minutes ago
-    checkin_filters = []
-    checkin_filters.append(utils.TimeFilter(minutes=-ignore_after_min, before_or_after=utils.AFTER, start_or_end=utils.START))
-    checkin_filters.append(utils.TimeFilter(minutes=-grace_min, before_or_after=utils.BEFORE, start_or_end=utils.START))
+def get_sweep_store(store_type, s3=None):
+    """
+    Returns the store for incremental sweep state, reusing it for the life of the container.
 
-    # Checkout filter finds those that ended between 15 minutes ago, and 75 minutes ago - as above, but end time
-    checkout_filters = []
-    checkout_filters.append(utils.TimeFilter(minutes=-ignore_after_min, before_or_after=utils.AFTER, start_or_end=utils.END))
-    checkout_filters.append(utils.TimeFilter(minutes=-grace_min, before_or_after=utils.BEFORE, start_or_end=utils.END))
+    Args:
+        store_type (str): Store type, as accepted by state_store.make_state_store
+        s3: boto3 S3 client, for an "s3:" store
 
-    # Send the calendar request. get_calendar_events queries /calendarView over a
-    # wide window and applies these TimeFilters client-side, so each occurrence
-    # of a recurring series is visible.
-    checkin_appointments = manager.get_calendar_events(checkin_filters)
-    checkout_appointments = manager.get_calendar_events(checkout_filters)
-    logger.info("Returning %d checkin and %d checkout appointments", len(checkin_appointments), len(checkout_appointments))
-    return checkin_appointments, checkout_appointments
+    Returns:
+        The store, or None if incremental sweeps are not configured
+    """
+    if store_type not in _sweep_stores:
+        _sweep_stores[store_type] = state_store.make_state_store(store_type, s3)
+    return _sweep_stores[store_type]
+
+def get_due_scheduler(scheduler_type):
+    """
+    Returns the scheduler for due runs, reusing it for the life of the container.
+
+    Args:
+        scheduler_type (str): Scheduler type, as accepted by due_scheduler.make_scheduler.
+            An in-process scheduler makes its runs by calling lambda_handler.
+
+    Returns:
+        The scheduler, or None if due runs are not scheduled
+    """
+    if scheduler_type not in _due_schedulers:
+        _due_schedulers[scheduler_type] = due_scheduler.make_scheduler(
+            scheduler_type, callback=lambda payload: lambda_handler(payload, None))
+    return _due_schedulers[scheduler_type]
+
+def get_calendar_items_incremental(manager, state):
+    """
+    Retrieves the calendar events that need attention, looking only at what has
+    changed since the previous sweep.
+
+    Args:
+        manager (LoneWorkerManager): Manager instance for handling API calls and configuration
+        state (dict): Sweep state from the previous sweep, or None (see calendar_sync.sync_calendar)
+
+    Returns:
+        tuple: (checkin_appointments, checkout_appointments, state) where the appointment
+            lists are as for get_calendar_items and state is the sweep state to save once
+            the appointments have been processed.
+
+    An event is looked at if it was added or changed since the previous sweep, or if
+    its grace period (for check-in, after its start; for check-out, after its end)
+    ran out since then. Events already looked at after their grace period ran out,
+    and unchanged since, were dealt with by an earlier sweep. The cost of a sweep
+    therefore follows the number of changes rather than the size of the calendar.
+    Changes found by the notification handler since the previous sweep count as
+    changes found by this one.
+
+    Saving the state only after processing means that a failed sweep is repeated in
+    full by the next one.
+    """
+    logger.info("Get calendar changes")
+    app_cfg = manager.get_app_cfg()
+    grace = timedelta(minutes=app_cfg["grace_min"])
+    checkin_filters, checkout_filters = sweep_filters(manager)
+
+    now = datetime.now(dt.timezone.utc)
+    state, changed_ids = calendar_sync.sync_calendar(manager, state, now, app_cfg["ignore_after_min"])
+    last_sweep = datetime.fromisoformat(state["last_sweep"]) if state["last_sweep"] else None
+
+    def candidates(start_or_end):
+        return [event for event in state["events"].values()
+                if event["id"] in changed_ids or last_sweep is None or
+                utils.parse_graph_datetime(event[start_or_end]['dateTime']) + grace > last_sweep]
+
+    checkin_appointments = utils.filter_events(candidates(utils.START), checkin_filters, now)
+    checkout_appointments = utils.filter_events(candidates(utils.END), checkout_filters, now)
+    state["last_sweep"] = now.isoformat()
+    state["changed_ids"] = []
+    logger.info("Returning %d checkin and %d checkout appointments from %d changed events",
+                len(checkin_appointments), len(checkout_appointments), len(changed_ids))
+    return checkin_appointments, checkout_appointments, state
 
 def process_appointments(manager, appointments, checkin):
     """
@@ -165,9 +286,23 @@ def process_appointments(manager, appointments, checkin):
         - Have no attendees
     - For problematic appointments:
         - Sends warning emails
-        - Updates appointment categories and subject
+        - Updates appointment categories and subject, in batched requests of up to
+          MAX_BATCH_REQUESTS as the mails are sent
         - Increments appropriate metrics
+    - Stops sending mails once fewer than WARNING_MIN_SEC seconds remain before the
+      deadline, counting the appointments left in the WarningsDeferred metric
     - Updates metrics for total meetings checked
+
+    The appointments warned about are flagged in batches as the mails go, and the rest
+    flagged before any error is raised, so that a run that fails or runs out of time part
+    way through does not warn about them again.
+
+    Returns:
+        list: IDs of the appointments left unchecked because the deadline was near, which
+            the caller must look at again in the next run
+
+    Raises:
+        RuntimeError: If any appointment update fails
     """
     if checkin:
         logger.info("Checking for missed checkin")
@@ -183,53 +318,130 @@ def process_appointments(manager, appointments, checkin):
     # Update metrics to report how many metrics we have checked.
     manager.increment_counter(METRIC_MEETINGS_CHECKED, len(appointments))
 
-    for appointment in appointments:
-        logger.info("Checking appointment at %s (%s), subject: %s",
-                     appointment['start']['dateTime'],
-                     appointment['start']['timeZone'],
-                     appointment['subject'])
-        categories = appointment['categories']
-        if target_category in categories:
-            # Either we are looking for checkin and there was one, or for checkouts and there was one.
-            logger.debug("Already checked in / out - %s present already", target_category)
-            continue
-        if missed_category in categories:
-            # We already flagged this as a problem
-            logger.debug("Already marked - %s present already", missed_category)
-            continue
-        if not checkin and not utils.CHECKED_IN in categories:
-            # We should not flag a missed checkout if we never checked in
-            logger.debug("Ignoring missed checkout where no checkin either")
-            continue
-        if not appointment['attendees']:
-            # No attendees for this appointment, so ignore it
-            logger.debug("Ignoring meeting without attendees")
-            continue
-
-        # If we got here, there is a problem with this appointment
-        subject = appointment['subject']
-        logger.warn("Missed checkin or checkout for appointment: %s", subject)
-        send_warning_mail(manager, checkin, appointment)
-
-        # Update metrics for this event.
-        manager.increment_counter(metric)
-
-        # We managed to send an email to warn people, so update the appointment
-        categories.append(missed_category)
-        changes = {
-            'subject': missed_category + ": " + subject,
-            'categories': categories
-        }
-        manager.patch_calendar_event(appointment['id'], changes)
-        logger.info("Appointment updated successfully")
+    queued = {}
+    failed = []
+    deferred = []
+    try:
+        for index, appointment in enumerate(appointments):
+            logger.info("Checking appointment at %s (%s), subject: %s",
+                         appointment['start']['dateTime'],
+                         appointment['start']['timeZone'],
+                         appointment['subject'])
+            categories = appointment['categories']
+            if target_category in categories:
+                # Either we are looking for checkin and there was one, or for checkouts and there was one.
+                logger.debug("Already checked in / out - %s present already", target_category)
+                continue
+            if missed_category in categories:
+                # We already flagged this as a problem
+                logger.debug("Already marked - %s present already", missed_category)
+                continue
+            if not checkin and not utils.CHECKED_IN in categories:
+                # We should not flag a missed checkout if we never checked in
+                logger.debug("Ignoring missed checkout where no checkin either")
+                continue
+            if not appointment['attendees']:
+                # No attendees for this appointment, so ignore it
+                logger.debug("Ignoring meeting without attendees")
+                continue
+
+            if not manager.deadline.has_time(WARNING_MIN_SEC):
+                # Leave the rest for the next run, which will find them still unflagged.
+                deferred = [a['id'] for a in appointments[index:]]
+                logger.warning("Only %.2f seconds remain - leaving up to %d appointments for the next run",
+                               manager.deadline.remaining_sec(), len(deferred))
+                manager.increment_counter(METRIC_WARNINGS_DEFERRED, len(deferred))
+                break
+
+            # If we got here, there is a problem with this appointment
+            subject = appointment['subject']
+            logger.warn("Missed checkin or checkout for appointment: %s", subject)
+            send_warning_mail(manager, checkin, appointment)
+
+            # Update metrics for this event.
+            manager.increment_counter(metric)
+
+            # We managed to send an email to warn people, so update the appointment. The
+            # update is only made if the appointment is unchanged since it was read;
+            # otherwise flag_changed merges it with the appointment as it is now.
+            categories.append(missed_category)
+            changes = {
+                'subject': missed_category + ": " + subject,
+                'categories': categories
+            }
+            request_id = manager.queue_calendar_patch(appointment['id'], changes,
+                                                      etag=appointment.get('@odata.etag'),
+                                                      merge=lambda current: flag_changed(current, checkin),
+                                                      merge_fields=("subject", "categories"))
+            queued[request_id] = appointment
+            if len(queued) >= utils.MAX_BATCH_REQUESTS:
+                failed.extend(send_flags(manager, queued))
+    except Exception:
+        # Flag the appointments already warned about before reporting the error, without
+        # letting a failure to flag them hide it.
+        try:
+            send_flags(manager, queued)
+        except Exception:
+            logger.exception("Failed to flag appointments already warned about")
+        raise
+    failed.extend(send_flags(manager, queued))
+
+    if failed:
+        raise RuntimeError(f"Failed to update {len(failed)} appointments: {failed}")
+    logger.info("Appointments updated successfully")
+    return deferred
+
+def send_flags(manager, queued):
+    """
+    Sends the queued appointment updates.
+
+    Args:
+        manager (LoneWorkerManager): Manager holding the queued updates
+        queued (dict): Appointment for each queued update, by request ID; emptied once sent
+
+    Returns:
+        list: Subjects of the appointments whose update failed
+
+    Raises:
+        RuntimeError: If a $batch request itself fails
+    """
+    results = manager.send_calendar_patches()
+    failed = [queued[request_id]['subject'] for request_id, status in results.items()
+              if request_id in queued and not 200 <= status < 300]
+    queued.clear()
+    return failed
+
+def flag_changed(current, checkin):
+    """
+    Works out the update flagging an appointment that changed after it was read.
+
+    Args:
+        current (dict): The appointment as it is now (subject and categories)
+        checkin (bool): True if flagging a missed check-in, False for a missed check-out
+
+    Returns:
+        dict: The changes to make, or None if the appointment no longer needs flagging
+            (for instance, because the lone worker checked in meanwhile)
+    """
+    target_category = utils.CHECKED_IN if checkin else utils.CHECKED_OUT
+    missed_category = utils.MISSED_CHECK_IN if checkin else utils.MISSED_CHECK_OUT
+    categories = current['categories']
+    if target_category in categories or missed_category in categories:
+        logger.info("Appointment changed and no longer needs flagging: %s", categories)
+        return None
+    return {
+        'subject': missed_category + ": " + current['subject'],
+        'categories': categories + [missed_category]
+    }
 
 def lambda_handler(event, context):
     """
     AWS Lambda handler for checking missed check-ins and check-outs.
 
     Args:
-        event (dict): AWS Lambda event (not used in this function)
-        context (LambdaContext): AWS Lambda context object (not used in this function)
+        event (dict): AWS Lambda event. Its optional "mode" is MODE_SWEEP (the default) or
+            MODE_DUE, for the frequent runs made when change notifications are enabled.
+        context (LambdaContext): AWS Lambda context object, used to set the deadline for Graph calls
 
     Returns:
         dict: Response containing:
@@ -238,21 +450,85 @@ def lambda_handler(event, context):
                 - Meetings checked: Total number of meetings processed
                 - Missed checkins reported: Number of missed check-ins found
                 - Missed checkouts reported: Number of missed check-outs found
+            - operations: Calls, time taken, bytes received and statuses for each kind of
+              outbound call (see LoneWorkerManager.get_operation_summary)
 
     The function:
-    - Retrieves relevant calendar appointments
-    - Processes both check-in and check-out scenarios
+    - Retrieves relevant calendar appointments, either reading the whole window or (if the
+      sweep_state environment variable names a store) only what changed since the last run
+    - In MODE_DUE, skips the calendar entirely unless the sweep state shows an event changed
+      or a grace period ran out since the last run
+    - Processes both check-in and check-out scenarios, keeping any appointments left for
+      lack of time in the sweep state's changed IDs so that the next run looks at them
+    - If the due_scheduler environment variable names a scheduler, schedules a due run for
+      the next time an appointment's grace period runs out
+    - Saves the sweep state only if no other run saved it meanwhile; if one did, brings
+      that run's state up to date and records this sweep in it instead
+    - In MODE_SWEEP, if the notification_url environment variable is set, creates or renews
+      the change notification subscription
     - Emits metrics about the processing
     - Returns a summary of actions taken
     """
-    manager = utils.LoneWorkerManager("Check", ALL_METRICS)
-
-    # Read the relevant appointments from the calendar
-    checkin_appointments, checkout_appointments = get_calendar_items(manager)
+    # Reuses the manager (config, token and clients) from a warm container where possible.
+    manager = utils.get_manager("Check", ALL_METRICS, utils.Deadline(context))
+
+    mode = (event or {}).get("mode", MODE_SWEEP)
+    if mode not in (MODE_SWEEP, MODE_DUE):
+        raise ValueError(f"Invalid mode: {mode}")
+    notification_url = os.environ.get('notification_url', '')
+
+    # Read the relevant appointments from the calendar; incrementally if a store
+    # for the sweep state is configured.
+    store = get_sweep_store(os.environ.get('sweep_state', ''), manager.s3)
+    if store is None:
+        if mode == MODE_DUE or notification_url or os.environ.get('due_scheduler'):
+            raise ValueError("Change notifications and due runs need the sweep_state store")
+        checkin_appointments, checkout_appointments = get_calendar_items(manager)
+        state = None
+    else:
+        state_key = calendar_sync.state_key(manager.username)
+        state, version = store.load_versioned(state_key)
+        grace = timedelta(minutes=manager.get_app_cfg()["grace_min"])
+        if mode == MODE_DUE and not calendar_sync.sweep_needed(state, grace, datetime.now(dt.timezone.utc)):
+            logger.info("Nothing changed or due since the last sweep")
+            checkin_appointments, checkout_appointments, state = [], [], None
+        else:
+            checkin_appointments, checkout_appointments, state = get_calendar_items_incremental(manager, state)
 
     # Process the appointments as required
-    process_appointments(manager, checkin_appointments, checkin=True)
-    process_appointments(manager, checkout_appointments, checkin=False)
+    deferred = process_appointments(manager, checkin_appointments, checkin=True)
+    deferred += process_appointments(manager, checkout_appointments, checkin=False)
+
+    if state is not None:
+        # The state already counts these appointments as looked at; marking them as
+        # changed makes the next run (due or sweep) look at them again.
+        if deferred:
+            state["changed_ids"] = sorted(set(state["changed_ids"]) | set(deferred))
+        scheduler = get_due_scheduler(os.environ.get('due_scheduler', ''))
+
+        def schedule(to_save):
+            # The next run is scheduled for the moment it is needed, rather than left to the
+            # next sweep; the time is kept in the state so it is only asked for once.
+            if scheduler is not None:
+                due_scheduler.schedule_next_due(scheduler, to_save, grace, datetime.now(dt.timezone.utc))
+            return to_save
+
+        def merge(saved):
+            return schedule(calendar_sync.merge_sweep(manager, saved, state, datetime.now(dt.timezone.utc),
+                                                      manager.get_app_cfg()["ignore_after_min"]))
+
+        # Notify runs (and other Check runs) save the state too; saving over one made
+        # since it was loaded would bring back events it had dealt with.
+        try:
+            store.save_if(state_key, schedule(state), version)
+        except state_store.ConflictError:
+            logger.warning("Sweep state saved by another run meanwhile - merging this sweep into it")
+            state_store.update(store, state_key, merge, calendar_sync.STATE_SAVE_ATTEMPTS)
+
+    # The full sweeps keep the subscription alive; a failure here leaves the
+    # appointments dealt with, but fails the run so that it is noticed.
+    if mode == MODE_SWEEP and notification_url:
+        subscriptions.ensure_subscription(manager, store, notification_url, datetime.now(dt.timezone.utc))
 
     # Emit the client secret days-to-expiry gauge. increment_counter on a
     # zero-baseline metric is equivalent to "set" because metrics_to_emit is
@@ -276,6 +552,7 @@ def lambda_handler(event, context):
     resultMap["metrics"]["Missed checkins reported"] = metrics[METRIC_CHECKINS_MISSED]
     resultMap["metrics"]["Missed checkouts reported"] = metrics[METRIC_CHECKOUTS_MISSED]
     resultMap["metrics"]["Client secret days to expiry"] = metrics[METRIC_CLIENT_SECRET_DAYS_TO_EXPIRY]
+    resultMap["operations"] = manager.get_operation_summary()
 
     logger.info("Returning structure: %s", resultMap)
 
@@ -10,10 +10,15 @@ sys.path.insert(0, os.path.join(os.path.dirname(__file__), "../../dependencies/s
 dummy_boto3 = types.ModuleType("boto3")
 sys.modules["boto3"] = dummy_boto3
 
-from datetime import date
+from collections import defaultdict
+from datetime import date, datetime, timedelta, timezone
+from unittest.mock import MagicMock
 
 import pytest
-from check import send_warning_mail, days_to_expiry, INVALID_DAYS_TO_EXPIRY
+from check import send_warning_mail, days_to_expiry, get_calendar_items, get_calendar_items_incremental, process_appointments, flag_changed, INVALID_DAYS_TO_EXPIRY
+import calendar_sync
+import check
+import loneworker_utils as utils
 
 class DummyManager:
     def __init__(self):
@@ -124,3 +129,372 @@ def test_send_warning_mail_checkout():
     assert manager.sent_mail[0] == "overdue"
     assert manager.sent_mail[1] == expected_subject
     assert manager.sent_mail[2] == expected_content
+
+
+# ---- get_calendar_items ----
+
+def _event(event_id, start, end):
+    fmt = lambda d: d.strftime("%Y-%m-%dT%H:%M:%S.0000000")
+    return {"id": event_id,
+            "start": {"dateTime": fmt(start), "timeZone": "Etc/GMT"},
+            "end": {"dateTime": fmt(end), "timeZone": "Etc/GMT"}}
+
+def test_get_calendar_items_reads_calendar_once():
+    now = datetime.now(timezone.utc)
+    events = [
+        # Started 30 minutes ago, still running: a check-in candidate only.
+        _event("started", now - timedelta(minutes=30), now + timedelta(minutes=30)),
+        # Started 60 and ended 30 minutes ago: both a check-in and a check-out candidate.
+        _event("finished", now - timedelta(minutes=60), now - timedelta(minutes=30)),
+        # Starts in the future: neither.
+        _event("future", now + timedelta(minutes=10), now + timedelta(minutes=70)),
+    ]
+    manager = MagicMock()
+    manager.get_app_cfg.return_value = {"grace_min": 15, "ignore_after_min": 75}
+    manager.query_window.return_value = (now - timedelta(minutes=75), now - timedelta(minutes=14))
+    manager.get_calendar_window.return_value = events
+
+    checkin, checkout = get_calendar_items(manager)
+
+    manager.get_calendar_window.assert_called_once()
+    assert manager.get_calendar_window.call_args.kwargs["select"] == utils.SELECT_CHECK
+    assert [e["id"] for e in checkin] == ["started", "finished"]
+    assert [e["id"] for e in checkout] == ["finished"]
+
+
+# ---- get_calendar_items_incremental ----
+
+def _delta_manager(delta_results):
+    manager = MagicMock()
+    manager.get_app_cfg.return_value = {"grace_min": 15, "ignore_after_min": 75}
+    manager.get_calendar_delta.side_effect = delta_results
+    return manager
+
+def test_incremental_first_sweep_reads_whole_window():
+    now = datetime.now(timezone.utc)
+    events = [
+        _event("started", now - timedelta(minutes=30), now + timedelta(minutes=30)),
+        _event("finished", now - timedelta(minutes=60), now - timedelta(minutes=30)),
+        _event("future", now + timedelta(minutes=10), now + timedelta(minutes=70)),
+    ]
+    manager = _delta_manager([(events, [], "https://delta1")])
+
+    checkin, checkout, state = get_calendar_items_incremental(manager, None)
+
+    assert "window_start" in manager.get_calendar_delta.call_args.kwargs
+    assert [e["id"] for e in checkin] == ["started", "finished"]
+    assert [e["id"] for e in checkout] == ["finished"]
+    assert state["delta_link"] == "https://delta1"
+    assert set(state["events"]) == {"started", "finished", "future"}
+
+def test_incremental_sweep_only_changed_and_newly_due():
+    now = datetime.now(timezone.utc)
+    last_sweep = now - timedelta(minutes=10)
+    old_events = {
+        # Grace ran out 40 minutes ago: dealt with by an earlier sweep.
+        "old": _event("old", now - timedelta(minutes=55), now + timedelta(minutes=5)),
+        # Grace ran out 5 minutes ago, since the last sweep.
+        "due": _event("due", now - timedelta(minutes=20), now + timedelta(minutes=40)),
+        # Ended long before anything a sweep looks at: dropped from the state.
+        "ancient": _event("ancient", now - timedelta(hours=3), now - timedelta(hours=2)),
+        "deleted": _event("deleted", now - timedelta(minutes=20), now + timedelta(minutes=40)),
+    }
+    state = {
+        "window_start": (now - timedelta(hours=2)).isoformat(),
+        "window_end": (now + timedelta(hours=20)).isoformat(),
+        "last_sweep": last_sweep.isoformat(),
+        "delta_link": "https://delta1",
+        "events": old_events,
+    }
+    changed = _event("changed", now - timedelta(minutes=50), now - timedelta(minutes=20))
+    manager = _delta_manager([([changed], ["deleted"], "https://delta2")])
+
+    checkin, checkout, state = get_calendar_items_incremental(manager, state)
+
+    manager.get_calendar_delta.assert_called_once_with(delta_link="https://delta1")
+    assert sorted(e["id"] for e in checkin) == ["changed", "due"]
+    assert [e["id"] for e in checkout] == ["changed"]
+    assert set(state["events"]) == {"old", "due", "changed"}
+    assert state["delta_link"] == "https://delta2"
+    assert datetime.fromisoformat(state["last_sweep"]) > last_sweep
+
+def test_incremental_sweep_restarts_when_delta_link_expired():
+    now = datetime.now(timezone.utc)
+    state = {
+        "window_start": (now - timedelta(hours=2)).isoformat(),
+        "window_end": (now + timedelta(hours=20)).isoformat(),
+        "last_sweep": (now - timedelta(minutes=10)).isoformat(),
+        "delta_link": "https://delta1",
+        "events": {},
+    }
+    events = [_event("started", now - timedelta(minutes=30), now + timedelta(minutes=30))]
+    manager = _delta_manager([utils.DeltaLinkExpired("gone"), (events, [], "https://delta2")])
+
+    checkin, _, state = get_calendar_items_incremental(manager, state)
+
+    assert manager.get_calendar_delta.call_count == 2
+    assert [e["id"] for e in checkin] == ["started"]
+    assert state["delta_link"] == "https://delta2"
+
+def test_incremental_sweep_restarts_when_window_passed():
+    now = datetime.now(timezone.utc)
+    state = {
+        "window_start": (now - timedelta(hours=26)).isoformat(),
+        "window_end": (now - timedelta(minutes=1)).isoformat(),
+        "last_sweep": (now - timedelta(minutes=10)).isoformat(),
+        "delta_link": "https://delta1",
+        "events": {},
+    }
+    manager = _delta_manager([([], [], "https://delta2")])
+
+    get_calendar_items_incremental(manager, state)
+
+    assert "delta_link" not in manager.get_calendar_delta.call_args.kwargs
+
+
+# ---- process_appointments ----
+
+def _flaggable(event_id, categories=None):
+    return {"id": event_id, "subject": f"Visit {event_id}", "categories": categories or [],
+            "attendees": [{"emailAddress": {"address": "billy@example.com"}}], "bodyPreview": "",
+            "start": {"dateTime": "2024-01-01T10:00:00.0000000", "timeZone": "Etc/GMT"},
+            "end": {"dateTime": "2024-01-01T11:00:00.0000000", "timeZone": "Etc/GMT"}}
+
+def test_process_appointments_batches_updates():
+    manager = MagicMock()
+    manager.queue_calendar_patch.side_effect = ["1", "2"]
+    manager.send_calendar_patches.return_value = {"1": 200, "2": 200}
+    appointments = [_flaggable("a"), _flaggable("b", [utils.CHECKED_IN]), _flaggable("c")]
+
+    process_appointments(manager, appointments, checkin=True)
+
+    assert [c.args[0] for c in manager.queue_calendar_patch.call_args_list] == ["a", "c"]
+    assert manager.queue_calendar_patch.call_args_list[0].args[1]["subject"] == "Missed-Check-In: Visit a"
+    manager.send_calendar_patches.assert_called_once()
+    manager.patch_calendar_event.assert_not_called()
+    assert manager.send_email.call_count == 2
+
+def test_process_appointments_update_failure_raises():
+    manager = MagicMock()
+    manager.queue_calendar_patch.side_effect = ["1"]
+    manager.send_calendar_patches.return_value = {"1": 500}
+
+    with pytest.raises(RuntimeError):
+        process_appointments(manager, [_flaggable("a")], checkin=True)
+
+def test_process_appointments_sends_queued_updates_when_mail_fails():
+    manager = MagicMock()
+    manager.queue_calendar_patch.side_effect = ["1"]
+    manager.send_email.side_effect = [None, RuntimeError("mail failed")]
+
+    with pytest.raises(RuntimeError, match="mail failed"):
+        process_appointments(manager, [_flaggable("a"), _flaggable("b")], checkin=True)
+
+    manager.send_calendar_patches.assert_called_once()
+
+def test_process_appointments_update_failure_does_not_hide_mail_failure():
+    manager = MagicMock()
+    manager.queue_calendar_patch.side_effect = ["1"]
+    manager.send_email.side_effect = [None, RuntimeError("mail failed")]
+    manager.send_calendar_patches.side_effect = RuntimeError("batch failed")
+
+    with pytest.raises(RuntimeError, match="mail failed"):
+        process_appointments(manager, [_flaggable("a"), _flaggable("b")], checkin=True)
+
+def test_process_appointments_sends_updates_in_batches():
+    manager = MagicMock()
+    count = utils.MAX_BATCH_REQUESTS + 1
+    manager.queue_calendar_patch.side_effect = [str(i) for i in range(count)]
+    manager.send_calendar_patches.side_effect = lambda: {}
+
+    process_appointments(manager, [_flaggable(str(i)) for i in range(count)], checkin=True)
+
+    # One batch as soon as it is full, while mails are still to be sent, then the rest.
+    assert manager.send_calendar_patches.call_count == 2
+    assert manager.send_email.call_count == count
+
+def test_process_appointments_stops_mails_when_deadline_near():
+    manager = MagicMock()
+    manager.metrics = defaultdict(int)
+    manager.increment_counter.side_effect = lambda name, increment=1: manager.metrics.__setitem__(
+        name, manager.metrics[name] + increment)
+    manager.queue_calendar_patch.side_effect = ["1", "2"]
+    manager.send_calendar_patches.return_value = {"1": 200, "2": 200}
+    manager.deadline.has_time.side_effect = [True, True, False]
+    manager.deadline.remaining_sec.return_value = 4.0
+    appointments = [_flaggable("a"), _flaggable("b"), _flaggable("c"), _flaggable("d")]
+
+    deferred = process_appointments(manager, appointments, checkin=True)
+
+    assert deferred == ["c", "d"]
+    assert manager.send_email.call_count == 2
+    assert [c.args[0] for c in manager.queue_calendar_patch.call_args_list] == ["a", "b"]
+    manager.send_calendar_patches.assert_called_once()
+    manager.deadline.has_time.assert_called_with(check.WARNING_MIN_SEC)
+    assert manager.metrics[check.METRIC_WARNINGS_DEFERRED] == 2
+
+def test_process_appointments_updates_are_conditional():
+    manager = MagicMock()
+    appointment = _flaggable("a")
+    appointment["@odata.etag"] = "etag-1"
+
+    process_appointments(manager, [appointment], checkin=True)
+
+    kwargs = manager.queue_calendar_patch.call_args.kwargs
+    assert kwargs["etag"] == "etag-1"
+    assert kwargs["merge"]({"subject": "Renamed", "categories": ["Blue"]}) == {
+        "subject": "Missed-Check-In: Renamed", "categories": ["Blue", utils.MISSED_CHECK_IN]}
+
+def test_flag_changed():
+    # Checked in after the sweep read the appointment: no longer needs flagging.
+    assert flag_changed({"subject": "Visit", "categories": [utils.CHECKED_IN]}, checkin=True) is None
+    assert flag_changed({"subject": "Visit", "categories": [utils.MISSED_CHECK_OUT]}, checkin=False) is None
+    assert flag_changed({"subject": "Visit", "categories": [utils.CHECKED_IN]}, checkin=False) == {
+        "subject": "Missed-Check-Out: Visit", "categories": [utils.CHECKED_IN, utils.MISSED_CHECK_OUT]}
+
+
+# ---- lambda_handler modes ----
+
+@pytest.fixture
+def handler_manager(monkeypatch):
+    monkeypatch.setenv("sweep_state", "memory")
+    check._sweep_stores.clear()
+    manager = MagicMock()
+    manager.username = "loneworker@example.com"
+    manager.get_app_cfg.return_value = {"grace_min": 15, "ignore_after_min": 75}
+    manager.client_secret_expiry = None
+    manager.get_metrics.return_value = defaultdict(int)
+    manager.get_calendar_delta.return_value = ([], [], "https://delta2")
+    monkeypatch.setattr(utils, "get_manager", lambda *args: manager)
+    yield manager
+    check._sweep_stores.clear()
+    check._due_schedulers.clear()
+
+def _saved_state(now, events, last_sweep):
+    store = check.get_sweep_store("memory")
+    store.save(calendar_sync.state_key("loneworker@example.com"), {
+        "window_start": (now - timedelta(hours=2)).isoformat(),
+        "window_end": (now + timedelta(hours=20)).isoformat(),
+        "last_sweep": last_sweep.isoformat(),
+        "delta_link": "https://delta1",
+        "events": {event["id"]: event for event in events},
+        "changed_ids": [],
+    })
+    return store
+
+def _flaggable_at(event_id, start):
+    event = _flaggable(event_id)
+    fmt = lambda d: d.strftime("%Y-%m-%dT%H:%M:%S.0000000")
+    event["start"]["dateTime"] = fmt(start)
+    event["end"]["dateTime"] = fmt(start + timedelta(hours=1))
+    return event
+
+def test_due_run_skips_calendar_when_nothing_due(handler_manager):
+    now = datetime.now(timezone.utc)
+    _saved_state(now, [_event("later", now + timedelta(minutes=30), now + timedelta(minutes=90))],
+                 now - timedelta(minutes=1))
+
+    check.lambda_handler({"mode": check.MODE_DUE}, None)
+
+    handler_manager.get_calendar_delta.assert_not_called()
+
+def test_due_run_sweeps_when_grace_ran_out(handler_manager):
+    now = datetime.now(timezone.utc)
+    store = _saved_state(now, [_flaggable_at("due", now - timedelta(minutes=15, seconds=30))],
+                         now - timedelta(minutes=1))
+
+    check.lambda_handler({"mode": check.MODE_DUE}, None)
+
+    handler_manager.get_calendar_delta.assert_called_once_with(delta_link="https://delta1")
+    assert handler_manager.send_email.call_count == 1
+    state = store.load(calendar_sync.state_key("loneworker@example.com"))
+    assert datetime.fromisoformat(state["last_sweep"]) > now - timedelta(minutes=1)
+
+def test_warnings_left_for_lack_of_time_sent_by_next_run(handler_manager):
+    now = datetime.now(timezone.utc)
+    store = _saved_state(now, [_flaggable_at("due", now - timedelta(minutes=15, seconds=30))],
+                         now - timedelta(minutes=1))
+    handler_manager.deadline.has_time.return_value = False
+    handler_manager.deadline.remaining_sec.return_value = 1.0
+
+    check.lambda_handler({"mode": check.MODE_DUE}, None)
+
+    handler_manager.send_email.assert_not_called()
+    state = store.load(calendar_sync.state_key("loneworker@example.com"))
+    assert state["changed_ids"] == ["due"]
+
+    # The next run, with time to spare, sends the warning although the grace period
+    # ran out before the first run's sweep.
+    handler_manager.deadline.has_time.return_value = True
+    check.lambda_handler({"mode": check.MODE_DUE}, None)
+
+    assert handler_manager.send_email.call_count == 1
+    state = store.load(calendar_sync.state_key("loneworker@example.com"))
+    assert state["changed_ids"] == []
+
+def test_state_saved_meanwhile_is_merged(handler_manager):
+    now = datetime.now(timezone.utc)
+    last_sweep = now - timedelta(minutes=1)
+    store = _saved_state(now, [_flaggable_at("due", now - timedelta(minutes=15, seconds=30))], last_sweep)
+    key = calendar_sync.state_key("loneworker@example.com")
+    notified = _event("new", now + timedelta(minutes=30), now + timedelta(minutes=90))
+
+    def notify_saves_meanwhile(**kwargs):
+        # A Notify run syncs from the same delta link while this run sweeps.
+        saved = dict(store.load(key), delta_link="https://notified", changed_ids=["new"])
+        saved["events"] = dict(saved["events"], new=notified)
+        store.save(key, saved)
+        handler_manager.get_calendar_delta.side_effect = None
+        return [], [], "https://delta2"
+
+    handler_manager.get_calendar_delta.side_effect = notify_saves_meanwhile
+    handler_manager.get_calendar_delta.return_value = ([], [], "https://delta3")
+
+    check.lambda_handler({"mode": check.MODE_DUE}, None)
+
+    assert handler_manager.send_email.call_count == 1
+    # The merge synced from the Notify run's delta link, keeping what it found.
+    assert handler_manager.get_calendar_delta.call_args.kwargs == {"delta_link": "https://notified"}
+    state = store.load(key)
+    assert state["delta_link"] == "https://delta3"
+    assert state["changed_ids"] == ["new"]
+    assert set(state["events"]) == {"due", "new"}
+    assert datetime.fromisoformat(state["last_sweep"]) > last_sweep
+
+def test_sweep_renews_subscription(handler_manager, monkeypatch):
+    monkeypatch.setenv("notification_url", "https://notify.example.com/")
+    handler_manager.create_subscription.return_value = {"id": "sub-1"}
+
+    check.lambda_handler({}, None)
+
+    handler_manager.create_subscription.assert_called_once()
+    assert handler_manager.create_subscription.call_args.args[0] == "https://notify.example.com/"
+
+def test_due_run_leaves_subscription_alone(handler_manager, monkeypatch):
+    monkeypatch.setenv("notification_url", "https://notify.example.com/")
+
+    check.lambda_handler({"mode": check.MODE_DUE}, None)
+
+    handler_manager.create_subscription.assert_not_called()
+
+def test_notifications_need_sweep_state(handler_manager, monkeypatch):
+    monkeypatch.setenv("sweep_state", "")
+
+    with pytest.raises(ValueError):
+        check.lambda_handler({"mode": check.MODE_DUE}, None)
+
+def test_run_schedules_next_due(handler_manager, monkeypatch):
+    now = datetime.now(timezone.utc)
+    store = _saved_state(now, [_event("later", now + timedelta(minutes=30), now + timedelta(minutes=90))],
+                         now - timedelta(minutes=1))
+    monkeypatch.setenv("due_scheduler", "test")
+    scheduler = MagicMock()
+    check._due_schedulers["test"] = scheduler
+
+    check.lambda_handler({}, None)
+
+    when, payload = scheduler.schedule.call_args.args
+    assert payload == {"mode": "due"}
+    assert now + timedelta(minutes=45) < when <= now + timedelta(minutes=45, seconds=1)
+    state = store.load(calendar_sync.state_key("loneworker@example.com"))
+    assert state["scheduled_due"] == when.isoformat()
@@ -1,6 +1,10 @@
 import requests
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
+import datetime as dt
 import os
+import time
 
 import loneworker_utils as utils
 
@@ -16,6 +20,7 @@ METRIC_APPT_NOT_FOUND = "NoMatchingAppointment"
 METRIC_DUPLICATE_CALL = "DuplicateCall"
 METRIC_SUCCESS = "Success"
 METRIC_MEETINGS_COMPLETED_OK = "MeetingsCompletedOK"
+METRIC_FOLLOW_UP_SKIPPED = "FollowUpSkipped"
 
 ALL_METRICS = [
     METRIC_CHECKINS,
@@ -26,19 +31,93 @@ ALL_METRICS = [
     METRIC_DUPLICATE_CALL,
     METRIC_SUCCESS,
     METRIC_MEETINGS_COMPLETED_OK,
+    METRIC_FOLLOW_UP_SKIPPED,
+    utils.METRIC_DIRECTORY_INDEX_HITS,
+    utils.METRIC_IDENTITY_CACHE_HITS,
 ]
 
+# Time taken to handle a call, by action and phase, so that its percentiles can be read.
+METRIC_CALL_LATENCY = "CallLatency"
+
+# Names of the actions, as the Action dimension of METRIC_CALL_LATENCY.
+ACTION_NAMES = {
+    KEY_CHECK_IN: "CheckIn",
+    KEY_CHECK_OUT: "CheckOut",
+    KEY_EMERGENCY: "Emergency",
+}
+
+# Phases of handling a call, as the Phase dimension of METRIC_CALL_LATENCY. Total is the
+# time from the handler starting to the response being ready, apart from emitting metrics.
+# The emergency email is sent while the caller is looked up and their meetings tagged, so
+# for an emergency those phases overlap.
+PHASE_INIT = "Init"
+PHASE_LOOKUP = "Lookup"
+PHASE_CALENDAR = "Calendar"
+PHASE_UPDATE = "Update"
+PHASE_FOLLOW_UP = "FollowUp"
+PHASE_EMAIL = "Email"
+PHASE_FOLLOW_UP_EMAIL = "FollowUpEmail"
+PHASE_METRICS = "Metrics"
+PHASE_TOTAL = "Total"
+
+# Message for a check-in or check-out finding appointments at the right time, none of which
+# the caller attends. This suggests their phone number maps to the wrong addresses, so
+# their cached identity is discarded.
+MESSAGE_NOT_ATTENDEE = "No matching appointments found for your email address."
+
+# The missed checkout lookup after a check-in is skipped unless at least this many
+# seconds remain before the deadline; the caller hearing a prompt answer matters more.
+FOLLOW_UP_MIN_SEC = 3
+
 logger = utils.get_logger()
 
-def get_calendar(manager, action, addresses, end_before=None):
+class PhaseTimer:
+    def __init__(self):
+        """
+        Times the phases of handling a call, from when it is created.
+        """
+        self.started = time.perf_counter()
+        self.phases = {}
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Times the code run in the with block as the named phase, adding to any time
+        already spent in it.
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0) + time.perf_counter() - started
+
+    def record(self, manager, action):
+        """
+        Records the time spent in each phase so far, and the total time so far, in the
+        CallLatency metric.
+
+        Args:
+            manager (LoneWorkerManager): Manager to record the times with
+            action (str): Name of the action (see ACTION_NAMES)
+        """
+        total = time.perf_counter() - self.started
+        logger.info("Call handled in %.0f ms: %s", total * 1000,
+                    ", ".join(f"{name} {elapsed * 1000:.0f} ms" for name, elapsed in self.phases.items()))
+        for name, elapsed in self.phases.items():
+            manager.record_timing(METRIC_CALL_LATENCY, elapsed, {"Action": action, "Phase": name})
+        manager.record_timing(METRIC_CALL_LATENCY, total, {"Action": action, "Phase": PHASE_TOTAL})
+
+def get_calendar(manager, action, addresses, end_before=None, now=None):
     """
     Retrieves calendar events from MS Graph API based on specified criteria.
 
     Args:
         manager (LoneWorkerManager): Manager instance for handling API calls and configuration
         action (str): Type of action being performed (check-in, check-out, emergency)
-        addresses (list): List of email addresses to match against event attendees
+        addresses (list): List of email addresses to match against event attendees (case is ignored)
         end_before (str, optional): UTC dateTime string to filter events ending before this time
+        now (datetime, optional): Reference time for the time filters; defaults to the current UTC time.
+            Calls in one invocation that pass the same value read the calendar only once.
 
     Returns:
         list: List of calendar events matching the specified criteria and time filters
@@ -49,6 +128,34 @@ def get_calendar(manager, action, addresses, end_before=None):
     - Emergency: Looks for meetings that could be currently in progress
     """
     logger.info("Get calendar events - action %s, end_before %s", action, end_before)
+    time_filters = calendar_filters(manager, action, end_before)
+
+    # Retrieve the appointments. get_calendar_events queries /calendarView (so
+    # individual occurrences of recurring series are visible) over the narrowest
+    # window these TimeFilters allow, then applies them client-side for exactness.
+    # Passing the addresses means only events they attend are considered, using an
+    # attendee index the manager keeps for the window, so busy calendars cost no more.
+    # TODO: I think it would be better if we moved the checking in process_appointments here; it would just be simpler
+    appointments = manager.get_calendar_events(time_filters, now=now, attendees=set(addresses),
+                                               select=utils.SELECT_CONNECT)
+
+    for appointment in appointments:
+        logger.info("Match on addresses %s for meeting from %s to %s", addresses, appointment["start"], appointment["end"])
+
+    return appointments
+
+def calendar_filters(manager, action, end_before=None):
+    """
+    Builds the TimeFilters for the appointments an action may apply to.
+
+    Args:
+        manager (LoneWorkerManager): Manager instance, for the configured grace periods
+        action (str): Type of action being performed (check-in, check-out, emergency)
+        end_before (str, optional): UTC dateTime string to filter events ending before this time
+
+    Returns:
+        list: The TimeFilters; see get_calendar
+    """
     app_cfg = manager.get_app_cfg()
 
     checkin_grace_min = app_cfg["checkin_grace_min"]
@@ -92,35 +199,9 @@ def get_calendar(manager, action, addresses, end_before=None):
         logger.info("Explicit end before of %s", end_before)
         time_filters.append(utils.TimeFilter(datetime=end_before, before_or_after=utils.BEFORE, start_or_end=utils.END))
 
-    # Retrieve the appointments. get_calendar_events queries /calendarView over
-    # a wide window (so individual occurrences of recurring series are visible)
-    # and applies these TimeFilters client-side to narrow to the scenario window.
-    appointments = manager.get_calendar_events(time_filters)
-
-    # TODO: I think it would be better if we moved the checking in process_appointments here; it would just be simpler
-    # Filter out by address
-    matching_appointments = []
-    for appointment in appointments:
-        logger.info("Checking appointment %s attendees: %s",
-                    appointment['subject'],
-                    [a['emailAddress']['address'] for a in appointment['attendees']])
-        for attendee in appointment['attendees']:
-            address = attendee['emailAddress']['address'].lower()
-
-            if address in addresses:
-                logger.info("Match on address %s for meeting from %s to %s", address, appointment["start"], appointment["end"])
-                matching_appointments.append(appointment)
-                # No need to check any more attendees
-                break
-        else:
-            logger.debug("Ignoring appointment %s as no address match", appointment['subject'])
-            continue
-
-    appointments = matching_appointments
+    return time_filters
 
-    return appointments
-
-def update_appointment(manager, appointment, action, ignore_already_done=False):
+def update_appointment(manager, appointment, action, ignore_already_done=False, queue=False):
     """
     Updates a calendar appointment with check-in, check-out, or emergency status.
 
@@ -129,13 +210,16 @@ def update_appointment(manager, appointment, action, ignore_already_done=False):
         appointment (dict): Calendar appointment data to update
         action (str): Type of action being performed (check-in, check-out, emergency)
         ignore_already_done (bool, optional): Whether to ignore if action was already performed
+        queue (bool, optional): Whether to queue the update with the manager (to be sent by
+            send_calendar_patches) rather than send it now
 
     Returns:
         bool: True if the action was already performed on this appointment, False otherwise
 
     The function:
     - Adds appropriate category to the appointment (checked-in, checked-out, emergency)
-    - Updates the appointment body with a timestamp of when the action occurred
+    - Updates the appointment body with a timestamp of when the action occurred, reading
+      the body first if the appointment was fetched without it
     - Returns True if the action was already performed (category already present), so nothing was done.
 
     The action must be one of the KEY_ values.
@@ -160,24 +244,102 @@ def update_appointment(manager, appointment, action, ignore_already_done=False):
         body_message = f"<p>Emergency reported by phone at {time_now}</p>\r\n"
         message = "Emergency call meeting found."
 
+    def mark(event):
+        # Adds the category and body message to the event, returning the changes to send.
+        event['categories'].append(target_category)
+        body = event['body']
+        body['content'] = body['content'].replace("</body>", f"{body_message}</body>")
+        return {'categories': event['categories'], 'body': body}
+
+    def merge(current):
+        # The event changed after we read it (perhaps another call, or the Check function,
+        # updated it). Apply our change to the event as it is now instead.
+        if target_category in current['categories']:
+            logger.info('Appointment now already has %s category', target_category)
+            return None
+        return mark(current)
+
     # Set the category
-    changes = {}
-    categories = appointment['categories']
-    if target_category in categories:
+    if target_category in appointment['categories']:
         logger.info('Appointment already has %s category', target_category)
         return True
-    categories.append(target_category)
-    changes['categories'] = categories
 
-    body = appointment['body']
-    body['content'] = body['content'].replace("</body>", f"{body_message}</body>")
-    changes['body'] = body
-    manager.patch_calendar_event(appointment['id'], changes)
-    logger.info("Appointment updated successfully")
+    if 'body' not in appointment:
+        # Calendar reads leave out the (possibly large) body; read it for this event only.
+        appointment['body'] = manager.get_calendar_event(appointment['id'], ("body",))['body']
+    changes = mark(appointment)
+
+    # The update is only made if the event is unchanged since the calendar read (so that
+    # a concurrent update is not overwritten), otherwise it is merged and retried.
+    etag = appointment.get('@odata.etag')
+    if queue:
+        manager.queue_calendar_patch(appointment['id'], changes, etag=etag, merge=merge,
+                                     merge_fields=("categories", "body"))
+        logger.info("Appointment update queued")
+    elif manager.patch_calendar_event(appointment['id'], changes, etag=etag, merge=merge,
+                                      merge_fields=("categories", "body")):
+        logger.info("Appointment updated successfully")
+    else:
+        return True
 
     return False
 
-def process_appointments(manager, addresses, action):
+def check_out_missed(manager, addresses, appointment, now):
+    """
+    After a check-in, looks for an earlier appointment that was checked into but not
+    out of, and checks out of it.
+
+    Args:
+        manager (LoneWorkerManager): Manager instance for handling API calls
+        addresses (list): List of email addresses to match against appointments
+        appointment (dict): The appointment just checked into
+        now (datetime): Reference time of the check-in's calendar lookup, so that the
+            calendar events already read are re-filtered rather than read again
+
+    Returns:
+        bool: True if an earlier appointment was checked out of
+    """
+    logger.info("Checked in - look for missed checkout")
+    start = appointment["start"]
+    if start["timeZone"] != "Etc/GMT":
+        # Somehow we have a non GMT timestamp, despite asking for GMT
+        # Give up.
+        logger.warn("Got a non-GMT timestamp, so giving up: %s", start)
+        return False
+
+    appointments = get_calendar(manager,
+                                KEY_CHECK_OUT,
+                                addresses,
+                                end_before=start["dateTime"],
+                                now=now)
+
+    if len(appointments) != 1:
+        # Multiple or no meetings, so do nothing. Maybe there was no missed checkout
+        logger.info("Not got a single meeting, so no missed checkout - count %d", len(appointments))
+        return False
+
+    appointment = appointments.pop()
+    logger.info("Possible missed checkout at %s (%s), subject: %s",
+                appointment['start']['dateTime'],
+                appointment['start']['timeZone'],
+                appointment['subject'])
+
+    if utils.CHECKED_IN not in appointment['categories']:
+        # Cannot check out of an appointment to which you have not checked in
+        # Probably a missed checkin and checkout.
+        logger.info("Appointment not checked in so no checkin at %s (%s), subject: %s",
+                     appointment['start']['dateTime'],
+                     appointment['start']['timeZone'],
+                     appointment['subject'])
+        return False
+
+    if update_appointment(manager, appointment, KEY_CHECK_OUT):
+        return False
+    logger.info("Found a missed checkout")
+    manager.increment_counter(METRIC_MEETINGS_COMPLETED_OK)
+    return True
+
+def process_appointments(manager, addresses, action, timer=None, matched=None):
     """
     Processes calendar appointments for check-in, check-out or emergency actions.
 
@@ -185,6 +347,8 @@ def process_appointments(manager, addresses, action):
         manager (LoneWorkerManager): Manager instance for handling API calls
         addresses (list): List of email addresses to match against appointments
         action (str): Type of action being performed (check-in, check-out, emergency)
+        timer (PhaseTimer, optional): Times the calendar read, update and follow-up phases
+        matched (list, optional): The appointments found for the action are added to this
 
     Returns:
         tuple: (success, message) where:
@@ -194,10 +358,13 @@ def process_appointments(manager, addresses, action):
     The function:
     - Finds relevant appointments based on time and attendee criteria
     - Handles special cases like multiple appointments or missing check-ins
-    - For check-ins, also looks for missed checkouts from previous appointments
+    - For check-ins, also looks for missed checkouts from previous appointments, unless
+      the invocation's deadline is too close. The calendar is read once, over a window
+      covering both lookups, and the events re-filtered for each.
     - Updates appointment categories and body content based on the action
     """
     logger.info("Processing appointments list for action %s, addresses %s", action, addresses)
+    timer = timer or PhaseTimer()
 
     # Assume error to start with, but set the default message for success.
     success = False
@@ -210,7 +377,26 @@ def process_appointments(manager, addresses, action):
         assert action == KEY_EMERGENCY, f"Unexpected action value {action}"
         message = "Emergency appointment updated."
 
-    appointments = get_calendar(manager, action, addresses)
+    # Both calendar lookups below use the same reference time, so the missed checkout
+    # lookup is served from the window the manager already read for the first one.
+    now = datetime.now(dt.timezone.utc)
+    with timer.phase(PHASE_CALENDAR):
+        if action == KEY_CHECK_IN:
+            # Read the one window that covers the check-in and the missed checkout lookup
+            # (whose filters are the check-out filters, narrowed by an end_before), as the
+            # check-in window alone misses it when checkout_grace_min > checkin_grace_min.
+            # That end_before is the start of the appointment checked into, so is at most
+            # checkin_grace_min from now; bounding the check-out filters by it keeps the
+            # window from reaching on to ignore_after_min.
+            follow_up_filters = calendar_filters(manager, KEY_CHECK_OUT)
+            follow_up_filters.append(utils.TimeFilter(minutes=manager.get_app_cfg()["checkin_grace_min"],
+                                                      before_or_after=utils.BEFORE, start_or_end=utils.END))
+            window = manager.query_window([calendar_filters(manager, KEY_CHECK_IN), follow_up_filters], now)
+            if window:
+                manager.find_calendar_window(*window, select=utils.SELECT_CONNECT)
+        appointments = get_calendar(manager, action, addresses, now=now)
+    if matched is not None:
+        matched.extend(appointments)
 
     # We found the appointment to deal with. If there were multiple or none, we should deal with that.
     if len(appointments) == 0:
@@ -221,6 +407,11 @@ def process_appointments(manager, addresses, action):
         else:
             # Increment the counter for unfound appointments
             manager.increment_counter(METRIC_APPT_NOT_FOUND)
+            # Re-filtering the window already read, without the addresses, tells whether
+            # there was simply nothing due or the caller attends none of what was due.
+            if manager.get_calendar_events(calendar_filters(manager, action), now=now, select=utils.SELECT_CONNECT):
+                logger.info("Appointments found, but not for addresses %s", addresses)
+                return success, MESSAGE_NOT_ATTENDEE
         return success, "No matching appointments found."
     if len(appointments) > 1:
         logger.info("More than one appointment found for this user - count: %d", len(appointments))
@@ -287,26 +478,35 @@ def process_appointments(manager, addresses, action):
                          appointment['subject'])
             return success, "You are trying to check out of a meeting that you have not checked into."
 
+    # An emergency can match several meetings; their updates are sent together.
+    queue = action == KEY_EMERGENCY
     already_done = False
-    while appointments:
-        appointment = appointments.pop()
-        # Set the category
-        already_done = update_appointment(manager, appointment, action)
-        if already_done:
-            logger.info("Appointment already marked with category at %s (%s), subject: %s",
-                         appointment['start']['dateTime'],
-                         appointment['start']['timeZone'],
-                         appointment['subject'])
-            if action == KEY_CHECK_IN:
-                message = "Your appointment has already been checked in."
-                manager.increment_counter(METRIC_DUPLICATE_CALL)
+    with timer.phase(PHASE_UPDATE):
+        while appointments:
+            appointment = appointments.pop()
+            # Set the category
+            already_done = update_appointment(manager, appointment, action, queue=queue)
+            if already_done:
+                logger.info("Appointment already marked with category at %s (%s), subject: %s",
+                             appointment['start']['dateTime'],
+                             appointment['start']['timeZone'],
+                             appointment['subject'])
+                if action == KEY_CHECK_IN:
+                    message = "Your appointment has already been checked in."
+                    manager.increment_counter(METRIC_DUPLICATE_CALL)
+                elif action == KEY_CHECK_OUT:
+                    message = "Your appointment has already been checked out."
+                    manager.increment_counter(METRIC_DUPLICATE_CALL)
+                else:
+                    message = "Emergency already registered."
             elif action == KEY_CHECK_OUT:
-                message = "Your appointment has already been checked out."
-                manager.increment_counter(METRIC_DUPLICATE_CALL)
-            else:
-                message = "Emergency already registered."
-        elif action == KEY_CHECK_OUT:
-            manager.increment_counter(METRIC_MEETINGS_COMPLETED_OK)
+                manager.increment_counter(METRIC_MEETINGS_COMPLETED_OK)
+
+        if queue:
+            results = manager.send_calendar_patches()
+            failed = [request_id for request_id, status in results.items() if not 200 <= status < 300]
+            if failed:
+                raise RuntimeError(f"Failed to update {len(failed)} of {len(results)} emergency appointments")
 
     # If we got here, we consider it a success
     logger.info("Success!")
@@ -314,47 +514,108 @@ def process_appointments(manager, addresses, action):
 
     if action == KEY_CHECK_IN and not already_done:
         # We managed to check in - try to see if we missed a checkout
-        logger.info("Checked in - look for missed checkout")
-        start = appointment["start"]
-        if start["timeZone"] != "Etc/GMT":
-            # Somehow we have a non GMT timestamp, despite asking for GMT
-            # Give up.
-            logger.warn("Got a non-GMT timestamp, so giving up: %s", start)
+        if not manager.deadline.has_time(FOLLOW_UP_MIN_SEC):
+            logger.warning("Checked in - skipping missed checkout lookup as only %.2f seconds remain",
+                           manager.deadline.remaining_sec())
+            manager.increment_counter(METRIC_FOLLOW_UP_SKIPPED)
             return success, message
 
-        appointments = get_calendar(manager,
-                                    KEY_CHECK_OUT,
-                                    addresses,
-                                    end_before=start["dateTime"])
+        with timer.phase(PHASE_FOLLOW_UP):
+            if check_out_missed(manager, addresses, appointment, now):
+                # We update the message - terminating the sentence and adding the second batch
+                message += " An earlier appointment has also been checked out."
 
-        if len(appointments) != 1:
-            # Multiple or no meetings, so do nothing. Maybe there was no missed checkout
-            logger.info("Not got a single meeting, so no missed checkout - count %d", len(appointments))
-            return success, message
+    return success, message
+
+def describe_appointment(appointment):
+    """
+    Describes an appointment for an email: its subject, location and local time.
+    """
+    start = utils.parse_graph_datetime(appointment['start']['dateTime']).astimezone()
+    end = utils.parse_graph_datetime(appointment['end']['dateTime']).astimezone()
+    location = (appointment.get('location') or {}).get('displayName') or "not given"
+    return (f" Meeting             : {appointment['subject']}\r\n"
+            f" Location            : {location}\r\n"
+            f" Time                : {start.strftime('%Y-%m-%d %H:%M')} to {end.strftime('%H:%M')}")
+
+def handle_emergency(manager, phone_number, timer=None):
+    """
+    Handles an emergency call.
 
-        appointment = appointments.pop()
-        logger.info("Possible missed checkout at %s (%s), subject: %s",
-                    appointment['start']['dateTime'],
-                    appointment['start']['timeZone'],
-                    appointment['subject'])
+    Args:
+        manager (LoneWorkerManager): Manager instance for handling API calls
+        phone_number (str): The caller's phone number, or None if not known
+        timer (PhaseTimer, optional): Times the phases of handling the call
 
-        if utils.CHECKED_IN not in appointment['categories']:
-            # Cannot check out of an appointment to which you have not checked in
-            # Probably a missed checkin and checkout.
-            logger.info("Appointment not checked in so no checkin at %s (%s), subject: %s",
-                         appointment['start']['dateTime'],
-                         appointment['start']['timeZone'],
-                         appointment['subject'])
-            return success, message
+    Returns:
+        tuple: (message, appointment_result), where appointment_result is the message from
+            tagging the caller's meetings, or None if the caller was not recognised
 
-        already_done = update_appointment(manager, appointment, KEY_CHECK_OUT)
-        if not already_done:
-            # We update the message - terminating the sentence and adding the second batch
-            logger.info("Found a missed checkout")
-            message += " An earlier appointment has also been checked out."
-            manager.increment_counter(METRIC_MEETINGS_COMPLETED_OK)
+    Raises:
+        RuntimeError: If the emergency email could not be sent
 
-    return success, message
+    The function:
+    - Sends the emergency email at once, from another thread, as nothing should delay it
+    - Meanwhile looks the caller up, and tags the meetings they may be in
+    - Once the emergency email has gone, sends a follow-up email with the caller's name
+      and the subject, location and time of those meetings
+
+    A failure to look the caller up or tag their meetings is logged, and given in the
+    follow-up email, but does not stop the emergency email or fail the call.
+    """
+    timer = timer or PhaseTimer()
+    number = phone_number or "UNKNOWN"
+
+    def send_emergency_email():
+        lines = []
+        lines.append("Emergency call received")
+        lines.append("")
+        lines.append(f" Calling number      : {number}")
+        if phone_number:
+            lines.append(" Caller name and meetings follow in a second email.")
+        with timer.phase(PHASE_EMAIL):
+            manager.send_email("emergency", "Emergency Assistance Required!", "\r\n".join(lines))
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        email_future = executor.submit(send_emergency_email)
+
+        display_name = "UNKNOWN"
+        meetings = []
+        appointment_result = None
+        try:
+            if phone_number:
+                with timer.phase(PHASE_LOOKUP):
+                    addresses, display_name = manager.phone_to_email(phone_number)
+                if addresses:
+                    logger.info("Emergency - add emergency tag to meeting or meetings that may match")
+                    # We do not use the message we get back here except to log it; we do try to update
+                    # the meeting, but cannot do more than that.
+                    _, appointment_result = process_appointments(manager, addresses, KEY_EMERGENCY, timer,
+                                                                 matched=meetings)
+                    logger.info("Got message from appointments: %s", appointment_result)
+        except Exception as e:
+            logger.exception("Failed to find or tag the caller's meetings")
+            appointment_result = f"Failed to find or tag meetings: {e}"
+
+        # Raises if the emergency email failed. The follow-up waits for it, so that the two
+        # arrive in order.
+        email_future.result()
+
+    if phone_number:
+        lines = []
+        lines.append(f"Further details of the emergency call from {number}")
+        lines.append("")
+        lines.append(f" Caller name if known: {display_name}")
+        if appointment_result is not None:
+            lines.append(f" Meeting search      : {appointment_result}")
+        for meeting in meetings:
+            lines.append("")
+            lines.append(describe_appointment(meeting))
+        with timer.phase(PHASE_FOLLOW_UP_EMAIL):
+            manager.send_email("emergency", "Emergency Assistance Required - caller details", "\r\n".join(lines))
+
+    message = "Emergency email sent." # This is not actually read out, so is just for diags purposes.
+    return message, appointment_result
 
 def lambda_handler(event, context):
     """
@@ -373,21 +634,30 @@ def lambda_handler(event, context):
             - success: Whether the operation succeeded
             - message: Human-readable result message
             - appointment check result: (Optional) Result of appointment processing
+            - operations: Time taken by each kind of outbound call, as one line
 
     The function:
     - Processes phone system events for check-in, check-out and emergency calls
-    - Maps phone numbers to email addresses
+    - Maps phone numbers to email addresses, through the manager's identity cache
     - Updates calendar appointments accordingly
     - Sends emergency notifications when required
-    - Tracks various metrics about system usage
+    - Tracks various metrics about system usage, including the time taken by each phase
+      of handling the call (see PhaseTimer)
     """
     logger.info("Received call to handle")
+    timer = PhaseTimer()
 
     # Assume failure
     success = False
     resultMap = {}
 
-    manager = utils.LoneWorkerManager("Connect", ALL_METRICS)
+    # The deadline is when the Lambda times out, or when Connect stops waiting if sooner.
+    budget_sec = os.environ.get('response_budget_sec')
+    deadline = utils.Deadline(context, budget_sec=float(budget_sec) if budget_sec else None)
+
+    # Reuses the manager (config, token and clients) from a warm container where possible.
+    with timer.phase(PHASE_INIT):
+        manager = utils.get_manager("Connect", ALL_METRICS, deadline)
 
     action = event['Details']['Parameters']['buttonpressed']
     if action == KEY_CHECK_IN:
@@ -412,59 +682,56 @@ def lambda_handler(event, context):
         logger.error("Phone number not found")
         phone_number = None
 
-    if phone_number:
-        logger.info("Get values for phone number %s", phone_number)
-        addresses, display_name = manager.phone_to_email(phone_number)
-        # phone_found is used purely to give a better error message
-        phone_found = True
-    else:
+    # phone_found is used purely to give a better error message
+    phone_found = bool(phone_number)
+    if not phone_found:
         phone_number = "UNKNOWN"
-        addresses = []
-        displayName = "UNKNOWN"
         manager.increment_counter(METRIC_UNKNOWN_CALLER)
-        phone_found = False
 
     resultMap["calling number"] = phone_number
     message = ""
 
     if action == KEY_CHECK_IN or action == KEY_CHECK_OUT:
+        addresses = []
+        if phone_found:
+            logger.info("Get values for phone number %s", phone_number)
+            with timer.phase(PHASE_LOOKUP):
+                addresses, display_name = manager.phone_to_email(phone_number)
         if addresses:
             logger.info("Check-in or out action selected")
-            success, message = process_appointments(manager, addresses, action)
+            success, message = process_appointments(manager, addresses, action, timer)
             if success:
                 manager.increment_counter(METRIC_SUCCESS)
+            elif message == MESSAGE_NOT_ATTENDEE:
+                # The cached identity may be out of date (e.g. the number has moved to
+                # another worker), so the caller's next attempt looks it up again.
+                manager.invalidate_identity(phone_number)
         else:
             logger.info("Giving up - no phone number or no matching addresses")
             if phone_found:
                 message = "Unrecognised phone number."
+                # The number may have been added to a contact or user since it was cached.
+                manager.invalidate_identity(phone_number)
             else:
                 message = "Unable to find your phone number."
             manager.increment_counter(METRIC_UNKNOWN_CALLER)
     else:
         logger.info("Emergency action selected")
-        subject = "Emergency Assistance Required!"
-        lines = []
-        lines.append("Emergency call received")
-        lines.append("")
-        lines.append(f" Calling number      : {phone_number}")
-        lines.append(f" Caller name if known: {display_name}")
-        content = "\r\n".join(lines)
-        manager.send_email("emergency", subject, content)
-        message = "Emergency email sent." # This is not actually read out, so is just for diags purposes.
-
-        if addresses:
-            logger.info("Emergency mail sent - add emergency tag to meeting or meetings that may match")
-            # We do not use the message we get back here except to log it; we do try to update the meeting, but cannot do more than that.
-            _, unused_message = process_appointments(manager, addresses, action)
-            logger.info("Got message from appointments: %s", unused_message)
-            resultMap["appointment check result"] = unused_message
+        message, appointment_result = handle_emergency(manager, phone_number if phone_found else None, timer)
+        if appointment_result is not None:
+            resultMap["appointment check result"] = appointment_result
 
         # We consider having sent the email as a success, even if we could not find the meeting.
         success = True
         manager.increment_counter(METRIC_SUCCESS)
 
-    # Report back metrics
-    manager.emit_metrics()
+    # Report back metrics. Emitting them is the last phase, so its time is reported by
+    # the next call this container handles.
+    timer.record(manager, ACTION_NAMES[action])
+    with timer.phase(PHASE_METRICS):
+        manager.emit_metrics()
+    manager.record_timing(METRIC_CALL_LATENCY, timer.phases[PHASE_METRICS],
+                          {"Action": ACTION_NAMES[action], "Phase": PHASE_METRICS})
 
     resultMap["success"] = success
     if success:
@@ -472,6 +739,9 @@ def lambda_handler(event, context):
     else:
         resultMap["message"] = f"An error occurred. {message} Please phone the office."
 
+    # Connect only accepts flat string values, so the timings are given as one line.
+    resultMap["operations"] = utils.format_operation_summary(manager.get_operation_summary())
+
     logger.info("Returning structure: %s", resultMap)
 
     return resultMap
\ No newline at end of file
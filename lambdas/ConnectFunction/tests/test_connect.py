@@ -76,12 +76,11 @@ def test_process_appointments_check_out(dummy_manager, monkeypatch):
 
 def test_process_appointments_no_matching_appointments(dummy_manager, monkeypatch):
     addresses = ["fred@example.com"]
-    appointments = [
-        make_appointment(categories=[], attendee_mails=["billy@example.com"])
-    ]
-    dummy_manager.get_calendar_events.return_value = appointments
+    # The manager only returns events with one of the addresses as an attendee
+    dummy_manager.get_calendar_events.return_value = []
     result = connect.process_appointments(dummy_manager, addresses, connect.KEY_CHECK_IN)
     assert result == (False, 'No matching appointments found.')
+    assert dummy_manager.get_calendar_events.call_args_list[0].kwargs["attendees"] == {"fred@example.com"}
 
 def test_process_appointments_multiple_matching_appointments(dummy_manager, monkeypatch):
     addresses = ["billy@example.com"]
@@ -117,7 +116,6 @@ def test_process_appointments_already_checked_in(dummy_manager, monkeypatch):
     addresses = ["billy@example.com"]
     appointments = [
         make_appointment(categories=["Checked-In"], attendee_mails=["jim@example.com", "BILLY@example.com"]),
-        make_appointment(categories=[], attendee_mails=["sue@example.com"])
     ]
     dummy_manager.get_calendar_events.return_value = appointments
     result = connect.process_appointments(dummy_manager, addresses, connect.KEY_CHECK_IN)
@@ -127,7 +125,6 @@ def test_process_appointments_already_checked_out(dummy_manager, monkeypatch):
     addresses = ["billy@example.com"]
     appointments = [
         make_appointment(categories=["Checked-In", "Checked-Out"], attendee_mails=["jim@example.com", "BILLY@example.com"]),
-        make_appointment(categories=[], attendee_mails=["sue@example.com"])
     ]
     dummy_manager.get_calendar_events.return_value = appointments
     result = connect.process_appointments(dummy_manager, addresses, connect.KEY_CHECK_OUT)
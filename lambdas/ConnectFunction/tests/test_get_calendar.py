@@ -2,8 +2,9 @@ import sys
 import os
 import types
 import pytest
-from unittest.mock import MagicMock
-from datetime import datetime
+from collections import defaultdict
+from unittest.mock import MagicMock, patch
+from datetime import datetime, timedelta, timezone
 
 # Add the local src directories to the include path
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), "../src"))
@@ -113,24 +114,120 @@ def test_get_calendar_end_before_filter(dummy_manager):
     assert time_filters[2].before_or_after == utils.BEFORE
     assert time_filters[2].start_or_end == utils.END
 
-def test_get_calendar_address_filtering(dummy_manager):
-    """Test that appointments are filtered by attendee email addresses"""
-    appointments = [
-        make_appointment(appointment_id="1", attendee_mails=["match@example.com", "other@example.com"]),
-        make_appointment(appointment_id="2", attendee_mails=["nomatch@example.com"]),
-        make_appointment(appointment_id="3", attendee_mails=["MATCH@EXAMPLE.COM"]),  # Test case insensitive
-        make_appointment(appointment_id="4", attendee_mails=[])  # Test no attendees
-    ]
+def test_get_calendar_passes_addresses(dummy_manager):
+    """Test that the caller's addresses are passed to the manager as a set"""
+    appointments = [make_appointment(appointment_id="1", attendee_mails=["match@example.com"])]
     dummy_manager.get_calendar_events.return_value = appointments
 
-    result = connect.get_calendar(dummy_manager, connect.KEY_CHECK_IN, ["match@example.com"])
+    result = connect.get_calendar(dummy_manager, connect.KEY_CHECK_IN, ["match@example.com", "other@example.com"])
 
-    # Should return appointments 1 and 3 (case insensitive match)
-    assert len(result) == 2
-    assert result[0]["id"] == "1"
-    assert result[1]["id"] == "3"
+    assert result == appointments
+    assert dummy_manager.get_calendar_events.call_args.kwargs["attendees"] == {"match@example.com", "other@example.com"}
 
 def test_get_calendar_invalid_action(dummy_manager):
     """Test that invalid action raises assertion error"""
     with pytest.raises(AssertionError):
-        connect.get_calendar(dummy_manager, "INVALID", ["test@example.com"])
\ No newline at end of file
+        connect.get_calendar(dummy_manager, "INVALID", ["test@example.com"])
+
+def test_get_calendar_follow_up_reuses_checkin_read():
+    """Test that a check-in lookup and its missed checkout lookup read the calendar once"""
+    manager = utils.LoneWorkerManager.__new__(utils.LoneWorkerManager)
+    manager.app_type = "Connect"
+    manager.cfg = MagicMock()
+    manager.cfg.get_app_cfg.side_effect = lambda name: {
+        "checkin_grace_min": 15, "checkout_grace_min": 15, "ignore_after_min": 75,
+        "connect_timeout_sec": 3.05, "read_timeout_sec": 10, "max_retries": 0,
+    }
+    manager.deadline = utils.Deadline()
+    manager.calendar_windows = []
+    manager.headers = {}
+    manager.calendar_view_url = "https://graph.microsoft.com/v1.0/users/x/calendar/calendarView"
+    manager.session = MagicMock()
+    manager.reset_operations()
+
+    now = datetime.now(timezone.utc)
+    fmt = lambda d: d.strftime("%Y-%m-%dT%H:%M:%S.0000000")
+    current = make_appointment(appointment_id="current", attendee_mails=["billy@example.com"],
+                               start_time=fmt(now), end_time=fmt(now + timedelta(minutes=60)))
+    earlier = make_appointment(appointment_id="earlier", attendee_mails=["billy@example.com"],
+                               start_time=fmt(now - timedelta(minutes=60)), end_time=fmt(now - timedelta(minutes=5)))
+    response = MagicMock(status_code=200)
+    response.json.return_value = {"value": [earlier, current]}
+    manager.session.request.return_value = response
+
+    checkin = connect.get_calendar(manager, connect.KEY_CHECK_IN, ["billy@example.com"], now=now)
+    follow_up = connect.get_calendar(manager, connect.KEY_CHECK_OUT, ["billy@example.com"],
+                                     end_before=current["start"]["dateTime"], now=now)
+
+    manager.session.request.assert_called_once()
+    assert [a["id"] for a in checkin] == ["current"]
+    assert [a["id"] for a in follow_up] == ["earlier"]
+
+def test_checkin_reads_calendar_once_with_longer_checkout_grace():
+    """Test that a check-in and its missed checkout lookup read the calendar once, even
+    when the checkout grace period reaches further back than the check-in window"""
+    manager = utils.LoneWorkerManager.__new__(utils.LoneWorkerManager)
+    manager.app_type = "Connect"
+    manager.cfg = MagicMock()
+    manager.cfg.get_app_cfg.side_effect = lambda name: {
+        "checkin_grace_min": 15, "checkout_grace_min": 60, "ignore_after_min": 75,
+        "connect_timeout_sec": 3.05, "read_timeout_sec": 10, "max_retries": 0,
+    }
+    manager.deadline = utils.Deadline()
+    manager.calendar_windows = []
+    manager.headers = {}
+    manager.calendar_view_url = "https://graph.microsoft.com/v1.0/users/x/calendar/calendarView"
+    manager.session = MagicMock()
+    manager.reset_operations()
+    manager.metrics = defaultdict(int)
+    manager.metrics_to_emit = defaultdict(int)
+
+    now = datetime.now(timezone.utc)
+    fmt = lambda d: d.strftime("%Y-%m-%dT%H:%M:%S.0000000")
+    current = make_appointment(appointment_id="current", attendee_mails=["billy@example.com"],
+                               start_time=fmt(now), end_time=fmt(now + timedelta(minutes=60)))
+    # Ended 45 minutes ago: inside the checkout grace period, but well outside the check-in window
+    earlier = make_appointment(appointment_id="earlier", attendee_mails=["billy@example.com"],
+                               start_time=fmt(now - timedelta(minutes=105)), end_time=fmt(now - timedelta(minutes=45)))
+    current["categories"] = []
+    earlier["categories"] = [utils.CHECKED_IN]
+    response = MagicMock(status_code=200)
+    response.json.return_value = {"value": [earlier, current]}
+    manager.session.request.return_value = response
+
+    with patch("connect.update_appointment", return_value=False) as update:
+        connect.process_appointments(manager, ["billy@example.com"], connect.KEY_CHECK_IN)
+
+    calendar_reads = [c for c in manager.session.request.call_args_list if c.args[1] == manager.calendar_view_url]
+    assert len(calendar_reads) == 1
+    # From the earliest end the missed checkout can have, to the latest start the check-in
+    # can have, rather than on to ignore_after_min.
+    params = calendar_reads[0].kwargs["params"]
+    parse = lambda value: datetime.strptime(value, "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=timezone.utc)
+    margin = timedelta(seconds=5)
+    assert abs(parse(params["startDateTime"]) - (now - timedelta(minutes=60) - utils.WINDOW_MARGIN)) < margin
+    assert abs(parse(params["endDateTime"]) - (now + timedelta(minutes=15) + utils.WINDOW_MARGIN)) < margin
+    assert [c.args[1]["id"] for c in update.call_args_list] == ["current", "earlier"]
+
+def test_get_calendar_address_filtering():
+    """Test that appointments are filtered by attendee email addresses"""
+    manager = utils.LoneWorkerManager.__new__(utils.LoneWorkerManager)
+    manager.app_type = "Connect"
+    manager.cfg = MagicMock()
+    manager.cfg.get_app_cfg.return_value = {"checkin_grace_min": 15, "checkout_grace_min": 15, "ignore_after_min": 75}
+
+    now = datetime.now(timezone.utc)
+    fmt = lambda d: d.strftime("%Y-%m-%dT%H:%M:%S.0000000")
+    times = dict(start_time=fmt(now), end_time=fmt(now + timedelta(minutes=60)))
+    appointments = [
+        make_appointment(appointment_id="1", attendee_mails=["match@example.com", "other@example.com"], **times),
+        make_appointment(appointment_id="2", attendee_mails=["nomatch@example.com"], **times),
+        make_appointment(appointment_id="3", attendee_mails=["MATCH@EXAMPLE.COM"], **times),  # Test case insensitive
+        make_appointment(appointment_id="4", attendee_mails=[], **times)  # Test no attendees
+    ]
+    manager.calendar_windows = [utils.CalendarWindow(now - timedelta(days=1), now + timedelta(days=1), appointments)]
+
+    result = connect.get_calendar(manager, connect.KEY_CHECK_IN, ["Match@example.com"], now=now)
+
+    # Should return appointments 1 and 3 (case insensitive match)
+    assert [a["id"] for a in result] == ["1", "3"]
@@ -1,5 +1,6 @@
 import sys
 import os
+import threading
 import types
 import pytest
 from unittest.mock import MagicMock, patch
@@ -17,7 +18,7 @@ import loneworker_utils as utils
 
 @pytest.fixture
 def mock_manager():
-    with patch('loneworker_utils.LoneWorkerManager') as mock:
+    with patch('loneworker_utils.get_manager') as mock:
         manager = MagicMock()
         mock.return_value = manager
         manager.phone_to_email = MagicMock(return_value=(["test@example.com"], "Test User"))
@@ -77,9 +78,27 @@ def test_lambda_handler_emergency(mock_manager):
     assert result["action"] == "Emergency"
     assert result["calling number"] == "+441234567890"
     mock_manager.increment_counter.assert_any_call(connect.METRIC_EMERGENCY)
-    mock_manager.send_email.assert_called_once()  # Emergency email should be sent
+    # The emergency email, then the follow-up with the caller's details
+    subjects = [c.args[1] for c in mock_manager.send_email.call_args_list]
+    assert subjects == ["Emergency Assistance Required!", "Emergency Assistance Required - caller details"]
     mock_manager.emit_metrics.assert_called_once()
 
+def test_lambda_handler_emergency_unknown_phone(mock_manager):
+    """Test that an emergency from an unknown number sends only the emergency email"""
+    event = {
+        "Details": {
+            "Parameters": {"buttonpressed": connect.KEY_EMERGENCY},
+            "ContactData": {"CustomerEndpoint": {}}
+        }
+    }
+
+    result = connect.lambda_handler(event, None)
+
+    assert result["success"]
+    assert result["calling number"] == "UNKNOWN"
+    mock_manager.send_email.assert_called_once()
+    mock_manager.phone_to_email.assert_not_called()
+
 def test_lambda_handler_unknown_phone(mock_manager):
     """Test lambda handler with unknown phone number"""
     mock_manager.phone_to_email.return_value = ([], "UNKNOWN")
@@ -97,6 +116,166 @@ def test_lambda_handler_unknown_phone(mock_manager):
     mock_manager.increment_counter.assert_any_call(connect.METRIC_UNKNOWN_CALLER)
     mock_manager.emit_metrics.assert_called_once()
 
+def test_lambda_handler_invalidates_identity_not_attending(mock_manager):
+    """Test that a caller who attends none of the appointments due is looked up again next time"""
+    event = {
+        "Details": {
+            "Parameters": {"buttonpressed": connect.KEY_CHECK_IN},
+            "ContactData": {"CustomerEndpoint": {"Address": "+441234567890"}}
+        }
+    }
+
+    with patch('connect.process_appointments', return_value=(False, connect.MESSAGE_NOT_ATTENDEE)):
+        connect.lambda_handler(event, None)
+    mock_manager.invalidate_identity.assert_called_once_with("+441234567890")
+
+    mock_manager.invalidate_identity.reset_mock()
+    with patch('connect.process_appointments', return_value=(True, "Checked in.")):
+        connect.lambda_handler(event, None)
+    mock_manager.invalidate_identity.assert_not_called()
+
+def test_lambda_handler_keeps_identity_when_nothing_due(mock_manager):
+    """Test that a caller retrying when no appointment is due keeps their cached identity"""
+    event = {
+        "Details": {
+            "Parameters": {"buttonpressed": connect.KEY_CHECK_IN},
+            "ContactData": {"CustomerEndpoint": {"Address": "+441234567890"}}
+        }
+    }
+
+    result = connect.lambda_handler(event, None)
+
+    assert "No matching appointments found." in result["message"]
+    mock_manager.invalidate_identity.assert_not_called()
+
+def test_lambda_handler_invalidates_unknown_number(mock_manager):
+    """Test that a number that matched nobody is looked up again next time"""
+    mock_manager.phone_to_email.return_value = ([], "UNKNOWN")
+    event = {
+        "Details": {
+            "Parameters": {"buttonpressed": connect.KEY_CHECK_OUT},
+            "ContactData": {"CustomerEndpoint": {"Address": "+441234567890"}}
+        }
+    }
+
+    connect.lambda_handler(event, None)
+
+    mock_manager.invalidate_identity.assert_called_once_with("+441234567890")
+
+def _phases(manager):
+    """Returns the (action, phase) of each call latency recorded with the manager."""
+    return [(call.args[2]["Action"], call.args[2]["Phase"]) for call in manager.record_timing.call_args_list
+            if call.args[0] == connect.METRIC_CALL_LATENCY]
+
+def test_lambda_handler_records_phase_latency(mock_manager):
+    """Test that the time taken by each phase is recorded, by action"""
+    event = {
+        "Details": {
+            "Parameters": {"buttonpressed": connect.KEY_CHECK_IN},
+            "ContactData": {"CustomerEndpoint": {"Address": "+441234567890"}}
+        }
+    }
+
+    recorded_before_emit = []
+    mock_manager.emit_metrics.side_effect = lambda: recorded_before_emit.append(_phases(mock_manager))
+
+    connect.lambda_handler(event, None)
+
+    assert _phases(mock_manager) == [("CheckIn", connect.PHASE_INIT), ("CheckIn", connect.PHASE_LOOKUP),
+                                     ("CheckIn", connect.PHASE_CALENDAR), ("CheckIn", connect.PHASE_TOTAL),
+                                     ("CheckIn", connect.PHASE_METRICS)]
+    # The metrics phase can only be recorded once the metrics are emitted.
+    assert recorded_before_emit == [_phases(mock_manager)[:-1]]
+
+def test_lambda_handler_records_emergency_email_phase(mock_manager):
+    """Test that the emergency email is timed as a phase of its own"""
+    event = {
+        "Details": {
+            "Parameters": {"buttonpressed": connect.KEY_EMERGENCY},
+            "ContactData": {"CustomerEndpoint": {"Address": "+441234567890"}}
+        }
+    }
+
+    connect.lambda_handler(event, None)
+
+    assert ("Emergency", connect.PHASE_EMAIL) in _phases(mock_manager)
+
+def _emergency_appointment():
+    return {
+        "id": "1",
+        "subject": "Site visit",
+        "categories": [],
+        "attendees": [{'emailAddress': {'address': "test@example.com"}}],
+        "location": {"displayName": "12 High Street"},
+        "body": {"content": "Details"},
+        "start": {"dateTime": "2024-01-01T10:00:00.0000000", "timeZone": "Etc/GMT"},
+        "end": {"dateTime": "2024-01-01T11:00:00.0000000", "timeZone": "Etc/GMT"},
+    }
+
+def test_handle_emergency_sends_email_while_looking_up(mock_manager):
+    """Test that the emergency email does not wait for the caller to be looked up"""
+    email_sent = threading.Event()
+    mock_manager.send_email.side_effect = lambda *args: email_sent.set()
+
+    def phone_to_email(phone_number):
+        # Would time out if the email were only sent after the lookup
+        assert email_sent.wait(5)
+        return ["test@example.com"], "Test User"
+    mock_manager.phone_to_email.side_effect = phone_to_email
+
+    connect.handle_emergency(mock_manager, "+441234567890")
+
+    assert mock_manager.send_email.call_count == 2
+
+def test_handle_emergency_follow_up_has_meeting_details(mock_manager):
+    """Test that the follow-up email gives the caller and the meetings tagged"""
+    mock_manager.send_calendar_patches.return_value = {"1": 200}
+    with patch("connect.get_calendar", return_value=[_emergency_appointment()]):
+        message, appointment_result = connect.handle_emergency(mock_manager, "+441234567890")
+
+    assert message == "Emergency email sent."
+    assert appointment_result == "Emergency appointment updated."
+    content = mock_manager.send_email.call_args_list[1].args[2]
+    assert "Test User" in content
+    assert "Site visit" in content
+    assert "12 High Street" in content
+    local_start = utils.parse_graph_datetime("2024-01-01T10:00:00.0000000").astimezone()
+    assert local_start.strftime('%Y-%m-%d %H:%M') in content
+
+def test_handle_emergency_lookup_failure_still_sends_email(mock_manager):
+    """Test that failing to look up the caller neither stops the emergency email nor fails the call"""
+    mock_manager.phone_to_email.side_effect = RuntimeError("Graph unavailable")
+    event = {
+        "Details": {
+            "Parameters": {"buttonpressed": connect.KEY_EMERGENCY},
+            "ContactData": {"CustomerEndpoint": {"Address": "+441234567890"}}
+        }
+    }
+
+    result = connect.lambda_handler(event, None)
+
+    assert result["success"]
+    assert "Graph unavailable" in result["appointment check result"]
+    assert mock_manager.send_email.call_args_list[0].args[1] == "Emergency Assistance Required!"
+    assert "Graph unavailable" in mock_manager.send_email.call_args_list[1].args[2]
+
+def test_handle_emergency_email_failure_raises(mock_manager):
+    """Test that a failure to send the emergency email is not hidden"""
+    mock_manager.send_email.side_effect = RuntimeError("Mail unavailable")
+
+    with pytest.raises(RuntimeError):
+        connect.handle_emergency(mock_manager, "+441234567890")
+
+def test_phase_timer_adds_repeated_phases():
+    """Test that time spent in a phase more than once is added together"""
+    timer = connect.PhaseTimer()
+    with patch("connect.time.perf_counter", side_effect=[1.0, 1.5, 2.0, 2.25]):
+        with timer.phase(connect.PHASE_CALENDAR):
+            pass
+        with timer.phase(connect.PHASE_CALENDAR):
+            pass
+    assert timer.phases == {connect.PHASE_CALENDAR: 0.75}
+
 def test_lambda_handler_missing_phone(mock_manager):
     """Test lambda handler with missing phone number"""
     event = {
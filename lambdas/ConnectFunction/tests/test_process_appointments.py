@@ -72,6 +72,32 @@ class TestProcessAppointmentsCheckin:
         # The recovery branch retro-actively completes the earlier meeting.
         dummy_manager.increment_counter.assert_any_call(connect.METRIC_MEETINGS_COMPLETED_OK)
 
+    def test_checkin_and_missed_checkout_share_reference_time(self, dummy_manager):
+        """Test that both lookups use one reference time, so the calendar is read once"""
+        addresses = ["billy@example.com"]
+        appointments = [
+            make_appointment(categories=[], attendee_mails=addresses)
+        ]
+        dummy_manager.get_calendar_events.side_effect = [appointments, []]
+        connect.process_appointments(dummy_manager, addresses, connect.KEY_CHECK_IN)
+        first, second = dummy_manager.get_calendar_events.call_args_list
+        assert first.kwargs["now"] is not None
+        assert first.kwargs["now"] == second.kwargs["now"]
+
+    def test_checkin_skips_missed_checkout_when_deadline_close(self, dummy_manager):
+        """Test that the missed check-out lookup is skipped when little time remains"""
+        addresses = ["billy@example.com"]
+        appointments = [
+            make_appointment(categories=[], attendee_mails=addresses)
+        ]
+        dummy_manager.get_calendar_events.side_effect = [appointments]
+        dummy_manager.deadline.has_time.return_value = False
+        dummy_manager.deadline.remaining_sec.return_value = 2.0
+        result = connect.process_appointments(dummy_manager, addresses, connect.KEY_CHECK_IN)
+        assert result == (True, "Your appointment has been checked in.")
+        dummy_manager.get_calendar_events.assert_called_once()
+        dummy_manager.increment_counter.assert_any_call(connect.METRIC_FOLLOW_UP_SKIPPED)
+
     def test_already_checked_in(self, dummy_manager):
         """Test attempting to check in to an already checked-in appointment"""
         addresses = ["billy@example.com"]
@@ -155,6 +181,23 @@ class TestProcessAppointmentsCheckout:
         result = connect.process_appointments(dummy_manager, addresses, connect.KEY_CHECK_OUT)
         assert result == (False, "No valid appointments found for checkout.")
 
+class TestProcessAppointmentsNotFound:
+    """Tests for telling apart why no appointment was found"""
+
+    def test_nothing_due(self, dummy_manager):
+        """Test a check-in when no appointment is due at all"""
+        dummy_manager.get_calendar_events.return_value = []
+        result = connect.process_appointments(dummy_manager, ["billy@example.com"], connect.KEY_CHECK_IN)
+        assert result == (False, "No matching appointments found.")
+
+    def test_caller_not_attending(self, dummy_manager):
+        """Test a check-in when appointments are due but the caller attends none of them"""
+        other = make_appointment(attendee_mails=["someone@example.com"])
+        dummy_manager.get_calendar_events.side_effect = (
+            lambda time_filters, now=None, attendees=None, select=None: [] if attendees else [other])
+        result = connect.process_appointments(dummy_manager, ["billy@example.com"], connect.KEY_CHECK_IN)
+        assert result == (False, connect.MESSAGE_NOT_ATTENDEE)
+
 class TestProcessAppointmentsEmergency:
     """Tests for emergency functionality in process_appointments"""
 
@@ -175,16 +218,41 @@ class TestProcessAppointmentsEmergency:
         result = connect.process_appointments(dummy_manager, addresses, connect.KEY_EMERGENCY)
         assert result == (True, "Emergency appointment updated.")
 
+    def test_emergency_updates_sent_together(self, dummy_manager):
+        """Test that an emergency matching several meetings sends their updates in one batch"""
+        addresses = ["billy@example.com"]
+        appointments = [
+            make_appointment(appointment_id="1", categories=[], attendee_mails=addresses),
+            make_appointment(appointment_id="2", categories=[], attendee_mails=addresses),
+        ]
+        dummy_manager.get_calendar_events.return_value = appointments
+        dummy_manager.send_calendar_patches.return_value = {"1": 200, "2": 200}
+
+        result = connect.process_appointments(dummy_manager, addresses, connect.KEY_EMERGENCY)
+
+        assert result == (True, "Emergency appointment updated.")
+        queued_ids = sorted(c.args[0] for c in dummy_manager.queue_calendar_patch.call_args_list)
+        assert queued_ids == ["1", "2"]
+        dummy_manager.send_calendar_patches.assert_called_once()
+        dummy_manager.patch_calendar_event.assert_not_called()
+
+    def test_emergency_update_failure_raises(self, dummy_manager):
+        """Test that a failed batched emergency update is reported"""
+        addresses = ["billy@example.com"]
+        dummy_manager.get_calendar_events.return_value = [make_appointment(categories=[], attendee_mails=addresses)]
+        dummy_manager.send_calendar_patches.return_value = {"1": 500}
+
+        with pytest.raises(RuntimeError):
+            connect.process_appointments(dummy_manager, addresses, connect.KEY_EMERGENCY)
+
 class TestProcessAppointmentsGeneral:
     """General tests for process_appointments"""
 
     def test_no_matching_appointments(self, dummy_manager):
         """Test when no matching appointments are found"""
         addresses = ["fred@example.com"]
-        appointments = [
-            make_appointment(categories=[], attendee_mails=["billy@example.com"])
-        ]
-        dummy_manager.get_calendar_events.return_value = appointments
+        # The manager only returns events with one of the addresses as an attendee
+        dummy_manager.get_calendar_events.return_value = []
         result = connect.process_appointments(dummy_manager, addresses, connect.KEY_CHECK_IN)
         assert result == (False, "No matching appointments found.")
         dummy_manager.increment_counter.assert_any_call(connect.METRIC_APPT_NOT_FOUND)
@@ -23,6 +23,12 @@ def dummy_manager():
     manager.patch_calendar_event = MagicMock()
     return manager
 
+def assert_patched(manager, event_id, changes):
+    """Assert that one update was made, with the given changes, conditional on the event's etag"""
+    manager.patch_calendar_event.assert_called_once()
+    assert manager.patch_calendar_event.call_args.args == (event_id, changes)
+    assert manager.patch_calendar_event.call_args.kwargs["etag"] == "etag-1"
+
 def make_test_appointment(categories=None, body_content="<body>Test content</body>"):
     """Helper to create a test appointment with specified categories and body content"""
     if categories is None:
@@ -31,7 +37,8 @@ def make_test_appointment(categories=None, body_content="<body>Test content</bod
         "id": "test-id",
         "subject": "Test Appointment",
         "categories": categories.copy(),  # Copy to prevent modification of input
-        "body": {"content": body_content}
+        "body": {"content": body_content},
+        "@odata.etag": "etag-1"
     }
 
 @freeze_time("2024-01-01 10:00:00")
@@ -44,7 +51,7 @@ def test_update_appointment_checkin(dummy_manager):
     assert result is False  # Not already done
     assert utils.CHECKED_IN in appointment["categories"]
     assert "<p>Checked in by phone at 2024-01-01 10:00:00</p>" in appointment["body"]["content"]
-    dummy_manager.patch_calendar_event.assert_called_once_with(
+    assert_patched(dummy_manager,
         "test-id",
         {
             "categories": [utils.CHECKED_IN],
@@ -62,7 +69,7 @@ def test_update_appointment_checkout(dummy_manager):
     assert result is False  # Not already done
     assert utils.CHECKED_OUT in appointment["categories"]
     assert "<p>Checked out by phone at 2024-01-01 10:00:00</p>" in appointment["body"]["content"]
-    dummy_manager.patch_calendar_event.assert_called_once_with(
+    assert_patched(dummy_manager,
         "test-id",
         {
             "categories": [utils.CHECKED_OUT],
@@ -80,7 +87,7 @@ def test_update_appointment_emergency(dummy_manager):
     assert result is False  # Not already done
     assert utils.EMERGENCY in appointment["categories"]
     assert "<p>Emergency reported by phone at 2024-01-01 10:00:00</p>" in appointment["body"]["content"]
-    dummy_manager.patch_calendar_event.assert_called_once_with(
+    assert_patched(dummy_manager,
         "test-id",
         {
             "categories": [utils.EMERGENCY],
@@ -106,3 +113,45 @@ def test_update_appointment_preserves_categories(dummy_manager):
     assert "ExistingCategory" in appointment["categories"]
     assert utils.CHECKED_IN in appointment["categories"]
     assert len(appointment["categories"]) == 2
+
+def test_update_appointment_reads_body_when_not_fetched(dummy_manager):
+    """Test that the body is read for the appointment being changed if the calendar read left it out"""
+    appointment = make_test_appointment()
+    del appointment["body"]
+    dummy_manager.get_calendar_event.return_value = {"id": "test-id", "body": {"content": "<body>Notes</body>"}}
+
+    connect.update_appointment(dummy_manager, appointment, connect.KEY_CHECK_IN)
+
+    dummy_manager.get_calendar_event.assert_called_once_with("test-id", ("body",))
+    changes = dummy_manager.patch_calendar_event.call_args.args[1]
+    assert changes["body"]["content"].startswith("<body>Notes<p>Checked in by phone")
+
+def test_update_appointment_already_done_skips_body_read(dummy_manager):
+    """Test that the body is not read when nothing needs changing"""
+    appointment = make_test_appointment(categories=[utils.CHECKED_IN])
+    del appointment["body"]
+
+    connect.update_appointment(dummy_manager, appointment, connect.KEY_CHECK_IN)
+
+    dummy_manager.get_calendar_event.assert_not_called()
+
+def test_update_appointment_merges_after_conflict(dummy_manager):
+    """Test the merge used if the appointment changed since it was read"""
+    appointment = make_test_appointment(categories=["Blue"])
+    connect.update_appointment(dummy_manager, appointment, connect.KEY_CHECK_IN)
+    merge = dummy_manager.patch_calendar_event.call_args.kwargs["merge"]
+
+    # Someone else added a category meanwhile; ours is added to theirs.
+    changes = merge({"categories": ["Blue", "Red"], "body": {"content": "<body>New</body>"}})
+    assert changes["categories"] == ["Blue", "Red", utils.CHECKED_IN]
+    assert changes["body"]["content"].startswith("<body>New<p>Checked in by phone")
+
+    # Someone else checked in meanwhile; nothing to do.
+    assert merge({"categories": [utils.CHECKED_IN], "body": {"content": "<body></body>"}}) is None
+
+def test_update_appointment_done_by_merge(dummy_manager):
+    """Test that an update found unnecessary after a conflict is reported as already done"""
+    appointment = make_test_appointment()
+    dummy_manager.patch_calendar_event.return_value = False
+
+    assert connect.update_appointment(dummy_manager, appointment, connect.KEY_CHECK_IN) is True
@@ -0,0 +1,138 @@
+from datetime import datetime
+import datetime as dt
+import os
+
+import loneworker_utils as utils
+import directory_index
+import state_store
+
+METRIC_DIRECTORY_CHANGES = "DirectoryChanges"
+METRIC_INDEXED_NUMBERS = "IndexedNumbers"
+
+ALL_METRICS = [METRIC_DIRECTORY_CHANGES, METRIC_INDEXED_NUMBERS]
+
+# Index stores, by store type, kept for the life of the container.
+_stores = {}
+
+logger = utils.get_logger()
+
+def get_store(store_type, s3=None):
+    """
+    Returns the store the index is published to, reusing it for the life of the container.
+
+    Args:
+        store_type (str): Store type, as accepted by state_store.make_state_store
+        s3: boto3 S3 client, for an "s3:" store
+
+    Raises:
+        ValueError: If no store is configured
+    """
+    if store_type not in _stores:
+        _stores[store_type] = state_store.make_state_store(store_type, s3)
+    if _stores[store_type] is None:
+        raise ValueError("The directory index needs the directory_index store")
+    return _stores[store_type]
+
+def sync_directory(manager, state):
+    """
+    Brings the sync state up to date with the contacts and users.
+
+    Args:
+        manager (LoneWorkerManager): Manager instance for handling API calls
+        state (dict): Sync state from the previous sync, or None
+
+    Returns:
+        tuple: (state, changes) where:
+            - state (dict): The updated sync state, holding the version of the last index
+              published and, for each of directory_index.CONTACTS and USERS:
+                - delta_link: The delta link to use next time
+                - entries: The contacts or users by ID, holding only directory_index.SELECT
+            - changes (int): The number of entries added, changed or removed
+
+    A kind whose delta link Graph no longer accepts is read again in full.
+    """
+    if state is None:
+        state = {"index_version": 0}
+
+    changes = 0
+    for kind in (directory_index.CONTACTS, directory_index.USERS):
+        source = state.get(kind) or {"delta_link": None, "entries": {}}
+        try:
+            items, removed_ids, delta_link = manager.get_directory_delta(kind, source["delta_link"])
+        except utils.DeltaLinkExpired:
+            logger.info("Directory %s delta link expired - starting again", kind)
+            changes += len(source["entries"])
+            source = {"delta_link": None, "entries": {}}
+            items, removed_ids, delta_link = manager.get_directory_delta(kind)
+
+        entries = source["entries"]
+        for entry_id in removed_ids:
+            if entries.pop(entry_id, None) is not None:
+                changes += 1
+        for item in items:
+            # Changes may carry only the fields that changed.
+            entry = entries.setdefault(item["id"], {})
+            entry.update({field: item[field] for field in directory_index.SELECT[kind]
+                          if field in item and field != "id"})
+            changes += 1
+        source["delta_link"] = delta_link
+        state[kind] = source
+
+    return state, changes
+
+def lambda_handler(event, context):
+    """
+    AWS Lambda handler that keeps the phone number index up to date, run on a schedule.
+
+    Args:
+        event (dict): AWS Lambda event (unused)
+        context (LambdaContext): AWS Lambda context object, used to set the deadline for Graph calls
+
+    Returns:
+        dict: Response containing:
+            - version: The version of the published index
+            - changes: The number of contacts and users added, changed or removed
+            - numbers: The number of phone numbers in the index, if a new one was published
+            - operations: Calls, time taken, bytes received and statuses for each kind of
+              outbound call (see LoneWorkerManager.get_operation_summary)
+
+    The function:
+    - Reads the changes to the shared mailbox's contacts and the directory's users
+      since the last run, through their delta queries, into the sync state
+    - Publishes a new version of the index, built from the sync state, if anything
+      changed or none has been published, and otherwise marks the index as synced so
+      that readers keep using it
+    - Saves the sync state, in the store named by the directory_index environment variable
+    - Emits metrics about the changes
+    """
+    logger.info("Syncing directory")
+
+    # Reuses the manager (config, token and clients) from a warm container where possible.
+    manager = utils.get_manager("Directory", ALL_METRICS, utils.Deadline(context))
+    store = get_store(os.environ.get('directory_index', ''), manager.s3)
+
+    state, changes = sync_directory(manager, store.load(directory_index.SYNC_KEY))
+    manager.increment_counter(METRIC_DIRECTORY_CHANGES, changes)
+    result = {"version": state["index_version"], "changes": changes}
+
+    now = datetime.now(dt.timezone.utc)
+    index = None if changes else store.load(directory_index.INDEX_KEY)
+    if index is None:
+        state["index_version"] += 1
+        index = directory_index.build_index(state, state["index_version"], now, manager.number_plan)
+        # The index is published before the sync state is saved, so that if the save
+        # fails the next run makes the same changes again rather than losing them.
+        store.save(directory_index.INDEX_KEY, index)
+        manager.increment_counter(METRIC_INDEXED_NUMBERS, len(index["numbers"]))
+        logger.info("Published directory index version %d of %d numbers",
+                    index["version"], len(index["numbers"]))
+        result.update(version=index["version"], numbers=len(index["numbers"]))
+    else:
+        directory_index.mark_synced(index, now)
+        store.save(directory_index.INDEX_KEY, index)
+        logger.info("No directory changes - index version %d kept and marked synced", index["version"])
+
+    store.save(directory_index.SYNC_KEY, state)
+    manager.emit_metrics()
+    result["operations"] = manager.get_operation_summary()
+    return result
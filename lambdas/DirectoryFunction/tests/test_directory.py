@@ -0,0 +1,133 @@
+import sys
+import os
+import types
+
+# Add the local src directories to the include path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "../src"))
+# Add the dependencies directory to sys.path to load the proper loneworker_utils module.
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "../../dependencies/src"))
+# Dummy out boto3 so that loneworker_utils loads without trying to use boto3.
+dummy_boto3 = types.ModuleType("boto3")
+sys.modules["boto3"] = dummy_boto3
+
+from unittest.mock import MagicMock, patch
+
+import pytest
+import directory
+import directory_index
+import loneworker_utils as utils
+import phone_numbers
+
+CONTACTS = directory_index.CONTACTS
+USERS = directory_index.USERS
+
+class FakeDirectory:
+    """
+    Holds contacts and users, and answers delta queries for them as Graph does.
+    """
+    def __init__(self):
+        self.items = {CONTACTS: {}, USERS: {}}
+        self.changes = {CONTACTS: [], USERS: []}
+        self.expired = set()
+
+    def put(self, kind, item):
+        self.items[kind][item["id"]] = item
+        self.changes[kind].append(item)
+
+    def remove(self, kind, item_id):
+        del self.items[kind][item_id]
+        self.changes[kind].append({"id": item_id, "@removed": {"reason": "deleted"}})
+
+    def get_directory_delta(self, kind, delta_link=None):
+        if delta_link in self.expired:
+            raise utils.DeltaLinkExpired("expired")
+        if delta_link is None:
+            changed = list(self.items[kind].values())
+        else:
+            changed = self.changes[kind]
+        self.changes[kind] = []
+        items = [item for item in changed if "@removed" not in item]
+        removed_ids = [item["id"] for item in changed if "@removed" in item]
+        return items, removed_ids, f"https://{kind}/delta/{len(self.expired)}"
+
+@pytest.fixture
+def store(monkeypatch):
+    monkeypatch.setenv("directory_index", "memory")
+    directory._stores.clear()
+    yield directory.get_store("memory")
+    directory._stores.clear()
+
+@pytest.fixture
+def graph():
+    return FakeDirectory()
+
+@pytest.fixture
+def manager(graph):
+    with patch('loneworker_utils.get_manager') as mock:
+        manager = MagicMock()
+        mock.return_value = manager
+        manager.get_directory_delta.side_effect = graph.get_directory_delta
+        manager.number_plan = phone_numbers.DEFAULT_PLAN
+        manager.get_operation_summary.return_value = {}
+        yield manager
+
+def _numbers(store):
+    return store.load(directory_index.INDEX_KEY)["numbers"]
+
+def test_first_run_publishes_index(store, graph, manager):
+    graph.put(USERS, {"id": "u1", "displayName": "Worker", "mobilePhone": "+447700900123", "mail": "worker@example.com"})
+    graph.put(CONTACTS, {"id": "c1", "displayName": "Visitor", "mobilePhone": "07700 900456",
+                         "emailAddresses": [{"address": "visitor@example.com"}]})
+
+    result = directory.lambda_handler({}, None)
+
+    assert result == {"version": 1, "changes": 2, "numbers": 2, "operations": {}}
+    assert _numbers(store) == {
+        "+447700900123": {"addresses": ["worker@example.com"], "display_name": "Worker"},
+        "+447700900456": {"addresses": ["visitor@example.com"], "display_name": "Visitor"},
+    }
+    manager.increment_counter.assert_any_call(directory.METRIC_DIRECTORY_CHANGES, 2)
+    manager.emit_metrics.assert_called_once()
+
+def test_no_changes_keeps_version(store, graph, manager):
+    graph.put(USERS, {"id": "u1", "displayName": "Worker", "mobilePhone": "+447700900123", "mail": "worker@example.com"})
+    directory.lambda_handler({}, None)
+
+    result = directory.lambda_handler({}, None)
+
+    assert result == {"version": 1, "changes": 0, "operations": {}}
+    index = store.load(directory_index.INDEX_KEY)
+    assert index["version"] == 1
+    # Marked as synced by the second run, so readers keep using it.
+    assert index["synced_at"] > index["built_at"]
+
+def test_changes_applied_incrementally(store, graph, manager):
+    graph.put(USERS, {"id": "u1", "displayName": "Worker", "mobilePhone": "+447700900123", "mail": "worker@example.com"})
+    graph.put(USERS, {"id": "u2", "displayName": "Leaver", "mobilePhone": "+447700900456", "mail": "leaver@example.com"})
+    directory.lambda_handler({}, None)
+
+    # The worker's number changes (Graph may send only the changed field), and the leaver goes.
+    graph.put(USERS, {"id": "u1", "mobilePhone": "+447700900789"})
+    graph.remove(USERS, "u2")
+    result = directory.lambda_handler({}, None)
+
+    assert result["version"] == 2
+    assert _numbers(store) == {"+447700900789": {"addresses": ["worker@example.com"], "display_name": "Worker"}}
+    delta_links = [call.args[1] for call in manager.get_directory_delta.call_args_list[2:]]
+    assert delta_links == ["https://contacts/delta/0", "https://users/delta/0"]
+
+def test_expired_delta_link_reads_again(store, graph, manager):
+    graph.put(USERS, {"id": "u1", "displayName": "Worker", "mobilePhone": "+447700900123", "mail": "worker@example.com"})
+    directory.lambda_handler({}, None)
+
+    graph.expired.add("https://users/delta/0")
+    result = directory.lambda_handler({}, None)
+
+    assert result["version"] == 2
+    assert "+447700900123" in _numbers(store)
+
+def test_missing_store(monkeypatch, manager):
+    monkeypatch.setenv("directory_index", "")
+    directory._stores.clear()
+    with pytest.raises(ValueError):
+        directory.lambda_handler({}, None)
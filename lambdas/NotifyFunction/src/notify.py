@@ -0,0 +1,254 @@
+import base64
+import boto3
+from datetime import datetime, timedelta
+import datetime as dt
+import json
+import os
+
+import loneworker_utils as utils
+import calendar_sync
+import due_scheduler
+import metrics_backend
+import state_store
+import subscriptions
+
+METRIC_NOTIFICATIONS = "Notifications"
+METRIC_NOTIFICATIONS_REJECTED = "NotificationsRejected"
+METRIC_CALENDAR_SYNCS = "CalendarSyncs"
+
+ALL_METRICS = [METRIC_NOTIFICATIONS, METRIC_NOTIFICATIONS_REJECTED, METRIC_CALENDAR_SYNCS]
+
+# Lifecycle notifications Graph sends about the subscription itself.
+LIFECYCLE_REAUTHORIZATION_REQUIRED = "reauthorizationRequired"
+LIFECYCLE_SUBSCRIPTION_REMOVED = "subscriptionRemoved"
+LIFECYCLE_MISSED = "missed"
+
+# Modes the handler runs in. Graph's requests come through the Function URL with no
+# mode, and are answered as soon as their notifications are checked; the notifications
+# are then dealt with by an asynchronous invocation of this function in MODE_PROCESS.
+MODE_PROCESS = "process"
+
+# State stores and due run schedulers, by type, kept for the life of the container.
+_stores = {}
+_schedulers = {}
+
+# AWS clients by service, and the mailbox owning the calendar, kept for the life of the
+# container. Requests from Graph use these rather than a manager, which would read all
+# the configuration and get a Graph token first.
+_clients = {}
+_mailbox = {}
+
+logger = utils.get_logger()
+
+def http_response(status, body="", content_type="text/plain"):
+    """
+    Builds a Lambda Function URL response.
+
+    Args:
+        status (int): HTTP status code
+        body (str, optional): Response body
+        content_type (str, optional): Content type of the body
+
+    Returns:
+        dict: The response, as expected by Lambda Function URLs
+    """
+    return {
+        "statusCode": status,
+        "headers": {"Content-Type": content_type},
+        "body": body,
+    }
+
+def parse_notifications(event):
+    """
+    Reads the notifications from the body of a Function URL request.
+
+    Args:
+        event (dict): The Function URL event
+
+    Returns:
+        list: The notifications (the "value" of the posted JSON)
+
+    Raises:
+        ValueError: If the body is not a JSON notification collection
+    """
+    body = event.get("body") or ""
+    if event.get("isBase64Encoded"):
+        body = base64.b64decode(body).decode()
+    try:
+        notifications = json.loads(body)["value"]
+    except (ValueError, KeyError, TypeError) as e:
+        raise ValueError(f"Not a notification collection: {e}")
+    if not isinstance(notifications, list):
+        raise ValueError("Not a notification collection: value is not a list")
+    return notifications
+
+def get_store(store_type, s3=None):
+    """
+    Returns the store shared with the Check function, reusing it for the life of the container.
+
+    Args:
+        store_type (str): Store type, as accepted by state_store.make_state_store
+        s3: boto3 S3 client, for an "s3:" store
+
+    Raises:
+        ValueError: If no store is configured
+    """
+    if store_type not in _stores:
+        _stores[store_type] = state_store.make_state_store(store_type, s3)
+    if _stores[store_type] is None:
+        raise ValueError("Change notifications need the sweep_state store")
+    return _stores[store_type]
+
+def get_scheduler(scheduler_type):
+    """
+    Returns the scheduler for the Check function's due runs, reusing it for the life of
+    the container.
+
+    Args:
+        scheduler_type (str): Scheduler type, as accepted by due_scheduler.make_scheduler.
+            There is no in-process scheduler here, as the runs are the Check function's.
+
+    Returns:
+        The scheduler, or None if due runs are not scheduled
+    """
+    if scheduler_type not in _schedulers:
+        _schedulers[scheduler_type] = due_scheduler.make_scheduler(scheduler_type)
+    return _schedulers[scheduler_type]
+
+def get_client(service):
+    """
+    Returns a boto3 client for a service, reusing it for the life of the container.
+    """
+    if service not in _clients:
+        _clients[service] = boto3.client(service)
+    return _clients[service]
+
+def get_mailbox():
+    """
+    Returns the mailbox owning the calendar, whose subscription record the notifications
+    are checked against, reading it from the Parameter Store once per container.
+    """
+    if "username" not in _mailbox:
+        name = "/" + os.environ['ssm_prefix'].strip("/") + "/emailuser"
+        _mailbox["username"] = get_client('ssm').get_parameter(Name=name)["Parameter"]["Value"]
+    return _mailbox["username"]
+
+def lambda_handler(event, context):
+    """
+    AWS Lambda handler for Graph change notifications on the shared calendar, called
+    through a Lambda Function URL.
+
+    Args:
+        event (dict): Function URL event, with either:
+            - queryStringParameters.validationToken: For Graph's check of the URL when the
+              subscription is created
+            - body: A JSON collection of change or lifecycle notifications
+            or, for the asynchronous invocation dealing with them, "mode" MODE_PROCESS and
+            "notifications", those that passed the checks
+        context (LambdaContext): AWS Lambda context object, used to set the deadline for Graph calls
+
+    Returns:
+        dict: Function URL response:
+            - 200 with the validation token as plain text, for a validation request
+            - 202 once notifications have been checked
+            - 400 if the body is not a notification collection
+
+    Graph expects an answer to a notification within 3 seconds, and throttles or drops
+    notifications to endpoints that are slower. So the function only checks the
+    notifications against the subscription's ID and clientState (ignoring those that do
+    not match), invokes itself asynchronously with those left, and returns. See
+    process_notifications for how they are then dealt with.
+    """
+    if event.get("mode") == MODE_PROCESS:
+        process_notifications(event["notifications"], context)
+        return {"message": "Notifications processed"}
+
+    # Graph expects the token back within 10 seconds, so it is answered without
+    # waiting for configuration or a token.
+    validation_token = (event.get("queryStringParameters") or {}).get("validationToken")
+    if validation_token is not None:
+        logger.info("Answering subscription validation request")
+        return http_response(200, validation_token)
+
+    try:
+        notifications = parse_notifications(event)
+    except ValueError as e:
+        logger.warning("Rejecting request: %s", e)
+        return http_response(400, str(e))
+    logger.info("Received %d notifications", len(notifications))
+
+    store = get_store(os.environ.get('sweep_state', ''), get_client('s3'))
+    record = store.load(subscriptions.subscription_key(get_mailbox()))
+    valid = [n for n in notifications if subscriptions.is_valid_notification(record, n)]
+    if len(valid) < len(notifications):
+        logger.warning("Ignoring %d notifications not from our subscription", len(notifications) - len(valid))
+
+    # Counted as Embedded Metric Format records, which cost no network call.
+    namespace = f"{os.environ['ssm_prefix']}/Notify"
+    metrics_backend.make_metrics_backend(metrics_backend.EMF, namespace).emit({
+        METRIC_NOTIFICATIONS: len(notifications),
+        METRIC_NOTIFICATIONS_REJECTED: len(notifications) - len(valid),
+    }, datetime.now(dt.timezone.utc))
+
+    if valid:
+        get_client('lambda').invoke(FunctionName=context.function_name, InvocationType='Event',
+                                    Payload=json.dumps({"mode": MODE_PROCESS, "notifications": valid}))
+    return http_response(202)
+
+def process_notifications(notifications, context):
+    """
+    Deals with notifications that have been checked as coming from the subscription.
+
+    Args:
+        notifications (list): The change and lifecycle notifications
+        context (LambdaContext): AWS Lambda context object, used to set the deadline for Graph calls
+
+    The function:
+    - For change notifications (and missed notification warnings), brings the sweep state
+      shared with the Check function up to date through a calendarView delta query, so
+      that Check's due runs can see what is due without reading the calendar, and (if the
+      due_scheduler environment variable names a scheduler) schedules a due run for the
+      next time an appointment's grace period runs out, which may have moved; the state is
+      saved only if no other run saved it meanwhile, and otherwise synced again
+    - For reauthorizationRequired and subscriptionRemoved lifecycle notifications,
+      renews or recreates the subscription, unless its record has gone
+    - Emits metrics about the calendar syncs
+    """
+    logger.info("Processing %d notifications", len(notifications))
+
+    # Reuses the manager (config, token and clients) from a warm container where possible.
+    manager = utils.get_manager("Notify", ALL_METRICS, utils.Deadline(context))
+
+    store = get_store(os.environ.get('sweep_state', ''), manager.s3)
+    record = store.load(subscriptions.subscription_key(manager.username))
+
+    now = datetime.now(dt.timezone.utc)
+    lifecycle_events = {n["lifecycleEvent"] for n in notifications if "lifecycleEvent" in n}
+    if lifecycle_events & {LIFECYCLE_REAUTHORIZATION_REQUIRED, LIFECYCLE_SUBSCRIPTION_REMOVED}:
+        if record is None:
+            # For instance, the record was deleted after the notification was checked.
+            logger.warning("Lifecycle notifications %s but no subscription record - not renewing",
+                           lifecycle_events)
+        else:
+            logger.info("Lifecycle notifications %s - renewing subscription", lifecycle_events)
+            subscriptions.ensure_subscription(manager, store, record["notification_url"], now, renew=True)
+
+    # One delta query picks up every change notified, however many there are.
+    if any("lifecycleEvent" not in n or n["lifecycleEvent"] == LIFECYCLE_MISSED for n in notifications):
+        check_cfg = manager.cfg.get_app_cfg("check")
+        scheduler = get_scheduler(os.environ.get('due_scheduler', ''))
+
+        def sync(state):
+            state, _ = calendar_sync.sync_calendar(manager, state, now, check_cfg["ignore_after_min"])
+            if scheduler is not None:
+                due_scheduler.schedule_next_due(scheduler, state, timedelta(minutes=check_cfg["grace_min"]), now)
+            return state
+
+        # Check runs (and other Notify runs) save the state too, so it is only saved if
+        # unchanged since it was loaded, and otherwise synced again from the newer state.
+        state = state_store.update(store, calendar_sync.state_key(manager.username), sync,
+                                   calendar_sync.STATE_SAVE_ATTEMPTS)
+        manager.increment_counter(METRIC_CALENDAR_SYNCS)
+        logger.info("Sweep state updated; %d events changed since the last sweep", len(state["changed_ids"]))
+
+    manager.emit_metrics()
@@ -0,0 +1,201 @@
+"""
+Local stand-in for Graph change notifications, so that the Notify function can be
+tested offline.
+
+NotificationEndpoint serves a Lambda handler over HTTP, turning each request into a
+Function URL event as AWS does. GraphNotifier plays Graph's part, validating the
+endpoint and posting change and lifecycle notifications to it.
+
+Run as a script, this serves notify.lambda_handler on a local port. The handler still
+needs AWS credentials and the environment variables set by the template.
+"""
+import argparse
+import base64
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import sys
+import threading
+import time
+from urllib.parse import parse_qsl, urlsplit
+import uuid
+
+import requests
+
+class LocalContext:
+    def __init__(self, timeout_sec, function_name="NotifyFunction"):
+        """
+        Initializes a stand-in for the Lambda context, for an invocation with the given timeout.
+        """
+        self.expires = time.monotonic() + timeout_sec
+        self.function_name = function_name
+
+    def get_remaining_time_in_millis(self):
+        return int(max(0, self.expires - time.monotonic()) * 1000)
+
+class NotificationEndpoint:
+    def __init__(self, handler, host="127.0.0.1", port=0, timeout_sec=30):
+        """
+        Initializes an HTTP endpoint serving a Lambda handler, as a Function URL would.
+
+        Args:
+            handler (callable): The Lambda handler, called with (event, context)
+            host (str, optional): Address to listen on
+            port (int, optional): Port to listen on; 0 picks a free one
+            timeout_sec (float, optional): Timeout given to each invocation
+
+        Use as a context manager, or call start and stop.
+        """
+        endpoint = self
+
+        class RequestHandler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                endpoint.handle(self)
+
+            def do_GET(self):
+                endpoint.handle(self)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.handler = handler
+        self.timeout_sec = timeout_sec
+        self.server = ThreadingHTTPServer((host, port), RequestHandler)
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def handle(self, request):
+        """
+        Invokes the handler for one HTTP request, and writes its response.
+
+        A handler that raises gets a 502, as from a Function URL.
+        """
+        parts = urlsplit(request.path)
+        body = request.rfile.read(int(request.headers.get("Content-Length", 0)))
+        event = {
+            "version": "2.0",
+            "rawPath": parts.path,
+            "rawQueryString": parts.query,
+            "headers": {name.lower(): value for name, value in request.headers.items()},
+            "requestContext": {"http": {"method": request.command, "path": parts.path}},
+            "isBase64Encoded": False,
+            "body": body.decode(),
+        }
+        if parts.query:
+            event["queryStringParameters"] = dict(parse_qsl(parts.query))
+
+        try:
+            response = self.handler(event, LocalContext(self.timeout_sec))
+            status = response.get("statusCode", 200)
+            headers = response.get("headers", {})
+            body = response.get("body", "")
+            if response.get("isBase64Encoded"):
+                body = base64.b64decode(body)
+            elif not isinstance(body, bytes):
+                body = body.encode()
+        except Exception as e:
+            status, headers, body = 502, {"Content-Type": "text/plain"}, str(e).encode()
+
+        request.send_response(status)
+        for name, value in headers.items():
+            request.send_header(name, value)
+        request.send_header("Content-Length", str(len(body)))
+        request.end_headers()
+        request.wfile.write(body)
+
+class GraphNotifier:
+    def __init__(self, url, username="loneworker@example.com", timeout_sec=10):
+        """
+        Initializes a stand-in for Graph posting notifications to a URL.
+
+        Args:
+            url (str): The notification URL
+            username (str, optional): Mailbox named in the notifications' resources
+            timeout_sec (float, optional): How long to wait for the endpoint
+        """
+        self.url = url
+        self.username = username
+        self.timeout_sec = timeout_sec
+
+    def validate(self):
+        """
+        Validates the endpoint, as Graph does when a subscription is created.
+
+        Returns:
+            bool: True if the endpoint echoed the validation token as plain text
+        """
+        token = uuid.uuid4().hex
+        response = requests.post(self.url, params={"validationToken": token}, data="",
+                                 headers={"Content-Type": "text/plain"}, timeout=self.timeout_sec)
+        return (response.status_code == 200 and response.text == token and
+                response.headers.get("Content-Type", "").startswith("text/plain"))
+
+    def post(self, notifications):
+        """
+        Posts a collection of notifications.
+
+        Returns:
+            requests.Response: The endpoint's response
+        """
+        return requests.post(self.url, data=json.dumps({"value": notifications}),
+                             headers={"Content-Type": "application/json"}, timeout=self.timeout_sec)
+
+    def change(self, subscription_id, client_state, event_id, change_type="updated"):
+        """
+        Builds a change notification for a calendar event.
+        """
+        return {
+            "subscriptionId": subscription_id,
+            "clientState": client_state,
+            "changeType": change_type,
+            "resource": f"Users/{self.username}/Events/{event_id}",
+            "resourceData": {"@odata.type": "#Microsoft.Graph.Event", "id": event_id},
+            "tenantId": "00000000-0000-0000-0000-000000000000",
+        }
+
+    def lifecycle(self, subscription_id, client_state, lifecycle_event):
+        """
+        Builds a lifecycle notification, such as reauthorizationRequired.
+        """
+        return {
+            "subscriptionId": subscription_id,
+            "clientState": client_state,
+            "lifecycleEvent": lifecycle_event,
+            "resource": f"Users/{self.username}/Events",
+            "tenantId": "00000000-0000-0000-0000-000000000000",
+        }
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the Notify function locally")
+    parser.add_argument("--port", type=int, default=8080, help="Port to listen on")
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), "../src"))
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), "../../dependencies/src"))
+    import notify
+    with NotificationEndpoint(notify.lambda_handler, host="0.0.0.0", port=args.port) as endpoint:
+        print(f"Serving notify.lambda_handler at {endpoint.url}")
+        endpoint.thread.join()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,208 @@
+import sys
+import os
+import types
+
+# Add the local src directories to the include path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "../src"))
+# Add the dependencies directory to sys.path to load the proper loneworker_utils module.
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "../../dependencies/src"))
+# Dummy out boto3 so that loneworker_utils loads without trying to use boto3.
+dummy_boto3 = types.ModuleType("boto3")
+sys.modules["boto3"] = dummy_boto3
+
+import json
+from datetime import datetime, timedelta, timezone
+from unittest.mock import MagicMock, patch
+
+import pytest
+import calendar_sync
+import metrics_backend
+import notify
+import subscriptions
+from local_graph import GraphNotifier, LocalContext, NotificationEndpoint
+
+USERNAME = "loneworker@example.com"
+
+def _event(event_id, start, end):
+    fmt = lambda d: d.strftime("%Y-%m-%dT%H:%M:%S.0000000")
+    return {"id": event_id,
+            "start": {"dateTime": fmt(start), "timeZone": "Etc/GMT"},
+            "end": {"dateTime": fmt(end), "timeZone": "Etc/GMT"}}
+
+@pytest.fixture
+def store(monkeypatch):
+    monkeypatch.setenv("sweep_state", "memory")
+    notify._stores.clear()
+    store = notify.get_store("memory")
+    store.save(subscriptions.subscription_key(USERNAME), {
+        "id": "sub-1", "client_state": "secret", "notification_url": "https://notify.example.com/",
+        "expiration": (datetime.now(timezone.utc) + timedelta(days=2)).isoformat()})
+    yield store
+    notify._stores.clear()
+    notify._schedulers.clear()
+
+class InlineLambda:
+    """Stand-in for the Lambda client, running an asynchronous self-invocation at once."""
+    def __init__(self):
+        self.invoke = MagicMock(side_effect=self._invoke)
+
+    def _invoke(self, FunctionName, InvocationType, Payload):
+        notify.lambda_handler(json.loads(Payload), LocalContext(10))
+
+@pytest.fixture(autouse=True)
+def clients(monkeypatch):
+    monkeypatch.setenv("ssm_prefix", "loneworker")
+    ssm = MagicMock()
+    ssm.get_parameter.return_value = {"Parameter": {"Value": USERNAME}}
+    notify._clients.update({"ssm": ssm, "s3": MagicMock(), "lambda": InlineLambda()})
+    yield notify._clients
+    notify._clients.clear()
+    notify._mailbox.clear()
+
+@pytest.fixture
+def manager():
+    with patch('loneworker_utils.get_manager') as mock:
+        manager = MagicMock()
+        mock.return_value = manager
+        manager.username = USERNAME
+        manager.cfg.get_app_cfg.return_value = {"grace_min": 15, "ignore_after_min": 75}
+        now = datetime.now(timezone.utc)
+        manager.get_calendar_delta.return_value = (
+            [_event("visit", now + timedelta(minutes=10), now + timedelta(minutes=70))], [], "https://delta1")
+        yield manager
+
+@pytest.fixture(scope="module")
+def graph():
+    with NotificationEndpoint(notify.lambda_handler) as endpoint:
+        yield GraphNotifier(endpoint.url, username=USERNAME)
+
+def test_validation_echoes_token(graph, manager):
+    assert graph.validate()
+    manager.get_calendar_delta.assert_not_called()
+
+def test_change_notification_updates_sweep_state(graph, manager, store):
+    response = graph.post([graph.change("sub-1", "secret", "visit", "created")])
+
+    assert response.status_code == 202
+    manager.get_calendar_delta.assert_called_once()
+    state = store.load(calendar_sync.state_key(USERNAME))
+    assert set(state["events"]) == {"visit"}
+    assert state["changed_ids"] == ["visit"]
+    assert state["delta_link"] == "https://delta1"
+
+def test_change_notification_schedules_next_due(graph, manager, store, monkeypatch):
+    monkeypatch.setenv("due_scheduler", "test")
+    scheduler = MagicMock()
+    notify._schedulers["test"] = scheduler
+
+    graph.post([graph.change("sub-1", "secret", "visit", "created")])
+
+    # The visit starts in 10 minutes, so its check-in is due in 25.
+    when, payload = scheduler.schedule.call_args.args
+    assert payload == {"mode": "due"}
+    assert timedelta(minutes=24) < when - datetime.now(timezone.utc) <= timedelta(minutes=25, seconds=1)
+
+def test_several_notifications_sync_once(graph, manager, store):
+    response = graph.post([graph.change("sub-1", "secret", "a"), graph.change("sub-1", "secret", "b")])
+
+    assert response.status_code == 202
+    manager.get_calendar_delta.assert_called_once()
+
+def test_notifications_not_from_subscription_are_ignored(graph, manager, store):
+    response = graph.post([graph.change("sub-1", "wrong", "visit"), graph.change("sub-2", "secret", "visit")])
+
+    assert response.status_code == 202
+    manager.get_calendar_delta.assert_not_called()
+    assert store.load(calendar_sync.state_key(USERNAME)) is None
+
+def test_unparseable_body_is_rejected(graph, manager, store):
+    response = graph.post("not a list")
+
+    assert response.status_code == 400
+    manager.get_calendar_delta.assert_not_called()
+
+def test_reauthorization_required_renews_subscription(graph, manager, store):
+    manager.renew_subscription.return_value = {"id": "sub-1"}
+
+    response = graph.post([graph.lifecycle("sub-1", "secret", notify.LIFECYCLE_REAUTHORIZATION_REQUIRED)])
+
+    assert response.status_code == 202
+    manager.renew_subscription.assert_called_once()
+    manager.get_calendar_delta.assert_not_called()
+
+def test_subscription_removed_recreates_subscription(graph, manager, store):
+    manager.renew_subscription.return_value = None
+    manager.create_subscription.return_value = {"id": "sub-2"}
+
+    graph.post([graph.lifecycle("sub-1", "secret", notify.LIFECYCLE_SUBSCRIPTION_REMOVED)])
+
+    assert manager.create_subscription.call_args.args[0] == "https://notify.example.com/"
+    assert store.load(subscriptions.subscription_key(USERNAME))["id"] == "sub-2"
+
+def test_notifications_answered_before_processing(graph, manager, store, clients):
+    clients["lambda"] = MagicMock()
+
+    response = graph.post([graph.change("sub-1", "secret", "visit", "created"), graph.change("sub-1", "wrong", "x")])
+
+    assert response.status_code == 202
+    # Neither the configuration, a token nor the calendar is needed to answer.
+    notify.utils.get_manager.assert_not_called()
+    manager.get_calendar_delta.assert_not_called()
+    kwargs = clients["lambda"].invoke.call_args.kwargs
+    assert (kwargs["FunctionName"], kwargs["InvocationType"]) == ("NotifyFunction", "Event")
+    payload = json.loads(kwargs["Payload"])
+    assert payload["mode"] == notify.MODE_PROCESS
+    assert [n["clientState"] for n in payload["notifications"]] == ["secret"]
+    clients["ssm"].get_parameter.assert_called_once_with(Name="/loneworker/emailuser")
+
+def test_notifications_counted_without_processing(graph, manager, store, clients):
+    clients["lambda"] = MagicMock()
+    with patch.object(metrics_backend.EmfBackend, "emit") as emit:
+        graph.post([graph.change("sub-1", "wrong", "visit")])
+
+    clients["lambda"].invoke.assert_not_called()
+    assert emit.call_args.args[0] == {notify.METRIC_NOTIFICATIONS: 1, notify.METRIC_NOTIFICATIONS_REJECTED: 1}
+
+def test_missed_notifications_sync_calendar(graph, manager, store):
+    graph.post([graph.lifecycle("sub-1", "secret", notify.LIFECYCLE_MISSED)])
+
+    manager.get_calendar_delta.assert_called_once()
+
+def test_state_saved_meanwhile_is_synced_again(graph, manager, store):
+    key = calendar_sync.state_key(USERNAME)
+    now = datetime.now(timezone.utc)
+    visit = _event("visit", now + timedelta(minutes=10), now + timedelta(minutes=70))
+    swept = {"window_start": (now - timedelta(hours=2)).isoformat(),
+             "window_end": (now + timedelta(hours=20)).isoformat(),
+             "last_sweep": now.isoformat(), "delta_link": "https://swept",
+             "events": {}, "changed_ids": []}
+
+    def check_saves_meanwhile(**kwargs):
+        # A Check sweep saves the state while this run reads the calendar.
+        store.save(key, swept)
+        manager.get_calendar_delta.side_effect = None
+        return [visit], [], "https://delta1"
+
+    manager.get_calendar_delta.side_effect = check_saves_meanwhile
+    manager.get_calendar_delta.return_value = ([visit], [], "https://delta2")
+
+    graph.post([graph.change("sub-1", "secret", "visit", "created")])
+
+    assert manager.get_calendar_delta.call_count == 2
+    assert manager.get_calendar_delta.call_args.kwargs == {"delta_link": "https://swept"}
+    state = store.load(key)
+    # The sweep's last_sweep is kept, with the change found since.
+    assert state["last_sweep"] == now.isoformat()
+    assert state["changed_ids"] == ["visit"]
+    assert state["delta_link"] == "https://delta2"
+
+def test_lifecycle_notification_without_subscription_record(manager, store):
+    # The record was deleted after the notification was checked.
+    store.entries.pop(subscriptions.subscription_key(USERNAME))
+
+    notify.process_notifications([{"subscriptionId": "sub-1", "clientState": "secret",
+                                   "lifecycleEvent": notify.LIFECYCLE_REAUTHORIZATION_REQUIRED}],
+                                 LocalContext(10))
+
+    manager.renew_subscription.assert_not_called()
+    manager.create_subscription.assert_not_called()
@@ -0,0 +1,221 @@
+"""
+Benchmarks for the calendar filtering and matching hot path.
+
+Generates synthetic Graph /calendarView payloads and times the functions that
+process them. Results are written as JSON so that runs on different commits can
+be compared.
+
+Usage:
+    python bench_calendar.py [--sizes 100,1000,10000,100000] [--repeat 5]
+                             [--output FILE] [--compare FILE]
+"""
+import argparse
+import copy
+import datetime as dt
+import json
+import logging
+import os
+import random
+import statistics
+import subprocess
+import sys
+import time
+import types
+from datetime import datetime, timedelta
+from unittest.mock import MagicMock
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "../dependencies/src"))
+sys.path.insert(0, os.path.join(HERE, "../ConnectFunction/src"))
+sys.path.insert(0, os.path.join(HERE, "../CheckFunction/src"))
+# boto3 is not needed for anything benchmarked here, and may not be installed.
+if "boto3" not in sys.modules:
+    try:
+        import boto3  # noqa: F401
+    except ImportError:
+        sys.modules["boto3"] = types.ModuleType("boto3")
+
+import loneworker_utils as utils
+import connect
+import check
+
+DEFAULT_SIZES = [100, 1000, 10000, 100000]
+WORKER_COUNT = 200
+CATEGORY_CHOICES = [[], [], [utils.CHECKED_IN], [utils.CHECKED_IN, utils.CHECKED_OUT],
+                    [utils.MISSED_CHECK_IN], ["Blue category"]]
+
+CONNECT_CFG = {"checkin_grace_min": 15, "checkout_grace_min": 15, "ignore_after_min": 75}
+CHECK_CFG = {"grace_min": 15, "ignore_after_min": 75}
+
+def fmt(d):
+    return d.strftime("%Y-%m-%dT%H:%M:%S.0000000")
+
+def make_events(count, now, seed=1):
+    """
+    Builds a synthetic calendarView payload of count events around now.
+
+    Events start on 15 minute slots within now +/- 75 minutes, last 30 to 120
+    minutes, and have one to five attendees drawn from a pool of workers plus
+    the shared mailbox, as real appointments do.
+    """
+    rng = random.Random(seed)
+    base = now.replace(second=0, microsecond=0) - timedelta(minutes=now.minute % 15)
+    events = []
+    for i in range(count):
+        start = base + timedelta(minutes=15 * rng.randint(-5, 5))
+        end = start + timedelta(minutes=rng.choice([30, 45, 60, 90, 120]))
+        attendees = [{"emailAddress": {"address": "Shared.Mailbox@example.com", "name": "Shared Mailbox"},
+                      "type": "required"}]
+        for worker in rng.sample(range(WORKER_COUNT), rng.randint(1, 4)):
+            attendees.append({"emailAddress": {"address": f"Worker.{worker}@Example.com", "name": f"Worker {worker}"},
+                              "type": "required"})
+        events.append({
+            "id": f"AAMkAGI2event{i:07d}",
+            "subject": f"Visit {i}",
+            "categories": list(rng.choice(CATEGORY_CHOICES)),
+            "attendees": attendees,
+            "bodyPreview": "Client visit. Door code 1234.",
+            "body": {"contentType": "html", "content": "<html><body>Client visit.</body></html>"},
+            "start": {"dateTime": fmt(start), "timeZone": "Etc/GMT"},
+            "end": {"dateTime": fmt(end), "timeZone": "Etc/GMT"},
+        })
+    return events
+
+def time_it(func, repeat, setup=None):
+    """
+    Runs func repeat times, returning timings in seconds. setup, if given, is called
+    before each run (outside the timing) and its result passed to func.
+    """
+    timings = []
+    for _ in range(repeat):
+        arg = setup() if setup else None
+        started = time.perf_counter()
+        func(arg)
+        timings.append(time.perf_counter() - started)
+    return timings
+
+def stub_manager(app_cfg, events):
+    manager = MagicMock()
+    manager.get_app_cfg.return_value = app_cfg
+    calendar_window = utils.CalendarWindow(None, None, events)
+
+    def get_calendar_events(time_filters, now=None, attendees=None, select=None):
+        appointments = events if attendees is None else calendar_window.attendee_events(attendees)
+        return utils.filter_events(appointments, time_filters, now)
+
+    manager.get_calendar_events.side_effect = get_calendar_events
+    return manager
+
+def run(sizes, repeat):
+    """
+    Runs every benchmark at every size, returning a list of result dicts.
+    """
+    now = datetime.now(dt.timezone.utc)
+    results = []
+    checkin_filters = [
+        utils.TimeFilter(minutes=-15, before_or_after=utils.AFTER, start_or_end=utils.START),
+        utils.TimeFilter(minutes=15, before_or_after=utils.BEFORE, start_or_end=utils.START),
+        utils.TimeFilter(datetime=fmt(now + timedelta(minutes=60)), before_or_after=utils.BEFORE, start_or_end=utils.END),
+    ]
+
+    for size in sizes:
+        events = make_events(size, now)
+        strings = [e[k]["dateTime"] for e in events for k in (utils.START, utils.END)]
+        caller = [f"worker.{WORKER_COUNT // 2}@example.com"]
+
+        def parse_cold(_):
+            utils.parse_graph_datetime.cache_clear()
+            for value in strings:
+                utils.parse_graph_datetime(value)
+
+        def parse_warm(_):
+            for value in strings:
+                utils.parse_graph_datetime(value)
+
+        def match_each(_):
+            for event in events:
+                utils.event_matches_time_filters(event, checkin_filters, now)
+
+        def filter_all(_):
+            utils.filter_events(events, checkin_filters, now)
+
+        def connect_get_calendar(_):
+            connect.get_calendar(stub_manager(CONNECT_CFG, events), connect.KEY_EMERGENCY, caller, now=now)
+
+        def check_classify(appointments):
+            manager = MagicMock()
+            check.process_appointments(manager, appointments, checkin=True)
+
+        benchmarks = [
+            ("parse_graph_datetime_cold", parse_cold, None),
+            ("parse_graph_datetime_warm", parse_warm, None),
+            ("event_matches_time_filters", match_each, None),
+            ("filter_events", filter_all, None),
+            ("connect_get_calendar", connect_get_calendar, None),
+            ("check_process_appointments", check_classify, lambda: copy.deepcopy(events)),
+        ]
+        for name, func, setup in benchmarks:
+            timings = time_it(func, repeat, setup)
+            result = {
+                "benchmark": name,
+                "events": size,
+                "min_sec": min(timings),
+                "median_sec": statistics.median(timings),
+                "repeat": repeat,
+            }
+            print(f"{name:32s} {size:>7d} events  min {result['min_sec'] * 1000:10.2f} ms"
+                  f"  median {result['median_sec'] * 1000:10.2f} ms")
+            results.append(result)
+    return results
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=HERE, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+def compare(results, baseline_path):
+    """
+    Prints the change in median time against an earlier results file.
+    """
+    with open(baseline_path, 'r') as f:
+        baseline = json.load(f)
+    previous = {(r["benchmark"], r["events"]): r for r in baseline["results"]}
+    print(f"\nComparison with {baseline_path} (commit {baseline.get('commit')})")
+    for result in results:
+        old = previous.get((result["benchmark"], result["events"]))
+        if old is None or old["median_sec"] == 0:
+            continue
+        change = (result["median_sec"] - old["median_sec"]) / old["median_sec"] * 100
+        print(f"{result['benchmark']:32s} {result['events']:>7d} events  {change:+7.1f}%")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark calendar filtering and matching")
+    parser.add_argument("--sizes", default=",".join(str(s) for s in DEFAULT_SIZES),
+                        help="Comma separated event counts")
+    parser.add_argument("--repeat", type=int, default=5, help="Runs per benchmark")
+    parser.add_argument("--output", help="Results file (default results/<commit>.json)")
+    parser.add_argument("--compare", help="Earlier results file to compare against")
+    args = parser.parse_args()
+
+    # The benchmarked code logs every event at INFO level, which would dominate the timings.
+    logging.disable(logging.WARNING)
+
+    sizes = [int(s) for s in args.sizes.split(",")]
+    results = run(sizes, args.repeat)
+
+    commit = git_commit()
+    output = args.output or os.path.join(HERE, "results", f"{commit}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump({"commit": commit,
+                   "python": sys.version.split()[0],
+                   "timestamp": datetime.now(dt.timezone.utc).isoformat(),
+                   "results": results}, f, indent=4)
+    print(f"Results written to {output}")
+
+    if args.compare:
+        compare(results, args.compare)
+
+if __name__ == '__main__':
+    main()
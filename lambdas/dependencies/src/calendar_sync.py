@@ -0,0 +1,196 @@
+"""
+Module keeping a copy of the calendar's events up to date with calendarView delta
+queries, shared by the Check sweeps and the change notification handler.
+
+The copy (the sweep state) is a JSON-serialisable dict, kept in a state store between
+invocations. Check sweeps look at the events in it whose grace periods ran out since
+the previous sweep; the notification handler keeps it up to date as the calendar
+changes, so that those sweeps need not ask Graph unless something is due.
+"""
+from datetime import datetime, timedelta
+import logging
+
+import loneworker_utils as utils
+
+logger = logging.getLogger(__name__)
+# Do not make the log level DEBUG or it explodes
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s.%(msecs)03d - %(levelname)s - %(message)s',
+                    datefmt='%Y-%m-%d %H:%M:%S')
+
+# The state follows changes to the calendar from ignore_after_min before it was started
+# until this many hours after, and is then started again with a full read.
+SYNC_HORIZON_HOURS = 24
+
+# Fields of each event kept in the state. The etag makes updates conditional on the
+# event not having changed since.
+SWEEP_EVENT_FIELDS = utils.SELECT_CHECK + ("@odata.etag",)
+
+# Times a Check or Notify run tries to save the sweep state when other runs keep saving
+# it first (see state_store.update).
+STATE_SAVE_ATTEMPTS = 3
+
+def state_key(username):
+    """
+    Returns the store key of the sweep state for a calendar.
+
+    Args:
+        username (str): The mailbox owning the calendar
+    """
+    return f"sweep-{username}"
+
+def sync_calendar(manager, state, now, ignore_after_min):
+    """
+    Brings the sweep state up to date with the calendar.
+
+    Args:
+        manager (LoneWorkerManager): Manager instance for handling API calls
+        state (dict): Sweep state from the previous sync, or None
+        now (datetime): The time of this sync
+        ignore_after_min (int): How long after its start or end an event stops being of
+            interest to a sweep (check.ignore_after_min)
+
+    Returns:
+        tuple: (state, changed_ids) where:
+            - state (dict): The updated sweep state, with:
+                - delta_link: The calendarView delta link to use next time
+                - window_start, window_end: The (ISO format) window the delta link follows
+                - last_sweep: The (ISO format) time of the previous sweep, or None
+                - events: Events in the window by ID, holding only SWEEP_EVENT_FIELDS
+                - changed_ids: IDs of the events added or changed since the previous sweep
+            - changed_ids (set): As held in the state; these include changes found by
+              syncs made since the previous sweep (e.g. by the notification handler)
+
+    The state is started again with a full read of the window if there is none, if the
+    window no longer covers the events a sweep must look at, or if Graph no longer
+    accepts the delta link. last_sweep is left for the sweep to set.
+    """
+    oldest_needed = now - timedelta(minutes=ignore_after_min)
+
+    changed = None
+    if state is not None:
+        if (datetime.fromisoformat(state["window_start"]) <= oldest_needed and
+                now < datetime.fromisoformat(state["window_end"])):
+            try:
+                changed, removed_ids, delta_link = manager.get_calendar_delta(delta_link=state["delta_link"])
+            except utils.DeltaLinkExpired:
+                logger.info("Sweep state delta link expired - starting again")
+        else:
+            logger.info("Sweep state window no longer covers the sweep - starting again")
+
+    if changed is None:
+        window_start = oldest_needed - utils.WINDOW_MARGIN
+        window_end = now + timedelta(hours=SYNC_HORIZON_HOURS)
+        changed, removed_ids, delta_link = manager.get_calendar_delta(window_start=window_start,
+                                                                      window_end=window_end)
+        state = {
+            "window_start": window_start.isoformat(),
+            "window_end": window_end.isoformat(),
+            "last_sweep": None,
+            "events": {},
+        }
+
+    events = state["events"]
+    for event_id in removed_ids:
+        events.pop(event_id, None)
+    for event in changed:
+        events[event["id"]] = {field: event[field] for field in SWEEP_EVENT_FIELDS if field in event}
+    state["delta_link"] = delta_link
+
+    # Events that ended before the oldest time a sweep looks at can never be picked
+    # up again unless they change, in which case the delta brings them back.
+    for event_id in [event_id for event_id, event in events.items()
+                     if utils.parse_graph_datetime(event[utils.END]['dateTime']) < oldest_needed]:
+        del events[event_id]
+
+    changed_ids = set(state.get("changed_ids", [])) | {event["id"] for event in changed}
+    state["changed_ids"] = sorted(event_id for event_id in changed_ids if event_id in events)
+    return state, changed_ids
+
+def merge_sweep(manager, saved, swept, now, ignore_after_min):
+    """
+    Records a sweep in the sweep state saved by another run while the sweep was made.
+
+    Args:
+        manager (LoneWorkerManager): Manager instance for handling API calls
+        saved (dict): The sweep state as saved meanwhile, or None
+        swept (dict): The state the sweep would have saved
+        now (datetime): The time of this sync
+        ignore_after_min (int): As for sync_calendar
+
+    Returns:
+        dict: The sweep state to save
+
+    The saved state is brought up to date with a delta query, which also picks up the
+    sweep's own updates to the events it flagged. The sweep's last_sweep is kept if it is
+    the later one, and the events it left to look at again (its changed_ids) are added to
+    those changed meanwhile, so that neither run's work is lost.
+    """
+    state, _ = sync_calendar(manager, saved, now, ignore_after_min)
+    if (state["last_sweep"] is None or
+            datetime.fromisoformat(state["last_sweep"]) < datetime.fromisoformat(swept["last_sweep"])):
+        state["last_sweep"] = swept["last_sweep"]
+    state["changed_ids"] = sorted(event_id for event_id in set(state["changed_ids"]) | set(swept["changed_ids"])
+                                  if event_id in state["events"])
+    return state
+
+def due_times(event, grace):
+    """
+    Returns the times at which an event's check-in and check-out grace periods run out.
+
+    Args:
+        event (dict): Event with start and end
+        grace (timedelta): The grace period (check.grace_min)
+
+    Returns:
+        tuple: (checkin_due, checkout_due) as UTC datetimes
+    """
+    return (utils.parse_graph_datetime(event[utils.START]['dateTime']) + grace,
+            utils.parse_graph_datetime(event[utils.END]['dateTime']) + grace)
+
+def sweep_needed(state, grace, now):
+    """
+    Works out whether a sweep would find anything to look at, without asking Graph.
+
+    Args:
+        state (dict): Sweep state, kept up to date by the notification handler
+        grace (timedelta): The grace period (check.grace_min)
+        now (datetime): The time of the sweep
+
+    Returns:
+        bool: True if there is no previous sweep, if events changed since it, or if a
+            grace period ran out since it
+    """
+    if state is None or state["last_sweep"] is None or state.get("changed_ids"):
+        return True
+    last_sweep = datetime.fromisoformat(state["last_sweep"])
+    return any(last_sweep < due <= now
+               for event in state["events"].values()
+               for due in due_times(event, grace))
+
+def next_due(state, grace, now):
+    """
+    Finds the next time a grace period runs out for an appointment that may need flagging.
+
+    Args:
+        state (dict): Sweep state
+        grace (timedelta): The grace period (check.grace_min)
+        now (datetime): The current UTC time
+
+    Returns:
+        datetime: The earliest check-in or check-out due time after now, or None if there is
+            none within the state's window
+
+    Check-ins (or check-outs) already made or flagged need no run. Those not yet made are
+    included even if the copy in the state is out of date, as a sweep reads the calendar
+    again before flagging anything.
+    """
+    due = []
+    for event in state["events"].values():
+        categories = event.get("categories", [])
+        checkin_due, checkout_due = due_times(event, grace)
+        if utils.CHECKED_IN not in categories and utils.MISSED_CHECK_IN not in categories:
+            due.append(checkin_due)
+        if utils.CHECKED_OUT not in categories and utils.MISSED_CHECK_OUT not in categories:
+            due.append(checkout_due)
+    return min((time for time in due if time > now), default=None)
@@ -72,6 +72,18 @@ class LambdaConfig:
             - connect.checkin_grace_min: 15
             - connect.checkout_grace_min: 15
             - connect.ignore_after_min: 75
+            - connect.identity_ttl_min: 60
+            - connect.unknown_caller_ttl_min: 10
+            - connect.identity_cache_size: 200
+            - phone.national_prefixes: {"0": "+44"}
+            - phone.international_prefix: "00"
+            - graph.pool_size: 10
+            - graph.connect_timeout_sec: 3.05
+            - graph.read_timeout_sec: 10
+            - graph.preconnect: True
+            - graph.max_retries: 4
+            - graph.backoff_base_sec: 0.5
+            - graph.backoff_max_sec: 8
         - Ensures both email recipient lists exist by copying if one is missing
         """
         # Define the JSON schema for configuration validation
@@ -116,6 +128,69 @@ class LambdaConfig:
                         "ignore_after_min": {
                             "type": "number",
                             "minimum": 0
+                        },
+                        "identity_ttl_min": {
+                            "type": "number",
+                            "minimum": 0
+                        },
+                        "unknown_caller_ttl_min": {
+                            "type": "number",
+                            "minimum": 0
+                        },
+                        "identity_cache_size": {
+                            "type": "integer",
+                            "minimum": 1
+                        }
+                    },
+                    "additionalProperties": False
+                },
+                "phone": {
+                    "type": ["object", "null"],
+                    "properties": {
+                        "national_prefixes": {
+                            "type": "object",
+                            "propertyNames": {"pattern": "^[0-9]+$"},
+                            "additionalProperties": {
+                                "type": "string",
+                                "pattern": "^\\+[1-9][0-9]{0,2}$"
+                            }
+                        },
+                        "international_prefix": {
+                            "type": "string",
+                            "pattern": "^[0-9]+$"
+                        }
+                    },
+                    "additionalProperties": False
+                },
+                "graph": {
+                    "type": ["object", "null"],
+                    "properties": {
+                        "pool_size": {
+                            "type": "integer",
+                            "minimum": 1
+                        },
+                        "connect_timeout_sec": {
+                            "type": "number",
+                            "exclusiveMinimum": 0
+                        },
+                        "read_timeout_sec": {
+                            "type": "number",
+                            "exclusiveMinimum": 0
+                        },
+                        "preconnect": {
+                            "type": "boolean"
+                        },
+                        "max_retries": {
+                            "type": "integer",
+                            "minimum": 0
+                        },
+                        "backoff_base_sec": {
+                            "type": "number",
+                            "minimum": 0
+                        },
+                        "backoff_max_sec": {
+                            "type": "number",
+                            "minimum": 0
                         }
                     },
                     "additionalProperties": False
@@ -157,6 +232,24 @@ class LambdaConfig:
             connect = {}
             self.config["connect"] = connect
 
+        # Default the phone structure to be present but empty
+        try:
+            phone = self.config["phone"]
+            if not phone:
+                raise KeyError
+        except KeyError:
+            phone = {}
+            self.config["phone"] = phone
+
+        # Default the graph structure to be present but empty
+        try:
+            graph = self.config["graph"]
+            if not graph:
+                raise KeyError
+        except KeyError:
+            graph = {}
+            self.config["graph"] = graph
+
         if not "grace_min" in check:
             check["grace_min"] = 15
         if not "ignore_after_min" in check:
@@ -167,6 +260,30 @@ class LambdaConfig:
              connect["checkout_grace_min"] = 15
         if not "ignore_after_min" in connect:
             connect["ignore_after_min"] = 75
+        if not "identity_ttl_min" in connect:
+            connect["identity_ttl_min"] = 60
+        if not "unknown_caller_ttl_min" in connect:
+            connect["unknown_caller_ttl_min"] = 10
+        if not "identity_cache_size" in connect:
+            connect["identity_cache_size"] = 200
+        if not "national_prefixes" in phone:
+            phone["national_prefixes"] = {"0": "+44"}
+        if not "international_prefix" in phone:
+            phone["international_prefix"] = "00"
+        if not "pool_size" in graph:
+            graph["pool_size"] = 10
+        if not "connect_timeout_sec" in graph:
+            graph["connect_timeout_sec"] = 3.05
+        if not "read_timeout_sec" in graph:
+            graph["read_timeout_sec"] = 10
+        if not "preconnect" in graph:
+            graph["preconnect"] = True
+        if not "max_retries" in graph:
+            graph["max_retries"] = 4
+        if not "backoff_base_sec" in graph:
+            graph["backoff_base_sec"] = 0.5
+        if not "backoff_max_sec" in graph:
+            graph["backoff_max_sec"] = 8
 
     def get_email_recipients(self, type):
         """
@@ -195,7 +312,7 @@ class LambdaConfig:
 
         Args:
             app_name (str): Name of the application (case-insensitive)
-                Expected values are "check" or "connect"
+                Expected values are "check", "connect", "phone" or "graph"
 
         Returns:
             dict: Configuration dictionary for the specified application, containing:
@@ -206,6 +323,20 @@ class LambdaConfig:
                     - checkin_grace_min: Minutes grace period for check-ins
                     - checkout_grace_min: Minutes grace period for check-outs
                     - ignore_after_min: Minutes after which to stop checking
+                    - identity_ttl_min: Minutes for which a caller's identity is cached
+                    - unknown_caller_ttl_min: Minutes for which an unknown number is cached
+                    - identity_cache_size: Caller identities cached per container
+                For "phone" (how phone numbers are written):
+                    - national_prefixes: Country code for numbers written with each national prefix
+                    - international_prefix: Prefix written instead of "+" before a country code
+                For "graph" (settings for all Microsoft Graph traffic):
+                    - pool_size: Maximum connections kept open per host
+                    - connect_timeout_sec: Timeout for establishing a connection
+                    - read_timeout_sec: Timeout waiting for a response
+                    - preconnect: Whether to open a connection to Graph during initialisation
+                    - max_retries: Maximum retries of a throttled request
+                    - backoff_base_sec: Initial backoff when no Retry-After is given
+                    - backoff_max_sec: Maximum backoff when no Retry-After is given
 
         Raises:
             KeyError: If the specified app_name section doesn't exist in config
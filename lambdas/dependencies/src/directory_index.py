@@ -0,0 +1,216 @@
+"""
+Module keeping an index of workers' phone numbers, built from the shared mailbox's
+contacts and the directory's users, so that callers can be identified without asking
+Graph during the call.
+
+The Directory function keeps a copy of the contacts and users up to date with delta
+queries (the sync state), and publishes the index built from it to a store whenever
+it changes. Each published index has a version one higher than the last, and readers
+(the Connect function) only ever move to a newer one. Runs that find no changes mark
+the index as synced instead, so that it stays in use while the directory is quiet.
+"""
+from datetime import datetime, timedelta, timezone
+import logging
+import threading
+import time
+
+import phone_numbers
+
+logger = logging.getLogger(__name__)
+# Do not make the log level DEBUG or it explodes
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s.%(msecs)03d - %(levelname)s - %(message)s',
+                    datefmt='%Y-%m-%d %H:%M:%S')
+
+# Kinds of directory entry that map phone numbers to workers, and the fields read for each.
+CONTACTS = "contacts"
+USERS = "users"
+SELECT = {
+    CONTACTS: ("id", "displayName", "mobilePhone", "emailAddresses"),
+    USERS: ("id", "displayName", "mobilePhone", "mail"),
+}
+
+# Store keys of the published index and of the Directory function's sync state.
+INDEX_KEY = "directory-index"
+SYNC_KEY = "directory-sync"
+
+# Readers look for a newer index once theirs is this old, in the background.
+RELOAD_SEC = 300
+
+# An index not synced for this long is not used, in case the sync has stopped and
+# numbers have since moved to other workers; callers are looked up in Graph instead.
+MAX_INDEX_AGE_HOURS = 24
+
+# The display name given to numbers whose entries have none, as phone_to_email does.
+UNKNOWN_NAME = "UNKNOWN"
+
+def entry_addresses(kind, entry):
+    """
+    Returns the lower case email addresses of a contact or user.
+    """
+    if kind == CONTACTS:
+        return [address["address"].lower() for address in entry.get("emailAddresses") or []
+                if address.get("address")]
+    return [entry["mail"].lower()] if entry.get("mail") else []
+
+def build_index(state, version, now, plan=phone_numbers.DEFAULT_PLAN):
+    """
+    Builds the phone number index from the sync state.
+
+    Args:
+        state (dict): Sync state
+        version (int): Version of the index
+        now (datetime): The time it is built
+        plan (NumberPlan, optional): How numbers are written, to put them in E.164 form
+
+    Returns:
+        dict: The index, with:
+            - version: As given
+            - built_at: The (ISO format) time it was built
+            - synced_at: The (ISO format) time the directory was last read for it; see
+              mark_synced
+            - numbers: For each number in E.164 form, the addresses of every contact and
+              user with it and the display name of the last of them (users after
+              contacts, as phone_to_email gives)
+    """
+    numbers = {}
+    for kind in (CONTACTS, USERS):
+        entries = state[kind]["entries"]
+        for entry_id in sorted(entries):
+            entry = entries[entry_id]
+            if not entry.get("mobilePhone"):
+                continue
+            identity = numbers.setdefault(plan.normalise(entry["mobilePhone"]),
+                                          {"addresses": [], "display_name": UNKNOWN_NAME})
+            for address in entry_addresses(kind, entry):
+                if address not in identity["addresses"]:
+                    identity["addresses"].append(address)
+            if entry.get("displayName"):
+                identity["display_name"] = entry["displayName"]
+
+    return {"version": version, "built_at": now.isoformat(), "synced_at": now.isoformat(), "numbers": numbers}
+
+def mark_synced(index, now):
+    """
+    Records that the directory was read at now and found unchanged since the index was built.
+    """
+    index["synced_at"] = now.isoformat()
+
+def synced_at(index):
+    """
+    Returns the time the directory was last read for an index. Indexes published before
+    synced_at was recorded give the time they were built.
+    """
+    return datetime.fromisoformat(index.get("synced_at", index["built_at"]))
+
+class DirectoryIndex:
+    def __init__(self, store, reload_sec=RELOAD_SEC, max_age=timedelta(hours=MAX_INDEX_AGE_HOURS)):
+        """
+        Initializes a reader of the published phone number index.
+
+        Args:
+            store: The store the Directory function publishes to (see state_store)
+            reload_sec (int, optional): Age in seconds at which the index is reloaded
+            max_age (timedelta, optional): Time since it was last synced at which an index is
+                no longer used
+
+        The index is loaded on the first lookup; after that, newer versions are loaded
+        in a background thread while the current one stays in use.
+        """
+        self.store = store
+        self.reload_sec = reload_sec
+        self.max_age = max_age
+
+        self.index = None
+        self.loaded_at = None
+        self.lock = threading.Lock()
+        self.reload_thread = None
+
+    def lookup(self, number, now=None):
+        """
+        Looks up a number.
+
+        Args:
+            number (str): Phone number, normalised by phone_numbers
+            now (datetime, optional): The current UTC time
+
+        Returns:
+            tuple: (addresses, display_name), or None if the number is not in the index,
+                or there is no usable index
+        """
+        index = self.current()
+        if index is None:
+            return None
+        now = now or datetime.now(timezone.utc)
+        if now - synced_at(index) > self.max_age:
+            logger.warning("Directory index version %d last synced at %s is too old to use",
+                           index["version"], synced_at(index).isoformat())
+            return None
+        identity = index["numbers"].get(number)
+        if identity is None:
+            return None
+        return list(identity["addresses"]), identity["display_name"]
+
+    def current(self):
+        """
+        Returns the index, loading it first if there is none yet, or starting a reload
+        in the background if it is due.
+        """
+        with self.lock:
+            if self.loaded_at is None:
+                logger.info("Loading directory index")
+                self._reload()
+            elif time.monotonic() - self.loaded_at >= self.reload_sec:
+                self._start_background_reload()
+            return self.index
+
+    def _reload(self):
+        """
+        Loads the published index, keeping it if it is newer than the one held. Must be
+        called with the lock held.
+        """
+        self.loaded_at = time.monotonic()
+        self._keep(self._load())
+
+    def _load(self):
+        try:
+            return self.store.load(INDEX_KEY)
+        except Exception as e:
+            # Lookups carry on with the index held, or in Graph if there is none.
+            logger.warning("Failed to load directory index: %s", e)
+            return None
+
+    def _keep(self, index):
+        """
+        Keeps a loaded index if it is newer than the one held, or the same version synced
+        since. Must be called with the lock held.
+        """
+        if index is None:
+            logger.info("No directory index published yet")
+        elif (self.index is not None and index["version"] == self.index["version"]
+                and synced_at(index) > synced_at(self.index)):
+            self.index = index
+        elif self.index is None or index["version"] > self.index["version"]:
+            logger.info("Using directory index version %d of %d numbers",
+                        index["version"], len(index["numbers"]))
+            self.index = index
+
+    def _start_background_reload(self):
+        """
+        Starts a thread to reload the index unless one is already running. Must be
+        called with the lock held.
+        """
+        if self.reload_thread is not None and self.reload_thread.is_alive():
+            return
+        self.loaded_at = time.monotonic()
+        self.reload_thread = threading.Thread(target=self._background_reload, daemon=True)
+        self.reload_thread.start()
+
+    def _background_reload(self):
+        """
+        Thread body for a background reload. The load is made without the lock, so
+        lookups keep using the current index meanwhile.
+        """
+        index = self._load()
+        with self.lock:
+            self._keep(index)
@@ -0,0 +1,210 @@
+"""
+Module containing the schedulers used to run the Check function's due runs at the
+moment an appointment's grace period runs out, rather than at the next sweep.
+
+Each scheduler has schedule(when, payload), asking for the Check function to be run with
+the event payload at (or just after) the UTC datetime when.
+"""
+import boto3
+import heapq
+import json
+import logging
+import threading
+from datetime import datetime, timedelta
+import datetime as dt
+
+import calendar_sync
+
+logger = logging.getLogger(__name__)
+# Do not make the log level DEBUG or it explodes
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s.%(msecs)03d - %(levelname)s - %(message)s',
+                    datefmt='%Y-%m-%d %H:%M:%S')
+
+# Due runs are scheduled this long after the grace period runs out, so that the
+# appointment is past it whatever the rounding of the scheduler's clock.
+DUE_MARGIN = timedelta(seconds=1)
+
+# The event payload for a due run.
+DUE_PAYLOAD = {"mode": "due"}
+
+class InProcessScheduler:
+    def __init__(self, callback):
+        """
+        Initializes a scheduler that runs the due runs itself, from a background thread.
+
+        Args:
+            callback (callable): Called with the payload when a run is due
+
+        This is for local runs and testing; on Lambda, a container is frozen between
+        invocations, so runs would only happen while it is handling one.
+        """
+        self.callback = callback
+        self.pending = []
+        self.condition = threading.Condition()
+        self.thread = None
+        self.stopped = False
+
+    def schedule(self, when, payload):
+        """
+        Schedules a run, unless one is already scheduled for the same time.
+        """
+        entry = (when, json.dumps(payload, sort_keys=True))
+        with self.condition:
+            if entry in self.pending:
+                return
+            heapq.heappush(self.pending, entry)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+            self.condition.notify()
+
+    def run_due(self, now=None):
+        """
+        Makes the runs that are due, in time order.
+
+        Args:
+            now (datetime, optional): The current UTC time; defaults to the real time
+
+        Returns:
+            int: The number of runs made
+        """
+        now = now or datetime.now(dt.timezone.utc)
+        due = []
+        with self.condition:
+            while self.pending and self.pending[0][0] <= now:
+                due.append(heapq.heappop(self.pending))
+        for when, payload in due:
+            logger.info("Making run scheduled for %s", when.isoformat())
+            try:
+                self.callback(json.loads(payload))
+            except Exception:
+                logger.exception("Scheduled run failed")
+        return len(due)
+
+    def run(self):
+        """
+        Waits for and makes the scheduled runs until stop is called.
+        """
+        while True:
+            with self.condition:
+                if self.stopped:
+                    return
+                if self.pending:
+                    wait_sec = (self.pending[0][0] - datetime.now(dt.timezone.utc)).total_seconds()
+                else:
+                    wait_sec = None
+                if wait_sec is None or wait_sec > 0:
+                    self.condition.wait(wait_sec)
+                    continue
+            self.run_due()
+
+    def stop(self):
+        """
+        Stops the background thread, dropping any runs not yet made.
+        """
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+        if self.thread is not None:
+            self.thread.join()
+
+class EventBridgeScheduler:
+    def __init__(self, target_arn, role_arn, client=None, group="default"):
+        """
+        Initializes a scheduler creating one-off EventBridge Scheduler schedules.
+
+        Args:
+            target_arn (str): ARN of the (Check) function to run
+            role_arn (str): ARN of the role EventBridge Scheduler assumes to run it
+            client: boto3 EventBridge Scheduler client; created if not given
+            group (str, optional): Schedule group
+
+        Each schedule is named after its time, so asking twice for the same time creates
+        one schedule, and is deleted by EventBridge Scheduler once it has run.
+        """
+        self.target_arn = target_arn
+        self.role_arn = role_arn
+        self.client = client or boto3.client('scheduler')
+        self.group = group
+
+    def schedule(self, when, payload):
+        """
+        Schedules a run, unless one is already scheduled for the same time.
+        """
+        name = f"check-due-{when.strftime('%Y%m%dT%H%M%S')}"
+        logger.info("Creating schedule %s", name)
+        try:
+            self.client.create_schedule(
+                Name=name,
+                GroupName=self.group,
+                ScheduleExpression=f"at({when.strftime('%Y-%m-%dT%H:%M:%S')})",
+                ScheduleExpressionTimezone="UTC",
+                FlexibleTimeWindow={"Mode": "OFF"},
+                ActionAfterCompletion="DELETE",
+                Target={
+                    "Arn": self.target_arn,
+                    "RoleArn": self.role_arn,
+                    "Input": json.dumps(payload),
+                })
+        except self.client.exceptions.ConflictException:
+            logger.info("Schedule %s already exists", name)
+
+def make_scheduler(scheduler_type, callback=None, client=None):
+    """
+    Builds a scheduler from a scheduler type string, as set in an environment variable.
+
+    Args:
+        scheduler_type (str): One of:
+            - "" or "none": no scheduler; due runs are left to the sweeps
+            - "memory": an in-process scheduler calling callback
+            - "eventbridge:<target arn>,<role arn>": EventBridge Scheduler
+        callback (callable, optional): For an in-process scheduler, called with the payload
+        client (optional): EventBridge Scheduler client, for an "eventbridge:" scheduler
+
+    Returns:
+        The scheduler, or None for no scheduler
+
+    Raises:
+        ValueError: If the scheduler type is not recognised
+    """
+    if not scheduler_type or scheduler_type == "none":
+        return None
+    if scheduler_type == "memory" and callback is not None:
+        return InProcessScheduler(callback)
+    if scheduler_type.startswith("eventbridge:"):
+        target_arn, _, role_arn = scheduler_type[len("eventbridge:"):].partition(",")
+        if target_arn and role_arn:
+            return EventBridgeScheduler(target_arn, role_arn, client)
+    raise ValueError(f"Invalid scheduler type: {scheduler_type}")
+
+def schedule_next_due(scheduler, state, grace, now):
+    """
+    Schedules a due run for the next time an appointment's grace period runs out.
+
+    Args:
+        scheduler: The scheduler
+        state (dict): Sweep state (see calendar_sync.sync_calendar); its scheduled_due
+            records the run already asked for, so that it is not asked for again
+        grace (timedelta): The grace period (check.grace_min)
+        now (datetime): The current UTC time
+
+    Returns:
+        datetime: The time of the run, or None if nothing is due within the state's window
+
+    Runs asked for earlier and no longer needed (for instance, because the appointment
+    moved) are left to happen; they find nothing to do.
+    """
+    next_due = calendar_sync.next_due(state, grace, now)
+    if next_due is None:
+        logger.info("Nothing due within the sweep state window")
+        return None
+
+    when = (next_due + DUE_MARGIN).replace(microsecond=0)
+    if state.get("scheduled_due") == when.isoformat():
+        logger.info("Due run at %s already scheduled", when.isoformat())
+        return when
+    logger.info("Scheduling due run at %s", when.isoformat())
+    scheduler.schedule(when, DUE_PAYLOAD)
+    state["scheduled_due"] = when.isoformat()
+    return when
@@ -0,0 +1,150 @@
+"""
+Module containing the cache of caller identities (the addresses and display name found
+for a phone number) used by the Connect function.
+
+Looking a caller up costs two Graph queries, one of them an advanced (eventual
+consistency) users query, and the same few workers call all day. Entries are held in
+a least recently used cache in the warm container, and optionally in a shared store so
+that new containers start with them. Numbers matching nobody are cached too, for a
+shorter time, so that repeated calls from unknown numbers cost nothing.
+"""
+from collections import OrderedDict
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+# Do not make the log level DEBUG or it explodes
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s.%(msecs)03d - %(levelname)s - %(message)s',
+                    datefmt='%Y-%m-%d %H:%M:%S')
+
+# Defaults for the connect section of the configuration.
+DEFAULT_TTL_MIN = 60
+DEFAULT_UNKNOWN_TTL_MIN = 10
+DEFAULT_MAX_ENTRIES = 200
+
+def store_key(number):
+    """
+    Returns the shared store key of the entry for a normalised number.
+    """
+    return f"identity-{number}"
+
+class IdentityCache:
+    def __init__(self, ttl_sec=DEFAULT_TTL_MIN * 60, unknown_ttl_sec=DEFAULT_UNKNOWN_TTL_MIN * 60,
+                 max_entries=DEFAULT_MAX_ENTRIES, store=None):
+        """
+        Initializes a cache of caller identities.
+
+        Args:
+            ttl_sec (int, optional): Seconds for which a number that was found is cached
+            unknown_ttl_sec (int, optional): Seconds for which a number matching nobody is cached
+            max_entries (int, optional): Entries held in memory, beyond which the least
+                recently used is dropped
+            store (optional): Shared store (see state_store.make_state_store), or None
+
+        Entries expire by wall clock time, so that containers sharing a store agree on
+        when they do.
+        """
+        self.ttl_sec = ttl_sec
+        self.unknown_ttl_sec = unknown_ttl_sec
+        self.max_entries = max_entries
+        self.store = store
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, number):
+        """
+        Looks up a number.
+
+        Args:
+            number (str): Phone number, normalised by phone_numbers
+
+        Returns:
+            tuple: (addresses, display_name) as cached, or None if not cached or expired
+
+        An entry found only in the shared store is added to the memory cache.
+        """
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(number)
+            if entry is not None:
+                if entry["expires_at"] > now:
+                    self.entries.move_to_end(number)
+                    return list(entry["addresses"]), entry["display_name"]
+                del self.entries[number]
+
+        entry = self._load_from_store(number)
+        if entry is None or entry.get("expires_at", 0) <= now:
+            return None
+        logger.info("Using identity of %s from shared store", number)
+        with self.lock:
+            self._remember(number, entry)
+        return list(entry["addresses"]), entry["display_name"]
+
+    def put(self, number, addresses, display_name):
+        """
+        Caches the result of looking a number up.
+
+        Args:
+            number (str): Phone number, normalised by phone_numbers
+            addresses (list): Addresses found for it, empty if none
+            display_name (str): Display name found for it
+        """
+        ttl_sec = self.ttl_sec if addresses else self.unknown_ttl_sec
+        entry = {
+            "addresses": list(addresses),
+            "display_name": display_name,
+            "expires_at": time.time() + ttl_sec,
+        }
+        with self.lock:
+            self._remember(number, entry)
+        self._save_to_store(number, entry)
+
+    def invalidate(self, number):
+        """
+        Discards the entry for a number, here and in the shared store, so that the
+        next call from it is looked up again.
+
+        Args:
+            number (str): Phone number, normalised by phone_numbers
+        """
+        with self.lock:
+            self.entries.pop(number, None)
+        # Stores cannot delete entries, so an expired one replaces it.
+        self._save_to_store(number, {"expires_at": 0})
+
+    def clear(self):
+        """
+        Discards every entry held in memory. The shared store is left alone.
+        """
+        with self.lock:
+            self.entries.clear()
+
+    def _remember(self, number, entry):
+        """
+        Adds an entry to the memory cache, dropping the least recently used beyond
+        max_entries. Must be called with the lock held.
+        """
+        self.entries[number] = entry
+        self.entries.move_to_end(number)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def _load_from_store(self, number):
+        if self.store is None:
+            return None
+        try:
+            return self.store.load(store_key(number))
+        except Exception as e:
+            # The store is only an optimisation; look the number up instead.
+            logger.warning("Failed to read identity from shared store: %s", e)
+            return None
+
+    def _save_to_store(self, number, entry):
+        if self.store is None:
+            return
+        try:
+            self.store.save(store_key(number), entry)
+        except Exception as e:
+            logger.warning("Failed to save identity to shared store: %s", e)
@@ -4,16 +4,29 @@ Module containing common utility functions for the loneworker lambda functions.
 # General
 import boto3
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 import datetime as dt
+from email.utils import parsedate_to_datetime
+from functools import lru_cache
 import json
 import logging
 import os
+import random
 import requests
+from requests.adapters import HTTPAdapter
+import threading
+import time
 from collections import defaultdict
 
 # Our own modules.
 import cfg_parser
+import directory_index
+import identity_cache
+import metrics_backend
+import phone_numbers
+import state_store
+import token_cache
 
 logger = logging.getLogger(__name__)
 # Do not make the log level DEBUG or it explodes
@@ -44,42 +57,242 @@ MISSED_CHECK_IN = "Missed-Check-In"
 MISSED_CHECK_OUT = "Missed-Check-Out"
 EMERGENCY = "Emergency"
 
+# How long (in seconds) a warm container keeps using configuration read from the
+# Parameter Store before reading it again. Overridden by the config_ttl_sec
+# environment variable.
+DEFAULT_CONFIG_TTL_SEC = 300
+
+# Used to open a connection to Graph before it is first needed.
+GRAPH_ROOT_URL = "https://graph.microsoft.com/v1.0/"
+
+# HTTP statuses that Graph and Entra use for throttling or transient unavailability,
+# which are retried with backoff.
+RETRY_STATUSES = (429, 503, 504)
+
+# Status Graph gives a request whose token it does not accept. The token is discarded and
+# the request made once more with a new one.
+STATUS_UNAUTHORIZED = 401
+
+# The statuses retried for a request that must not be repeated, such as sending mail. A
+# 503 or 504 may come back for a request that Graph went on to carry out, so only a
+# throttled request, which Graph has refused, is retried.
+THROTTLE_STATUSES = (429,)
+
+# Graph JSON batching: up to MAX_BATCH_REQUESTS requests are sent in one POST.
+GRAPH_BATCH_URL = "https://graph.microsoft.com/v1.0/$batch"
+MAX_BATCH_REQUESTS = 20
+
+# Status Graph gives a batched request that was not run because one it depends on failed.
+STATUS_FAILED_DEPENDENCY = 424
+
+# A retry is not attempted unless at least this many seconds of the invocation would be
+# left after the backoff, so that the handler still has time to respond.
+RETRY_TIME_RESERVE_SEC = 2
+
+# Time held back from HTTP timeouts so that the handler can still respond (and emit
+# metrics) after a call times out.
+DEADLINE_RESERVE_SEC = 1
+
+# HTTP timeouts are never set below this, even when the deadline is very close.
+MIN_HTTP_TIMEOUT_SEC = 0.1
+
+# Metrics reported by the manager itself, in addition to those supplied by the lambda.
+METRIC_GRAPH_RETRIES = "GraphRetries"
+METRIC_GRAPH_BACKOFF_MS = "GraphRetryBackoffMs"
+METRIC_CALENDAR_CONFLICTS = "CalendarConflicts"
+MANAGER_METRICS = [METRIC_GRAPH_RETRIES, METRIC_GRAPH_BACKOFF_MS, METRIC_CALENDAR_CONFLICTS]
+
+# Reported by phone_to_email for callers found in the directory index or the identity
+# cache. Only Connect looks callers up, so these are not MANAGER_METRICS.
+METRIC_DIRECTORY_INDEX_HITS = "DirectoryIndexHits"
+METRIC_IDENTITY_CACHE_HITS = "IdentityCacheHits"
+
+# Operation under which Graph and Entra calls are timed when the caller names none.
+DEFAULT_OPERATION = "Graph"
+
+# Status Graph gives a conditional (If-Match) update to an event that has changed since it was read.
+STATUS_PRECONDITION_FAILED = 412
+
+# An update that keeps conflicting with other changes to the event is given up after this many merges.
+MAX_CONFLICT_RETRIES = 3
+
+# Managers cached across warm invocations of the same container, keyed by app_type.
+_managers = {}
+
+# Metrics may be counted by calls made from several threads (e.g. retries of the
+# concurrent phone number queries).
+_metrics_lock = threading.Lock()
+
+class DeadlineExceeded(RuntimeError):
+    """
+    Raised when there is no time left in the invocation to make a call.
+    """
+    pass
+
+class DeltaLinkExpired(RuntimeError):
+    """
+    Raised when Graph no longer accepts a delta link, so a full read is needed.
+    """
+
+class Deadline:
+    def __init__(self, context=None, budget_sec=None, reserve_sec=DEADLINE_RESERVE_SEC):
+        """
+        Initializes a deadline for the current invocation.
+
+        Args:
+            context (LambdaContext, optional): The invocation's Lambda context. The deadline is
+                the time at which the Lambda would time out.
+            budget_sec (float, optional): A tighter limit in seconds from now, for callers (such as
+                Amazon Connect) that give up waiting before the Lambda would time out
+            reserve_sec (float, optional): Time held back from call timeouts for the handler to respond
+
+        With neither context nor budget, the deadline is unbounded.
+        """
+        self.reserve_sec = reserve_sec
+        limits = []
+        if context is not None:
+            limits.append(context.get_remaining_time_in_millis() / 1000)
+        if budget_sec is not None:
+            limits.append(budget_sec)
+        self.expires = time.monotonic() + min(limits) if limits else None
+
+    def remaining_sec(self):
+        """
+        Returns the seconds left before the deadline, or None if it is unbounded.
+        """
+        if self.expires is None:
+            return None
+        return self.expires - time.monotonic()
+
+    def has_time(self, needed_sec):
+        """
+        Returns True if at least needed_sec seconds (plus the reserve) remain.
+        """
+        remaining = self.remaining_sec()
+        return remaining is None or remaining - self.reserve_sec >= needed_sec
+
+    def timeout(self, connect_timeout_sec, read_timeout_sec):
+        """
+        Returns a (connect, read) timeout tuple for an HTTP call, limited by the time remaining.
+
+        Args:
+            connect_timeout_sec (float): Configured connect timeout
+            read_timeout_sec (float): Configured read timeout
+
+        Raises:
+            DeadlineExceeded: If there is no time left for the call
+        """
+        remaining = self.remaining_sec()
+        if remaining is None:
+            return (connect_timeout_sec, read_timeout_sec)
+        available = remaining - self.reserve_sec
+        if available < MIN_HTTP_TIMEOUT_SEC:
+            raise DeadlineExceeded(f"No time left for call: {remaining:.2f} seconds remaining")
+        return (min(connect_timeout_sec, available), min(read_timeout_sec, available))
+
+def get_manager(app_type, metric_names=[], deadline=None):
+    """
+    Returns a LoneWorkerManager for the app type, reusing one cached by an earlier
+    invocation of the same (warm) Lambda container where possible.
+
+    Args:
+        app_type (str): Type of application, one of 'Check', 'Connect', 'Notify' or 'Directory'
+        metric_names (list, optional): List of metric names to initialize with zero values
+        deadline (Deadline, optional): The invocation's deadline, used to bound calls and retries
+
+    Returns:
+        LoneWorkerManager: A manager ready for this invocation.
+
+    A newly created manager reads configuration, builds its AWS clients and gets a
+    token. A reused manager has its metrics reset, re-reads configuration only when
+    it is older than the configured TTL, and takes its token from the token cache.
+    """
+    manager = _managers.get(app_type)
+    if manager is None:
+        logger.info("No cached manager for app %s - creating one", app_type)
+        manager = LoneWorkerManager(app_type, metric_names, deadline)
+        _managers[app_type] = manager
+    else:
+        logger.info("Reusing cached manager for app %s", app_type)
+        manager.start_invocation(metric_names, deadline)
+    return manager
+
+def clear_managers():
+    """
+    Discards all cached managers, so the next get_manager call builds a new one.
+    """
+    _managers.clear()
+
 class LoneWorkerManager:
-    def __init__(self, app_type, metric_names=[]):
+    def __init__(self, app_type, metric_names=[], deadline=None):
         """
         Initializes a LoneWorkerManager instance for handling lone worker operations.
 
         Args:
-            app_type (str): Type of application, must be either 'Check' or 'Connect'
+            app_type (str): Type of application, one of 'Check', 'Connect', 'Notify' or 'Directory'
             metric_names (list, optional): List of metric names to initialize with zero values
+            deadline (Deadline, optional): The invocation's deadline, used to bound calls and retries
 
         Raises:
-            AssertionError: If app_type is not 'Check' or 'Connect'
+            AssertionError: If app_type is not 'Check', 'Connect', 'Notify' or 'Directory'
 
         The manager:
+        - Creates the AWS clients it needs, timing every call made through them
         - Reads configuration from AWS Parameter Store
-        - Initializes metrics tracking
+        - Creates a pooled HTTP session, optionally opening a connection to Graph
+        - Initializes metrics tracking, and the backend through which they are reported
+        - Times every outbound call, by operation (see record_operation)
         - Obtains Microsoft Graph API authentication token
         - Sets up API endpoints for calendar, mail, contacts, and users
         """
         logger.info("Get configuration for app %s", app_type)
-        assert app_type in ("Check", "Connect"), "app_type must be either 'Check' or 'Connect'"
+        assert app_type in ("Check", "Connect", "Notify", "Directory"), "app_type must be one of 'Check', 'Connect', 'Notify' or 'Directory'"
         self.app_type = app_type
+        self.deadline = deadline or Deadline()
+        self.app_prefix = os.environ['ssm_prefix']
+        self.config_ttl_sec = int(os.environ.get('config_ttl_sec', DEFAULT_CONFIG_TTL_SEC))
+
+        # Calls are timed from the start, so that the cold start's reads are included.
+        self.reset_operations()
+        self.timings_to_emit = {}
+
+        # Clients are created once and reused by every invocation in this container.
+        self.ssm = self.instrument_client(boto3.client('ssm'))
+        self.s3 = self.instrument_client(boto3.client('s3'))
+
         self.read_config()
 
+        # The session keeps connections alive, so calls in this and later (warm)
+        # invocations do not each pay for a TCP and TLS handshake.
+        graph_cfg = self.cfg.get_app_cfg("graph")
+        self.session = create_session(graph_cfg["pool_size"])
+        if graph_cfg["preconnect"]:
+            self.preconnect()
+
         logger.info("Initialise metrics structures")
         self.init_metrics(metric_names)
+        # The metrics_backend environment variable selects how metrics are reported;
+        # only the (default) cloudwatch backend needs a CloudWatch client.
+        self.metrics_backend = metrics_backend.make_metrics_backend(
+            os.environ.get('metrics_backend', metrics_backend.CLOUDWATCH), self.metrics_namespace)
+        if isinstance(self.metrics_backend, metrics_backend.CloudWatchBackend):
+            self.instrument_client(self.metrics_backend.client)
+
+        # Calendar windows read in this invocation.
+        self.calendar_windows = []
+        self.pending_patches = []
+        self.pending_merges = {}
 
         logger.info("Get auth token")
+        self.token = None
+        self.token_provider = None
         self.get_token()
 
+        # Created on first use, and kept for the life of the container.
+        self.identity_cache = None
+        self.directory_index = None
+
         # A couple of things it will be useful to work out in advance
-        # Note that we use GMT for all times, to try to avoid timezone confusion.
-        self.headers = {
-            'Authorization': 'Bearer ' + self.token,
-            'Content-Type': 'application/json',
-            'Prefer': 'outlook.timezone="Etc/GMT"'
-        }
         self.calendar_url = f"https://graph.microsoft.com/v1.0/users/{self.username}/calendar/events"
         # /calendarView expands recurring series server-side: each occurrence in the
         # window comes back as its own event with an independently PATCH-able id.
@@ -88,6 +301,157 @@ class LoneWorkerManager:
         self.mail_url = f"https://graph.microsoft.com/v1.0/users/{self.username}/sendMail"
         self.contacts_url = f"https://graph.microsoft.com/v1.0/users/{self.username}/contacts"
         self.users_url = f"https://graph.microsoft.com/v1.0/users"
+        self.subscriptions_url = "https://graph.microsoft.com/v1.0/subscriptions"
+
+    def preconnect(self):
+        """
+        Opens a connection to Microsoft Graph ahead of the first real call.
+
+        The request is unauthenticated and its response is ignored; the point is to
+        leave an established connection in the session's pool. Failures are logged
+        and otherwise ignored, as the real call will simply open its own connection.
+        """
+        logger.info("Opening connection to Graph")
+        try:
+            self.session.head(GRAPH_ROOT_URL, timeout=self.http_timeout())
+        except (requests.RequestException, DeadlineExceeded) as e:
+            logger.warning("Failed to open connection to Graph: %s", e)
+
+    def http_timeout(self):
+        """
+        Returns the (connect, read) timeout tuple for HTTP calls, from the graph configuration,
+        cut down if necessary so that the call ends before the invocation's deadline.
+
+        Raises:
+            DeadlineExceeded: If there is no time left for a call
+        """
+        graph_cfg = self.cfg.get_app_cfg("graph")
+        return self.deadline.timeout(graph_cfg["connect_timeout_sec"], graph_cfg["read_timeout_sec"])
+
+    def graph_request(self, method, url, operation=DEFAULT_OPERATION, retry_statuses=RETRY_STATUSES, **kwargs):
+        """
+        Sends an HTTP request through the session, retrying throttled requests.
+
+        Args:
+            method (str): HTTP method, such as "GET"
+            url (str): URL to call
+            operation (str, optional): Name under which the request is timed, such as "Users"
+            retry_statuses (tuple, optional): Statuses that are retried; THROTTLE_STATUSES for a
+                request that must not be repeated
+            **kwargs: Further arguments for requests (headers, params, json, data)
+
+        Returns:
+            requests.Response: The final response. Callers check the status as before; a
+                response still throttled after all retries is returned rather than raised.
+
+        The function:
+        - Retries responses with a status in retry_statuses, up to graph.max_retries times
+        - Waits for the Retry-After time if the response gives one, otherwise backs off
+          exponentially from graph.backoff_base_sec with full jitter, capped at graph.backoff_max_sec
+        - Gives up early if the wait would leave less than RETRY_TIME_RESERVE_SEC before
+          the invocation's deadline
+        - Limits each attempt's timeout to the time left before the deadline
+        - Records each attempt's latency, bytes received and status under operation
+          (status 0 for an attempt that gets no response)
+        - Counts retries and total backoff time in the GraphRetries and GraphRetryBackoffMs metrics
+        - If Graph rejects the token (status 401), discards it from the token cache (and
+          so from the shared store), gets a new one and makes the request once more
+
+        Raises:
+            DeadlineExceeded: If there is no time left to make the request
+        """
+        graph_cfg = self.cfg.get_app_cfg("graph")
+        attempt = 0
+        reauthorized = False
+        while True:
+            timeout = self.http_timeout()
+            started = time.perf_counter()
+            try:
+                response = self.session.request(method, url, timeout=timeout, **kwargs)
+            except requests.RequestException:
+                self.record_operation(operation, time.perf_counter() - started, 0, 0)
+                raise
+            self.record_operation(operation, time.perf_counter() - started, len(response.content or b""),
+                                  response.status_code)
+            if (response.status_code == STATUS_UNAUTHORIZED and not reauthorized
+                    and self.token_provider is not None and 'Authorization' in kwargs.get('headers', {})):
+                logger.warning("%s %s returned status 401 - getting a new token and retrying", method, url)
+                self.token_provider.invalidate()
+                self.get_token()
+                kwargs['headers'] = {**kwargs['headers'], 'Authorization': self.headers['Authorization']}
+                reauthorized = True
+                continue
+            if response.status_code not in retry_statuses or attempt >= graph_cfg["max_retries"]:
+                return response
+
+            if not self.wait_to_retry(attempt, retry_after_sec(response),
+                                      f"{method} {url} returned status {response.status_code}"):
+                return response
+            attempt += 1
+
+    def wait_to_retry(self, attempt, delay, description):
+        """
+        Waits before retrying a throttled request, if there is time to.
+
+        Args:
+            attempt (int): Number of retries already made
+            delay (float): Seconds to wait, from Retry-After, or None to back off
+                exponentially from graph.backoff_base_sec with full jitter, capped at graph.backoff_max_sec
+            description (str): What was throttled, for the log
+
+        Returns:
+            bool: True once the wait is over, or False (without waiting) if the wait would leave
+                less than RETRY_TIME_RESERVE_SEC before the invocation's deadline
+
+        Counts the retry and the time waited in the GraphRetries and GraphRetryBackoffMs metrics.
+        """
+        if delay is None:
+            graph_cfg = self.cfg.get_app_cfg("graph")
+            delay = random.uniform(0, min(graph_cfg["backoff_max_sec"],
+                                          graph_cfg["backoff_base_sec"] * (2 ** attempt)))
+
+        remaining = self.deadline.remaining_sec()
+        if remaining is not None and remaining - delay < RETRY_TIME_RESERVE_SEC:
+            logger.warning("Not retrying: %s - wait of %.2f seconds exceeds remaining time %.2f",
+                           description, delay, remaining)
+            return False
+
+        logger.warning("%s - retry %d after %.2f seconds", description, attempt + 1, delay)
+        self.increment_counter(METRIC_GRAPH_RETRIES)
+        self.increment_counter(METRIC_GRAPH_BACKOFF_MS, int(delay * 1000))
+        time.sleep(delay)
+        return True
+
+    def start_invocation(self, metric_names=[], deadline=None):
+        """
+        Prepares a manager cached from an earlier invocation for reuse.
+
+        Args:
+            metric_names (list, optional): List of metric names to initialize with zero values
+            deadline (Deadline, optional): The invocation's deadline, used to bound calls and retries
+
+        The function:
+        - Re-reads configuration if it is older than config_ttl_sec
+        - Resets metrics, operation timings and cached calendar windows, so nothing is carried
+          over from the last invocation
+        - Gets the token from the token cache (discarding the cache if the credentials changed)
+        """
+        self.deadline = deadline or Deadline()
+        self.reset_operations()
+        config_age = time.monotonic() - self.config_read_time
+        if config_age >= self.config_ttl_sec:
+            logger.info("Configuration is %d seconds old - reading it again", config_age)
+            old_credentials = (self.tenant, self.client_id, self.client_secret)
+            self.read_config()
+            if old_credentials != (self.tenant, self.client_id, self.client_secret):
+                logger.info("Credentials changed - discarding cached token")
+                self.token_provider = None
+
+        self.init_metrics(metric_names)
+        self.calendar_windows = []
+        self.pending_patches = []
+        self.pending_merges = {}
+        self.get_token()
 
     def read_config(self):
         """
@@ -106,14 +470,12 @@ class LoneWorkerManager:
         logger.info("Reading configuration from %s", self.app_prefix)
 
         # Read configuration from the environment
-        ssm = boto3.client('ssm')
-        self.app_prefix = os.environ['ssm_prefix']
         mand_names = ["clientid", "emailuser", "tenant", "config", "clientsecret"]
         # clientsecretexpiry is optional so existing deployments continue to start
         # while the operator adds the new parameter; a missing value is handled the
         # same way as an unparseable one (CheckFunction reports days=1000 → invalid alarm).
         optional_names = ["clientsecretexpiry"]
-        values = get_params(ssm, self.app_prefix, mand_names=mand_names, optional_names=optional_names)
+        values = get_params(self.ssm, self.app_prefix, mand_names=mand_names, optional_names=optional_names)
 
         self.client_id = values["clientid"]
         self.client_secret = values["clientsecret"]
@@ -127,6 +489,8 @@ class LoneWorkerManager:
         # More config in the config blob.
         logger.info("Validate and save configuration")
         self.cfg = cfg_parser.LambdaConfig(data=values["config"])
+        self.number_plan = phone_numbers.NumberPlan.from_config(self.cfg.get_app_cfg("phone"))
+        self.config_read_time = time.monotonic()
 
     def get_app_cfg(self):
         """
@@ -140,12 +504,46 @@ class LoneWorkerManager:
 
     def get_token(self):
         """
-        Obtains an authentication token from Microsoft Graph API.
+        Obtains an authentication token for the Microsoft Graph API.
+
+        The function:
+        - Takes the token from the token cache, which only requests a new one when
+          the cached token is close to expiry
+        - Creates the token cache on first use, with the shared store selected by the
+          token_store environment variable
+        - Builds the headers used for Graph API calls when the token changes
+
+        Raises:
+            RuntimeError: If authentication fails with status code and error message
+        """
+        if self.token_provider is None:
+            store = token_cache.make_token_store(os.environ.get('token_store', ''), self.ssm, self.app_prefix)
+            self.token_provider = token_cache.TokenProvider(self.request_token,
+                                                            key=f"{self.tenant}-{self.client_id}",
+                                                            store=store)
+
+        token = self.token_provider.get_token()
+        if token == self.token:
+            return
+
+        self.token = token
+        # Note that we use GMT for all times, to try to avoid timezone confusion.
+        self.headers = {
+            'Authorization': 'Bearer ' + self.token,
+            'Content-Type': 'application/json',
+            'Prefer': 'outlook.timezone="Etc/GMT"'
+        }
+
+    def request_token(self):
+        """
+        Requests a new authentication token from Microsoft Graph API.
 
         The function:
         - Uses client credentials flow for authentication
         - Requests token from Microsoft OAuth endpoint
-        - Stores token in instance for API calls
+
+        Returns:
+            tuple: (access_token, expires_in) where expires_in is the token lifetime in seconds
 
         Raises:
             RuntimeError: If authentication fails with status code and error message
@@ -167,30 +565,35 @@ class LoneWorkerManager:
         payload['scope'] = 'https://graph.microsoft.com/.default'
 
         # Send the token request
-        response = requests.post(auth_endpoint, data=payload)
+        response = self.graph_request("POST", auth_endpoint, operation="Token", data=payload)
 
         # Check if the request was successful
         if response.status_code != 200:
             logger.error('Authentication failed: %d, message: %s', response.status_code, response.text)
             raise RuntimeError(f"Authentication failed: {response.status_code}, message: {response.text}")
 
-        # Get the access token from the response, and store it. We also build some useful headers here.
-        access_token = response.json()['access_token']
-        logger.info("Successful authentication")
-        self.token = access_token
+        # expires_in is the lifetime in seconds; Entra issues 3599 by default.
+        token_data = response.json()
+        logger.info("Successful authentication - token expires in %s seconds", token_data.get('expires_in'))
+        return token_data['access_token'], int(token_data.get('expires_in', 3599))
 
-    def get_calendar_events(self, time_filters):
+    def get_calendar_events(self, time_filters, now=None, attendees=None, select=None):
         """
-        Retrieves calendar events overlapping a wide window centred on now and
-        matching the supplied TimeFilter constraints.
+        Retrieves calendar events matching the supplied TimeFilter constraints.
 
         Args:
             time_filters (list[TimeFilter]): constraints on event start/end
-                relative to the current time. Applied client-side after the
-                Graph query.
+                relative to the current time. Used to narrow the Graph query,
+                and applied client-side after it.
+            now (datetime, optional): reference time for the window and the
+                filters; defaults to the current UTC time.
+            attendees (iterable, optional): email addresses; if given, only events
+                with at least one of them as an attendee (ignoring case) are returned.
+            select (tuple, optional): event fields to read, such as SELECT_CONNECT;
+                defaults to every field.
 
         Returns:
-            list: Calendar events satisfying every supplied TimeFilter.
+            list: Calendar events satisfying every supplied TimeFilter, in calendarView order.
 
         Raises:
             RuntimeError: If the calendar API request fails
@@ -202,20 +605,110 @@ class LoneWorkerManager:
             would only return the series master at its original time, so most
             occurrences would be invisible to the query.
 
-            The window is now ± ignore_after_min, which is wide enough to
-            cover every TimeFilter the lambdas construct today. The narrower
-            constraints are then applied client-side to preserve exact
-            behaviour.
+            The window queried is the tightest one that can contain every event
+            satisfying the filters (see query_window), within now ±
+            ignore_after_min. The filters are then applied client-side to
+            preserve exact behaviour. Windows already fetched in this
+            invocation are reused (see get_calendar_window), as is the attendee
+            index built for them.
+        """
+        if now is None:
+            now = datetime.now(dt.timezone.utc)
+        window = self.query_window([time_filters], now)
+        if window is None:
+            logger.info("No event can satisfy the time filters - not reading calendar")
+            return []
+
+        calendar_window = self.find_calendar_window(*window, select=select)
+        if attendees is None:
+            appointments = calendar_window.events
+        else:
+            # Only the caller's events are looked at, however busy the calendar is.
+            appointments = calendar_window.attendee_events(attendees)
+            logger.info("Got %d appointments with a matching attendee", len(appointments))
+
+        matching = filter_events(appointments, time_filters, now)
+        logger.info("Got %d appointments after time-filter", len(matching))
+        return matching
+
+    def query_window(self, time_filter_sets, now):
+        """
+        Works out the calendarView window needed to find events matching any of
+        several sets of TimeFilters.
+
+        Args:
+            time_filter_sets (list[list[TimeFilter]]): filter sets; an event is wanted
+                if it satisfies every filter in at least one set.
+            now (datetime): reference time for relative (minutes-based) filters.
+
+        Returns:
+            tuple: (window_start, window_end) covering every set's window, limited to
+                now ± ignore_after_min, or None if no event could satisfy any set.
         """
         ignore_after_min = self.get_app_cfg()["ignore_after_min"]
-        now = datetime.now(dt.timezone.utc)
-        window_start = now - timedelta(minutes=ignore_after_min)
-        window_end = now + timedelta(minutes=ignore_after_min)
+        default_start = now - timedelta(minutes=ignore_after_min)
+        default_end = now + timedelta(minutes=ignore_after_min)
+
+        windows = [time_filter_window(time_filters, now, default_start, default_end)
+                   for time_filters in time_filter_sets]
+        windows = [w for w in windows if w is not None]
+        if not windows:
+            return None
+        return min(w[0] for w in windows), max(w[1] for w in windows)
+
+    def get_calendar_window(self, window_start, window_end, select=None):
+        """
+        Retrieves all calendar events overlapping a window, reusing an earlier
+        fetch in this invocation where one covers the window.
+
+        Args:
+            window_start (datetime): UTC start of the window
+            window_end (datetime): UTC end of the window
+            select (tuple, optional): event fields to read, such as SELECT_CHECK;
+                defaults to every field.
+
+        Returns:
+            list: Calendar events from /calendarView. If an earlier fetch covered a
+                wider window, events from that wider window are returned, so callers
+                must filter the result to the times they are interested in.
+
+        Raises:
+            RuntimeError: If the calendar API request fails
+
+        The cache is cleared at the start of each invocation, so it never returns
+        events older than the current invocation.
+        """
+        return self.find_calendar_window(window_start, window_end, select).events
+
+    def find_calendar_window(self, window_start, window_end, select=None):
+        """
+        Returns the CalendarWindow for a window, from this invocation's cache if an
+        earlier fetch covers it, otherwise by reading /calendarView.
+
+        Args:
+            window_start (datetime): UTC start of the window
+            window_end (datetime): UTC end of the window
+            select (tuple, optional): event fields to read; defaults to every field.
+                A cached window is only reused if it was read with at least these fields.
+
+        Returns:
+            CalendarWindow: The fetched window, which may be wider (in time or fields)
+                than the one requested
+
+        Raises:
+            RuntimeError: If the calendar API request fails
+        """
+        for calendar_window in self.calendar_windows:
+            if calendar_window.covers(window_start, window_end, select):
+                logger.info("Reusing %d events already read from calendarView", len(calendar_window.events))
+                return calendar_window
 
         params = {
             'startDateTime': window_start.strftime("%Y-%m-%dT%H:%M:%SZ"),
             'endDateTime': window_end.strftime("%Y-%m-%dT%H:%M:%SZ"),
         }
+        if select is not None:
+            params['$select'] = ",".join(select)
         logger.info("Reading calendarView from %s to %s",
                     params['startDateTime'], params['endDateTime'])
 
@@ -223,7 +716,8 @@ class LoneWorkerManager:
         url = self.calendar_view_url
         request_params = params
         while url is not None:
-            response = requests.get(url, headers=self.headers, params=request_params)
+            response = self.graph_request("GET", url, operation="CalendarView", headers=self.headers,
+                                          params=request_params)
             if response.status_code != 200:
                 logger.error('Calendar operation failed: %d, message: %s', response.status_code, response.text)
                 raise RuntimeError(f"Calendar operation failed: {response.status_code}, message: {response.text}")
@@ -236,12 +730,298 @@ class LoneWorkerManager:
             request_params = None
 
         logger.info("Got %d events from calendarView before client-side filtering", len(appointments))
+        calendar_window = CalendarWindow(window_start, window_end, appointments, select)
+        self.calendar_windows.append(calendar_window)
+        return calendar_window
 
-        matching = [a for a in appointments if event_matches_time_filters(a, time_filters, now)]
-        logger.info("Got %d appointments after time-filter", len(matching))
-        return matching
+    def queue_calendar_patch(self, event_id, changes, depends_on=None, etag=None, merge=None,
+                             merge_fields=("categories",)):
+        """
+        Queues an update to a calendar event, to be sent with others by send_calendar_patches.
+
+        Args:
+            event_id (str): ID of the calendar event to update
+            changes (dict): Dictionary of changes to apply to the event
+            depends_on (str, optional): ID of an earlier queued update that must succeed
+                before this one is made
+            etag, merge, merge_fields (optional): As for patch_calendar_event. A conflicting
+                update is merged and retried on its own once the batch has been sent.
+
+        Returns:
+            str: ID of the queued update, which keys its status in the send_calendar_patches result
+        """
+        request_id = str(len(self.pending_patches) + 1)
+        request = {
+            'id': request_id,
+            'method': "PATCH",
+            'url': f"/users/{self.username}/calendar/events/{event_id}",
+            'headers': {'Content-Type': "application/json"},
+            'body': changes,
+        }
+        if depends_on is not None:
+            request['dependsOn'] = [depends_on]
+        if etag is not None:
+            request['headers']['If-Match'] = etag
+        if merge is not None:
+            self.pending_merges[request_id] = (event_id, merge, merge_fields)
+        self.pending_patches.append(request)
+        return request_id
+
+    def send_calendar_patches(self):
+        """
+        Sends the calendar updates queued by queue_calendar_patch, in as few requests as possible.
 
-    def patch_calendar_event(self, event_id, changes):
+        Returns:
+            dict: The final HTTP status of each update, by the ID queue_calendar_patch returned.
+                An update that conflicted with another change to its event, and was then merged
+                and made (or found no longer to be needed), has status 200.
+
+        Raises:
+            RuntimeError: If a $batch request itself fails
+        """
+        batch_requests, self.pending_patches = self.pending_patches, []
+        merges, self.pending_merges = self.pending_merges, {}
+        if not batch_requests:
+            return {}
+        logger.info("Sending %d queued calendar updates", len(batch_requests))
+        statuses = self.send_batch(batch_requests)
+
+        for request_id, (event_id, merge, merge_fields) in merges.items():
+            if statuses.get(request_id) != STATUS_PRECONDITION_FAILED:
+                continue
+            self.increment_counter(METRIC_CALENDAR_CONFLICTS)
+            try:
+                changes, etag = self.merge_calendar_event(event_id, merge, merge_fields)
+                if changes is not None:
+                    self.patch_calendar_event(event_id, changes, etag=etag, merge=merge, merge_fields=merge_fields)
+            except RuntimeError as e:
+                logger.error("Failed to merge conflicting update to calendar event %s: %s", event_id, e)
+                continue
+            statuses[request_id] = 200
+        return statuses
+
+    def send_batch(self, batch_requests):
+        """
+        Sends requests through the Graph $batch endpoint, MAX_BATCH_REQUESTS at a time.
+
+        Args:
+            batch_requests (list): Graph batch requests (dicts with id, method, url, and
+                optionally headers, body and dependsOn). dependsOn may only name earlier requests.
+
+        Returns:
+            dict: The final HTTP status of each request, by request ID
+
+        Raises:
+            RuntimeError: If a $batch request itself fails
+
+        The function:
+        - Sends the requests in order, so a request's dependency is always in the same
+          batch or an earlier one. A dependency in an earlier batch is left out of the
+          request if it succeeded; if it failed, the request is not sent and gets status
+          424 (Failed Dependency), as Graph does within a batch.
+        - Retries throttled requests (status in RETRY_STATUSES) on their own, along with
+          requests that failed only because a throttled request they depend on did. The
+          wait is the longest Retry-After they gave, or the usual backoff (see wait_to_retry),
+          and there are up to graph.max_retries retries.
+        """
+        graph_cfg = self.cfg.get_app_cfg("graph")
+        by_id = {request['id']: request for request in batch_requests}
+        statuses = {}
+        pending = batch_requests
+        attempt = 0
+        while True:
+            # Throttled requests, mapped to (status, Retry-After seconds or None)
+            throttled = {}
+            for chunk_start in range(0, len(pending), MAX_BATCH_REQUESTS):
+                chunk = []
+                for request in pending[chunk_start:chunk_start + MAX_BATCH_REQUESTS]:
+                    dependency = request.get('dependsOn', [None])[0]
+                    if dependency in throttled:
+                        throttled[request['id']] = (STATUS_FAILED_DEPENDENCY, None)
+                    elif dependency in statuses:
+                        if 200 <= statuses[dependency] < 300:
+                            chunk.append({k: v for k, v in request.items() if k != 'dependsOn'})
+                        else:
+                            statuses[request['id']] = STATUS_FAILED_DEPENDENCY
+                    else:
+                        chunk.append(request)
+                if not chunk:
+                    continue
+
+                response = self.graph_request("POST", GRAPH_BATCH_URL, operation="Batch", headers=self.headers,
+                                              json={'requests': chunk})
+                if response.status_code != 200:
+                    logger.error('Batch operation failed: %d, message: %s', response.status_code, response.text)
+                    raise RuntimeError(f"Batch operation failed: {response.status_code}, message: {response.text}")
+
+                for item in response.json().get('responses', []):
+                    request_id = item['id']
+                    status = int(item['status'])
+                    dependency = by_id[request_id].get('dependsOn', [None])[0]
+                    if status in RETRY_STATUSES:
+                        headers = requests.structures.CaseInsensitiveDict(item.get('headers') or {})
+                        throttled[request_id] = (status, parse_retry_after(headers.get('Retry-After')))
+                    elif status == STATUS_FAILED_DEPENDENCY and dependency in throttled:
+                        throttled[request_id] = (status, None)
+                    else:
+                        statuses[request_id] = status
+                        if not 200 <= status < 300:
+                            logger.error('Batched %s %s failed: %d, message: %s', by_id[request_id]['method'],
+                                         by_id[request_id]['url'], status, item.get('body'))
+
+            if not throttled:
+                return statuses
+
+            delays = [delay for _, delay in throttled.values() if delay is not None]
+            if (attempt >= graph_cfg["max_retries"] or
+                    not self.wait_to_retry(attempt, max(delays) if delays else None,
+                                           f"{len(throttled)} batched requests throttled")):
+                statuses.update({request_id: status for request_id, (status, _) in throttled.items()})
+                return statuses
+            attempt += 1
+            pending = [request for request in pending if request['id'] in throttled]
+
+    def get_calendar_delta(self, delta_link=None, window_start=None, window_end=None):
+        """
+        Reads calendar changes from /calendarView/delta.
+
+        Args:
+            delta_link (str, optional): The delta link returned by an earlier call; changes
+                since that call are returned
+            window_start (datetime, optional): UTC start of the window, for a first call
+            window_end (datetime, optional): UTC end of the window, for a first call
+
+        Returns:
+            tuple: (events, removed_ids, delta_link) where:
+                - events (list): Events added or changed (on a first call, every event in the window)
+                - removed_ids (list): IDs of events deleted or moved out of the window
+                - delta_link (str): The link to pass to the next call
+
+        Raises:
+            DeltaLinkExpired: If Graph no longer accepts the delta link
+            RuntimeError: If the calendar API request fails
+
+        The window is fixed by the first call; the delta link only reports changes within it.
+        """
+        if delta_link is None:
+            url = f"{self.calendar_view_url}/delta"
+            request_params = {
+                'startDateTime': window_start.strftime("%Y-%m-%dT%H:%M:%SZ"),
+                'endDateTime': window_end.strftime("%Y-%m-%dT%H:%M:%SZ"),
+            }
+            logger.info("Starting calendarView delta from %s to %s",
+                        request_params['startDateTime'], request_params['endDateTime'])
+        else:
+            url = delta_link
+            request_params = None
+
+        events, removed_ids, delta_link = self.read_delta(url, request_params, "Calendar")
+        logger.info("Got %d changed and %d removed events from calendarView delta", len(events), len(removed_ids))
+        return events, removed_ids, delta_link
+
+    def get_directory_delta(self, kind, delta_link=None):
+        """
+        Reads changes to the shared mailbox's contacts or to the directory's users, from
+        their delta queries.
+
+        Args:
+            kind (str): directory_index.CONTACTS or directory_index.USERS
+            delta_link (str, optional): The delta link returned by an earlier call; changes
+                since that call are returned
+
+        Returns:
+            tuple: (items, removed_ids, delta_link) where:
+                - items (list): Contacts or users added or changed (on a first call, all
+                  of them), with the fields in directory_index.SELECT
+                - removed_ids (list): IDs of those deleted
+                - delta_link (str): The link to pass to the next call
+
+        Raises:
+            DeltaLinkExpired: If Graph no longer accepts the delta link
+            RuntimeError: If the request fails
+        """
+        if delta_link is None:
+            # The contacts are those of the mailbox's default contacts folder, as searched
+            # by lookup_phone_number.
+            url = f"{self.contacts_url if kind == directory_index.CONTACTS else self.users_url}/delta"
+            request_params = {'$select': ",".join(directory_index.SELECT[kind])}
+            logger.info("Starting %s delta", kind)
+        else:
+            url = delta_link
+            request_params = None
+
+        items, removed_ids, delta_link = self.read_delta(url, request_params, kind.capitalize())
+        logger.info("Got %d changed and %d removed %s from delta", len(items), len(removed_ids), kind)
+        return items, removed_ids, delta_link
+
+    def read_delta(self, url, request_params, description):
+        """
+        Reads every page of a delta query.
+
+        Args:
+            url (str): The delta URL for a first call, or a delta link
+            request_params (dict): Query parameters for a first call, or None
+            description (str): What is being read, for messages
+
+        Returns:
+            tuple: (items, removed_ids, delta_link) as described for get_calendar_delta
+
+        Raises:
+            DeltaLinkExpired: If Graph no longer accepts the delta link
+            RuntimeError: If a request fails
+        """
+        items = []
+        removed_ids = []
+        while True:
+            response = self.graph_request("GET", url, operation=f"{description}Delta", headers=self.headers,
+                                          params=request_params)
+            if response.status_code == 410:
+                logger.info("Delta link expired: %s", response.text)
+                raise DeltaLinkExpired(f"Delta link expired: {response.text}")
+            if response.status_code != 200:
+                logger.error('%s delta operation failed: %d, message: %s', description, response.status_code, response.text)
+                raise RuntimeError(f"{description} delta operation failed: {response.status_code}, message: {response.text}")
+
+            body = response.json()
+            for item in body.get('value', []):
+                if '@removed' in item:
+                    removed_ids.append(item['id'])
+                else:
+                    items.append(item)
+            # Pages are linked by @odata.nextLink; the last page has @odata.deltaLink instead.
+            # Both are complete URLs with all query state baked in.
+            if '@odata.nextLink' in body:
+                url = body['@odata.nextLink']
+                request_params = None
+            else:
+                break
+
+        return items, removed_ids, body['@odata.deltaLink']
+
+    def get_calendar_event(self, event_id, select):
+        """
+        Retrieves selected fields of a single calendar event.
+
+        Args:
+            event_id (str): ID of the calendar event
+            select (tuple): Fields to read (e.g. ("body",))
+
+        Returns:
+            dict: The event, containing the selected fields
+
+        Raises:
+            RuntimeError: If the calendar API request fails
+        """
+        logger.info("Reading %s for calendar event %s", ",".join(select), event_id)
+        response = self.graph_request("GET", f"{self.calendar_url}/{event_id}", operation="GetEvent", headers=self.headers,
+                                      params={'$select': ",".join(select)})
+
+        if response.status_code != 200:
+            logger.error('Calendar operation failed: %d, message: %s', response.status_code, response.text)
+            raise RuntimeError(f"Calendar operation failed: {response.status_code}, message: {response.text}")
+        return response.json()
+
+    def patch_calendar_event(self, event_id, changes, etag=None, merge=None, merge_fields=("categories",)):
         """
         Updates a calendar event with specified changes.
 
@@ -249,17 +1029,123 @@ class LoneWorkerManager:
             event_id (str): ID of the calendar event to update
             changes (dict): Dictionary of changes to apply to the event
                           (e.g., {'categories': ['new-category']})
+            etag (str, optional): The event's @odata.etag when it was read. If given, the
+                update is only made if the event has not changed since (If-Match).
+            merge (callable, optional): Called with the event as it is now (its merge_fields
+                and @odata.etag) if it has changed since it was read. Returns the changes to
+                make instead, or None if no update is needed any more.
+            merge_fields (tuple, optional): Fields of the event that merge needs
+
+        Returns:
+            bool: True if the event was updated, False if merge found no update was needed
 
         Raises:
-            RuntimeError: If the calendar update operation fails
+            RuntimeError: If the calendar update operation fails, or the event has changed and
+                there is no merge function or it still conflicts after MAX_CONFLICT_RETRIES merges
         """
-        logger.info("Updating calendar event %s with new categories %s", event_id, changes.get("categories"))
-        response = requests.patch(f"{self.calendar_url}/{event_id}", headers=self.headers, json=changes)
+        conflicts = 0
+        while True:
+            logger.info("Updating calendar event %s with new categories %s", event_id, changes.get("categories"))
+            headers = self.headers if etag is None else {**self.headers, 'If-Match': etag}
+            response = self.graph_request("PATCH", f"{self.calendar_url}/{event_id}", operation="PatchEvent",
+                                              headers=headers, json=changes)
+            if response.status_code == 200:
+                return True
+
+            if (response.status_code == STATUS_PRECONDITION_FAILED and merge is not None and
+                    conflicts < MAX_CONFLICT_RETRIES):
+                conflicts += 1
+                self.increment_counter(METRIC_CALENDAR_CONFLICTS)
+                changes, etag = self.merge_calendar_event(event_id, merge, merge_fields)
+                if changes is None:
+                    return False
+                continue
 
-        if response.status_code != 200:
             logger.error('Calendar patch operation failed: %d, message: %s', response.status_code, response.text)
             raise RuntimeError(f"Calendar patch operation failed: {response.status_code}, message: {response.text}")
 
+    def merge_calendar_event(self, event_id, merge, merge_fields):
+        """
+        Re-reads an event that changed after it was read, and works out the update to make now.
+
+        Args:
+            event_id (str): ID of the calendar event
+            merge (callable): As for patch_calendar_event
+            merge_fields (tuple): Fields of the event that merge needs
+
+        Returns:
+            tuple: (changes, etag) - the changes from merge (or None if no update is needed),
+                and the etag to make them with
+
+        Raises:
+            RuntimeError: If the calendar API request fails
+        """
+        logger.info("Calendar event %s changed since it was read - merging", event_id)
+        current = self.get_calendar_event(event_id, merge_fields)
+        return merge(current), current.get('@odata.etag')
+
+    def create_subscription(self, notification_url, client_state, expiration):
+        """
+        Subscribes to change notifications for the calendar's events.
+
+        Args:
+            notification_url (str): HTTPS URL that Graph posts notifications to. Graph
+                validates it (see the Notify function) before the subscription is created.
+            client_state (str): Secret included in every notification, so they can be checked
+            expiration (datetime): UTC time the subscription expires unless renewed
+
+        Returns:
+            dict: The subscription, including its id and expirationDateTime
+
+        Raises:
+            RuntimeError: If the subscription request fails
+
+        Lifecycle notifications (such as reauthorizationRequired) go to the same URL.
+        """
+        payload = {
+            'changeType': "created,updated,deleted",
+            'notificationUrl': notification_url,
+            'lifecycleNotificationUrl': notification_url,
+            'resource': f"users/{self.username}/events",
+            'expirationDateTime': expiration.strftime("%Y-%m-%dT%H:%M:%SZ"),
+            'clientState': client_state,
+        }
+        logger.info("Creating subscription to %s expiring at %s", payload['resource'], payload['expirationDateTime'])
+        response = self.graph_request("POST", self.subscriptions_url, operation="CreateSubscription",
+                                      headers=self.headers, json=payload)
+
+        if response.status_code != 201:
+            logger.error('Subscription request failed: %d, message: %s', response.status_code, response.text)
+            raise RuntimeError(f"Subscription request failed: {response.status_code}, message: {response.text}")
+        return response.json()
+
+    def renew_subscription(self, subscription_id, expiration):
+        """
+        Extends a subscription's expiry.
+
+        Args:
+            subscription_id (str): ID of the subscription
+            expiration (datetime): New UTC expiry time
+
+        Returns:
+            dict: The subscription, or None if it no longer exists (e.g. it expired)
+
+        Raises:
+            RuntimeError: If the renewal request fails
+        """
+        logger.info("Renewing subscription %s", subscription_id)
+        response = self.graph_request("PATCH", f"{self.subscriptions_url}/{subscription_id}",
+                                      operation="RenewSubscription", headers=self.headers,
+                                      json={'expirationDateTime': expiration.strftime("%Y-%m-%dT%H:%M:%SZ")})
+
+        if response.status_code == 404:
+            logger.info("Subscription %s no longer exists", subscription_id)
+            return None
+        if response.status_code != 200:
+            logger.error('Subscription renewal failed: %d, message: %s', response.status_code, response.text)
+            raise RuntimeError(f"Subscription renewal failed: {response.status_code}, message: {response.text}")
+        return response.json()
+
     def send_email(self, type, subject, content):
         """
         Sends an email using the Microsoft Graph API.
@@ -303,13 +1189,102 @@ class LoneWorkerManager:
                         }
         logger.info("Payload: %s", message_payload)
 
-        response = requests.post(self.mail_url, headers=self.headers, json=message_payload)
+        # Only retried when throttled, as a mail that timed out may still have been sent.
+        response = self.graph_request("POST", self.mail_url, operation="SendMail", retry_statuses=THROTTLE_STATUSES,
+                                      headers=self.headers, json=message_payload)
         # The Microsoft Graph API sendMail method returns a 202 in most cases.
         if response.status_code != 200 and  response.status_code != 202:
             logger.error('Error sending mail: %d, message: %s', response.status_code, response.text)
             raise RuntimeError(f"Error sending mail: {response.status_code}, message: {response.text}")
 
+    def get_identity_cache(self):
+        """
+        Returns the cache of caller identities, creating it on first use.
+
+        The cache takes its TTLs and size from the connect section of the configuration
+        when it is created, and the optional shared store from the identity_store
+        environment variable (a type accepted by state_store.make_state_store).
+        """
+        if self.identity_cache is None:
+            connect_cfg = self.cfg.get_app_cfg("connect")
+            store = state_store.make_state_store(os.environ.get('identity_store', ''), self.s3)
+            self.identity_cache = identity_cache.IdentityCache(
+                ttl_sec=connect_cfg["identity_ttl_min"] * 60,
+                unknown_ttl_sec=connect_cfg["unknown_caller_ttl_min"] * 60,
+                max_entries=connect_cfg["identity_cache_size"],
+                store=store)
+        return self.identity_cache
+
+    def get_directory_index(self):
+        """
+        Returns the reader of the phone number index published by the Directory function,
+        creating it on first use.
+
+        Returns:
+            DirectoryIndex: The reader, or None if the directory_index environment
+                variable (a type accepted by state_store.make_state_store) names no store
+        """
+        if self.directory_index is None:
+            store = state_store.make_state_store(os.environ.get('directory_index', ''), self.s3)
+            if store is None:
+                return None
+            self.directory_index = directory_index.DirectoryIndex(store)
+        return self.directory_index
+
     def phone_to_email(self, number):
+        """
+        Maps a phone number to associated email addresses, using the directory index or
+        the identity cache where possible.
+
+        Args:
+            number (str): Phone number to search for (supports international format)
+
+        Returns:
+            tuple: (addresses, display_name) where:
+                - addresses (list): List of email addresses associated with the phone number
+                - display_name (str): Display name of the first matching contact/user, or "UNKNOWN"
+
+        The function:
+        - Returns the number's entry in the directory index if there is one, counting
+          the hit in the DirectoryIndexHits metric
+        - Otherwise returns the cached result for the number if there is one, counting
+          the hit in the IdentityCacheHits metric
+        - Otherwise looks the number up in contacts and users (see lookup_phone_number),
+          and caches the result, including the result that nobody has the number
+        """
+        key = self.number_plan.normalise(number)
+        index = self.get_directory_index()
+        if index is not None:
+            found = index.lookup(key)
+            if found is not None:
+                logger.info("Identity of %s found in directory index: %s", number, found)
+                self.increment_counter(METRIC_DIRECTORY_INDEX_HITS)
+                return found
+
+        # Numbers missing from the index may have been added since it was built.
+        cache = self.get_identity_cache()
+        cached = cache.get(key)
+        if cached is not None:
+            logger.info("Identity of %s found in cache: %s", number, cached)
+            self.increment_counter(METRIC_IDENTITY_CACHE_HITS)
+            return cached
+
+        addresses, display_name = self.lookup_phone_number(number)
+        cache.put(key, addresses, display_name)
+        return addresses, display_name
+
+    def invalidate_identity(self, number):
+        """
+        Discards the cached identity for a phone number, so that the next call from it
+        is looked up in Graph again.
+
+        Args:
+            number (str): Phone number, in any form phone_to_email accepts
+        """
+        logger.info("Discarding cached identity of %s", number)
+        self.get_identity_cache().invalidate(self.number_plan.normalise(number))
+
+    def lookup_phone_number(self, number):
         """
         Maps a phone number to associated email addresses from contacts and users.
 
@@ -322,8 +1297,8 @@ class LoneWorkerManager:
                 - display_name (str): Display name of the first matching contact/user, or "UNKNOWN"
 
         The function:
-        - Searches both contacts and users directories
-        - Handles international number format (+44) conversion
+        - Searches both contacts and users directories, at the same time
+        - Matches the number in E.164 form and in each national form of the number plan
         - Returns all matching email addresses in lowercase
         """
         logger.info("Looking for phone number %s", number)
@@ -331,21 +1306,68 @@ class LoneWorkerManager:
         addresses = []
         display_name = "UNKNOWN"
 
-        clauses = [f"mobilePhone eq '{number}'"]
-
-        prefix = "+44"
-        if number.startswith(prefix):
-            alt_number = "0" + number[len(prefix):]
-            logger.info("Also checking for number %s", alt_number)
-            clauses.append(f"mobilePhone eq '{alt_number}'")
+        # Graph can only match the number as it is held, so each form it may be held in is
+        # asked for.
+        variants = self.number_plan.variants(number)
+        logger.info("Checking for numbers %s", variants)
+        clauses = []
+        for variant in variants:
+            # Quotes are doubled in OData string literals.
+            quoted = variant.replace("'", "''")
+            clauses.append(f"mobilePhone eq '{quoted}'")
         filter = " or ".join(clauses)
 
         params = {
             '$filter': filter
         }
 
+        # The two queries are independent, so the contacts query runs in another thread
+        # while the users query runs in this one.
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            contacts_future = executor.submit(self.find_contacts, number, params)
+            users, users_sec = self.find_users(number, params)
+            contacts, contacts_sec = contacts_future.result()
+
+        # Results are merged contacts first, so a user's display name wins.
+        for contact in contacts:
+            for emailaddr in contact['emailAddresses']:
+                addresses.append(emailaddr['address'].lower())
+                logger.info("Contact with phone %s has email address %s and name %s", number, addresses[-1], contact['displayName'])
+            if contact['displayName']:
+                display_name = contact['displayName']
+
+        for user in users:
+            addresses.append(user['mail'].lower())
+            logger.info("User with phone %s has email address %s and name %s", number, addresses[-1], user['displayName'])
+            if user['displayName']:
+                display_name = user['displayName']
+
+        logger.info("Lookup of %s took %.0f ms (contacts %.0f ms, users %.0f ms)", number,
+                    (time.perf_counter() - started) * 1000, contacts_sec * 1000, users_sec * 1000)
+        logger.info("Full list of returned matching addresses: %s", addresses)
+        return addresses, display_name
+
+    def find_contacts(self, number, params):
+        """
+        Finds the shared mailbox's contacts matching a phone number filter.
+
+        Args:
+            number (str): Phone number searched for, for messages
+            params (dict): Query parameters, holding the $filter
+
+        Returns:
+            tuple: (contacts, elapsed_sec) where:
+                - contacts (list): The matching contacts
+                - elapsed_sec (float): Time taken by the query, in seconds
+
+        Raises:
+            RuntimeError: If the request fails
+        """
         logger.info("Finding contacts with number %s", number)
-        response = requests.get(self.contacts_url, headers=self.headers, params=params)
+        started = time.perf_counter()
+        response = self.graph_request("GET", self.contacts_url, operation="Contacts", headers=self.headers,
+                                      params=params)
 
         if response.status_code != 200:
             logger.error('Contacts request failed: %d, message: %s', response.status_code, response.text)
@@ -354,20 +1376,35 @@ class LoneWorkerManager:
         # Get the contacts from the response
         contacts = response.json()['value']
         logger.info("Got %d contacts", len(contacts))
-        for contact in contacts:
-            for emailaddr in contact['emailAddresses']:
-                addresses.append(emailaddr['address'].lower())
-                logger.info("Contact with phone %s has email address %s and name %s", number, addresses[-1], contact['displayName'])
-            if contact['displayName']:
-                display_name = contact['displayName']
+        return contacts, time.perf_counter() - started
 
-        # Now the same for users; we need to add another parameter and another header.
+    def find_users(self, number, params):
+        """
+        Finds the directory's users matching a phone number filter.
+
+        Args:
+            number (str): Phone number searched for, for messages
+            params (dict): Query parameters, holding the $filter
+
+        Returns:
+            tuple: (users, elapsed_sec) where:
+                - users (list): The matching users
+                - elapsed_sec (float): Time taken by the query, in seconds
+
+        Raises:
+            RuntimeError: If the request fails
+
+        Filtering users on mobilePhone is an advanced query, needing $count and
+        eventual consistency.
+        """
         logger.info("Finding users with number %s", number)
-        params['$count'] = 'true'
+        started = time.perf_counter()
+        params = dict(params, **{'$count': 'true'})
         headers_with_consistency = self.headers.copy()
         headers_with_consistency['ConsistencyLevel'] = 'eventual'
 
-        response = requests.get(self.users_url, headers=headers_with_consistency, params=params)
+        response = self.graph_request("GET", self.users_url, operation="Users", headers=headers_with_consistency,
+                                      params=params)
 
         if response.status_code != 200:
             logger.error('User list request failed: %d, message: %s', response.status_code, response.text)
@@ -376,14 +1413,7 @@ class LoneWorkerManager:
         # Get the users from the response
         users = response.json()['value']
         logger.info("Got %d users", len(users))
-        for user in users:
-            addresses.append(user['mail'].lower())
-            logger.info("User with phone %s has email address %s and name %s", number, addresses[-1], user['displayName'])
-            if user['displayName']:
-                display_name = user['displayName']
-
-        logger.info("Full list of returned matching addresses: %s", addresses)
-        return addresses, display_name
+        return users, time.perf_counter() - started
 
     def init_metrics(self, metric_names):
         """
@@ -393,12 +1423,13 @@ class LoneWorkerManager:
             metric_names (list): List of metric names to initialize with zero values
 
         The function:
-        - Sets up CloudWatch client
         - Initializes metrics namespace using app prefix and type
         - Creates tracking dictionaries for both current and to-be-emitted metrics
+
+        It is called again at the start of each invocation that reuses a cached
+        manager, discarding any metrics from the previous invocation.
         """
         # Set up metrics ready to report
-        self.cloudwatch = boto3.client('cloudwatch')
         self.metrics_namespace = f"{self.app_prefix}/{self.app_type}"
 
         # metrics is all the metrics reported; metrics_to_emit is all the metrics that have
@@ -406,7 +1437,7 @@ class LoneWorkerManager:
         self.metrics_to_emit = defaultdict(int)
 
         # Add any metric names supplied to the list ready to emit, with zero values.
-        for name in metric_names:
+        for name in MANAGER_METRICS + metric_names:
             self.metrics_to_emit[name] = 0
 
     def increment_counter(self, name, increment=1):
@@ -419,18 +1450,25 @@ class LoneWorkerManager:
 
         The function updates both the current metrics and the to-be-emitted metrics.
         """
-        self.metrics[name] += increment
-        self.metrics_to_emit[name] += increment
+        with _metrics_lock:
+            self.metrics[name] += increment
+            self.metrics_to_emit[name] += increment
 
     def emit_metrics(self):
         """
         Emits accumulated metrics to CloudWatch.
 
         The function:
-        - Sends all pending metrics to CloudWatch with current timestamp
+        - Reports all pending metrics through the metrics backend with current timestamp
         - Uses Count as the unit for all metrics
-        - Clears the to-be-emitted metrics after successful emission
+        - Reports the operations timed since the last emission, as high resolution metrics
+          with an Operation dimension, and the timings recorded since the last emission
+        - Clears the to-be-emitted metrics and operations after successful emission
         - Preserves the total metrics history in the metrics dictionary
+
+        The time taken by the cloudwatch backend's own call is recorded (as operation
+        CloudWatch.PutMetricData) after the metrics are sent, so it appears in the
+        operation summary but not in the metrics.
         """
         logging.info("Emit metrics array: %s", self.metrics)
         # Metrics timestamps must be in UTC
@@ -439,23 +1477,14 @@ class LoneWorkerManager:
             logging.info("No metrics in array - drop out")
             return
 
-        metric_data = []
-        for key, value in self.metrics_to_emit.items():
-            metric_data.append({
-                'MetricName': key,
-                'Timestamp': timestamp,
-                'Value': value,
-                'Unit': 'Count'
-            })
-
-        logging.info("Putting %d metrics, %s", len(metric_data), metric_data)
-        self.cloudwatch.put_metric_data(
-            Namespace=self.metrics_namespace,
-            MetricData=metric_data
-        )
-
-        # This is a pretty useless trace statement EXCEPT that it allows us to track the
-        # time of the AWS call
+        with _metrics_lock:
+            operations = {name: {"latency_ms": list(entry["latency_ms"]), "bytes": list(entry["bytes"]),
+                                 "statuses": dict(entry["statuses"])}
+                          for name, entry in self.operations_to_emit.items()}
+            self.operations_to_emit.clear()
+            timings = [(name, dict(dimensions), values) for (name, dimensions), values in self.timings_to_emit.items()]
+            self.timings_to_emit.clear()
+        self.metrics_backend.emit(dict(self.metrics_to_emit), timestamp, operations, timings)
         logging.info("Metrics emission complete")
 
         # Clear the supplied dict in case we call emit_metrics twice.
@@ -471,6 +1500,180 @@ class LoneWorkerManager:
         """
         return self.metrics
 
+    def record_timing(self, name, elapsed_sec, dimensions):
+        """
+        Records a time to be reported by emit_metrics, as a high resolution metric in
+        milliseconds with a value for each time recorded, so that its percentiles can be
+        read.
+
+        Args:
+            name (str): Name of the metric
+            elapsed_sec (float): The time
+            dimensions (dict): Dimension name to value
+
+        Unlike counters, timings are not discarded at the start of an invocation, so a
+        time recorded after emit_metrics (such as how long it took) is reported by the
+        next invocation of this container.
+        """
+        key = (name, tuple(sorted(dimensions.items())))
+        with _metrics_lock:
+            self.timings_to_emit.setdefault(key, []).append(round(elapsed_sec * 1000, 1))
+
+    def reset_operations(self):
+        """
+        Discards the operation timings recorded so far.
+
+        operations holds every call timed in this invocation, for get_operation_summary;
+        operations_to_emit holds those not yet reported by emit_metrics.
+        """
+        with _metrics_lock:
+            self.operations = {}
+            self.operations_to_emit = {}
+
+    def record_operation(self, operation, elapsed_sec, size, status):
+        """
+        Records one outbound call.
+
+        Args:
+            operation (str): Name of the operation, such as "Users" or "SSM.GetParametersByPath"
+            elapsed_sec (float): Time the call took
+            size (int): Bytes received
+            status (int): HTTP status, or 0 if there was no response
+        """
+        latency_ms = round(elapsed_sec * 1000, 1)
+        logger.info("%s took %.1f ms, %d bytes, status %d", operation, latency_ms, size, status)
+        with _metrics_lock:
+            for operations in (self.operations, self.operations_to_emit):
+                entry = operations.setdefault(operation, {"latency_ms": [], "bytes": [], "statuses": {}})
+                entry["latency_ms"].append(latency_ms)
+                entry["bytes"].append(size)
+                entry["statuses"][str(status)] = entry["statuses"].get(str(status), 0) + 1
+
+    def get_operation_summary(self):
+        """
+        Summarises the calls timed in this invocation.
+
+        Returns:
+            dict: For each operation, a dict of calls, total_ms, max_ms, bytes (received
+                in total) and statuses (a dict of the number of calls by HTTP status)
+        """
+        with _metrics_lock:
+            return {name: {"calls": len(entry["latency_ms"]),
+                           "total_ms": round(sum(entry["latency_ms"])),
+                           "max_ms": round(max(entry["latency_ms"])),
+                           "bytes": sum(entry["bytes"]),
+                           "statuses": dict(entry["statuses"])}
+                    for name, entry in self.operations.items()}
+
+    def instrument_client(self, client):
+        """
+        Times every call made through a boto3 client, as operation <service>.<call>
+        (such as "SSM.GetParametersByPath").
+
+        Args:
+            client: The boto3 client
+
+        Returns:
+            The client, so that it can be instrumented as it is created
+
+        Each call is timed including botocore's own retries. Bytes received are taken from
+        the Content-Length header, as a streamed body (such as an S3 object) is not yet read.
+        """
+        events = client.meta.events
+        events.register("before-call", self._start_aws_call)
+        events.register("after-call", self._end_aws_call)
+        events.register("after-call-error", self._fail_aws_call)
+        return client
+
+    def _start_aws_call(self, model, context, **kwargs):
+        context["timed_operation"] = f"{model.service_model.service_id}.{model.name}"
+        context["timed_started"] = time.perf_counter()
+
+    def _end_aws_call(self, http_response, context, **kwargs):
+        self._record_aws_call(context, int(http_response.headers.get("content-length", 0)),
+                              http_response.status_code)
+
+    def _fail_aws_call(self, context, **kwargs):
+        self._record_aws_call(context, 0, 0)
+
+    def _record_aws_call(self, context, size, status):
+        if "timed_operation" in context:
+            self.record_operation(context["timed_operation"], time.perf_counter() - context["timed_started"],
+                                  size, status)
+
+def format_operation_summary(summary):
+    """
+    Formats an operation summary (see LoneWorkerManager.get_operation_summary) as one line,
+    for callers such as Amazon Connect that only accept flat string values.
+
+    Args:
+        summary (dict): The operation summary
+
+    Returns:
+        str: e.g. "Users: 1 call, 312 ms (max 312), 2048 bytes, status 200x1; ..."
+    """
+    parts = []
+    for operation, entry in summary.items():
+        statuses = ",".join(f"{status}x{count}" for status, count in entry["statuses"].items())
+        calls = "call" if entry["calls"] == 1 else "calls"
+        parts.append(f"{operation}: {entry['calls']} {calls}, {entry['total_ms']} ms (max {entry['max_ms']}), "
+                     f"{entry['bytes']} bytes, status {statuses}")
+    return "; ".join(parts)
+
+def retry_after_sec(response):
+    """
+    Returns the wait requested by a response's Retry-After header, in seconds.
+
+    Args:
+        response (requests.Response): The throttled response
+
+    Returns:
+        float: Seconds to wait, or None if there is no valid Retry-After header.
+            Both forms of the header (a number of seconds, or an HTTP date) are handled.
+    """
+    return parse_retry_after(response.headers.get('Retry-After'))
+
+def parse_retry_after(value):
+    """
+    Converts a Retry-After header value to seconds.
+
+    Args:
+        value (str): The header value: a number of seconds or an HTTP date (or None)
+
+    Returns:
+        float: Seconds to wait, or None if the value is missing or invalid
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        logger.warning("Ignoring invalid Retry-After header %s", value)
+        return None
+    if retry_at.tzinfo is None:
+        # A date with a -0000 zone parses as naive, but is still UTC.
+        retry_at = retry_at.replace(tzinfo=dt.timezone.utc)
+    return max(0.0, (retry_at - datetime.now(dt.timezone.utc)).total_seconds())
+
+def create_session(pool_size):
+    """
+    Creates an HTTP session with a connection pool, for all Graph and Entra traffic.
+
+    Args:
+        pool_size (int): Maximum number of connections kept open to each host
+
+    Returns:
+        requests.Session: Session whose connections are kept alive between calls
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    return session
+
 def get_params(ssm, prefix, mand_names, optional_names=[]):
     """
     Retrieves multiple parameters from AWS SSM Parameter Store using get_parameters_by_path.
@@ -515,6 +1718,72 @@ def get_params(ssm, prefix, mand_names, optional_names=[]):
 
     return results
 
+class CalendarWindow:
+    def __init__(self, start, end, events, fields=None):
+        """
+        Holds the events read from /calendarView for one window.
+
+        Args:
+            start (datetime): UTC start of the window
+            end (datetime): UTC end of the window
+            events (list): Events returned by /calendarView, in the order returned
+            fields (tuple, optional): The $select fields the events were read with, or None for all
+
+        An index from attendee address to events is built the first time it is needed,
+        and then reused for every lookup against this window.
+        """
+        self.start = start
+        self.end = end
+        self.events = events
+        self.fields = None if fields is None else frozenset(fields)
+        self.attendee_index = None
+
+    def covers(self, start, end, fields=None):
+        """
+        Returns True if this window contains the window from start to end, and its
+        events have every field in fields (None meaning all fields).
+        """
+        if self.fields is not None and (fields is None or not self.fields.issuperset(fields)):
+            return False
+        return self.start <= start and end <= self.end
+
+    def attendee_events(self, addresses):
+        """
+        Returns the events with any of the given addresses as an attendee.
+
+        Args:
+            addresses (iterable): Email addresses to look for; case is ignored
+
+        Returns:
+            list: Matching events, each once, in the order of the window's events
+        """
+        if self.attendee_index is None:
+            self.attendee_index = build_attendee_index(self.events)
+        positions = set()
+        for address in {a.lower() for a in addresses}:
+            positions.update(self.attendee_index.get(address, ()))
+        return [self.events[i] for i in sorted(positions)]
+
+def build_attendee_index(events):
+    """
+    Maps each lower-cased attendee address to the positions of the events it attends.
+
+    Args:
+        events (list): Calendar events from /calendarView
+
+    Returns:
+        dict: Address to list of indexes into events, in ascending order
+    """
+    index = defaultdict(list)
+    for position, event in enumerate(events):
+        for attendee in event.get('attendees', []):
+            address = attendee['emailAddress']['address'].lower()
+            positions = index[address]
+            # An address listed twice on one event only needs recording once.
+            if not positions or positions[-1] != position:
+                positions.append(position)
+    return dict(index)
+
 class TimeFilter:
     def __init__(self, minutes=None, datetime=None, before_or_after=None, start_or_end=None):
         """
@@ -544,6 +1813,7 @@ class TimeFilter:
         else:
             self.explicit = False
 
+@lru_cache(maxsize=4096)
 def parse_graph_datetime(datetime_string):
     """
     Parses a Microsoft Graph dateTime string and returns a UTC-aware datetime.
@@ -553,40 +1823,134 @@ def parse_graph_datetime(datetime_string):
     < 3.11), with no offset suffix when the ``Prefer: outlook.timezone`` header
     requests Etc/GMT. The fractional component is dropped and the result is
     tagged as UTC, matching the timezone we asked Graph for.
+
+    Results are cached by string: a calendar has many events starting and ending
+    on the same slot boundaries, and each event is filtered more than once.
     """
     s = datetime_string.rstrip('Z').split('.')[0]
     return datetime.fromisoformat(s).replace(tzinfo=dt.timezone.utc)
 
-def event_matches_time_filters(event, time_filters, now):
+# Margin added around windows derived from TimeFilters, so that an event exactly on a
+# filter boundary is still returned by /calendarView (which matches on overlap, and
+# whose parameters are only accurate to the second).
+WINDOW_MARGIN = timedelta(minutes=1)
+
+# $select projections for calendarView reads, one per use of the calendar. Fields not
+# listed are not downloaded; in particular the HTML body, which can be large, is
+# only fetched for an event that is about to be changed (see get_calendar_event).
+SELECT_CONNECT = ("id", "subject", "start", "end", "location", "categories", "attendees")
+SELECT_CHECK = SELECT_CONNECT + ("bodyPreview",)
+
+def time_filter_window(time_filters, now, default_start, default_end):
     """
-    Returns True if the event satisfies every supplied TimeFilter.
+    Returns the narrowest calendarView window that contains every event satisfying
+    all of the supplied TimeFilters.
 
     Args:
-        event (dict): Calendar event from Graph, with start/end dateTime.
         time_filters (list[TimeFilter]): constraints to apply.
         now (datetime): reference time for relative (minutes-based) filters.
+        default_start (datetime): window start to use if the filters give no lower bound.
+        default_end (datetime): window end to use if the filters give no upper bound.
+
+    Returns:
+        tuple: (window_start, window_end), never wider than the default window,
+            or None if the window is empty.
 
     Raises:
         ValueError: if a TimeFilter has invalid before_or_after / start_or_end.
+
+    /calendarView returns events that overlap the window, so the window must start
+    before the earliest end time an event can have, and finish after the latest
+    start time it can have. An event never ends before it starts, so a lower bound
+    on its start is also a lower bound on its end, and an upper bound on its end is
+    also an upper bound on its start.
     """
-    for time_filter in time_filters:
-        if time_filter.before_or_after not in [BEFORE, AFTER]:
-            raise ValueError(f"Time direction must be either '{BEFORE}' or '{AFTER}' - provided value '{time_filter.before_or_after}'")
-        if time_filter.start_or_end not in [START, END]:
-            raise ValueError(f"Start or end must be either '{START}' or '{END}' - provided value '{time_filter.start_or_end}'")
+    window_start = default_start
+    window_end = default_end
+    for _, before, target_dt in CompiledTimeFilters(time_filters, now).conditions:
+        if before:
+            window_end = min(window_end, target_dt + WINDOW_MARGIN)
+        else:
+            window_start = max(window_start, target_dt - WINDOW_MARGIN)
 
-        event_dt = parse_graph_datetime(event[time_filter.start_or_end]['dateTime'])
+    if window_start >= window_end:
+        return None
+    return window_start, window_end
 
-        if time_filter.explicit:
-            target_dt = parse_graph_datetime(time_filter.datetime)
-        else:
-            target_dt = now + timedelta(minutes=time_filter.minutes)
+class CompiledTimeFilters:
+    def __init__(self, time_filters, now):
+        """
+        Compiles a list of TimeFilters into a predicate for matching events.
 
-        if time_filter.before_or_after == BEFORE:
-            if event_dt > target_dt:
-                return False
-        else:
-            if event_dt < target_dt:
-                return False
+        Args:
+            time_filters (list[TimeFilter]): constraints to apply.
+            now (datetime): reference time for relative (minutes-based) filters.
+
+        Raises:
+            ValueError: if a TimeFilter has invalid before_or_after / start_or_end.
+
+        Each filter is validated and its target time worked out once here, rather
+        than once per event.
+        """
+        self.conditions = []
+        for time_filter in time_filters:
+            if time_filter.before_or_after not in [BEFORE, AFTER]:
+                raise ValueError(f"Time direction must be either '{BEFORE}' or '{AFTER}' - provided value '{time_filter.before_or_after}'")
+            if time_filter.start_or_end not in [START, END]:
+                raise ValueError(f"Start or end must be either '{START}' or '{END}' - provided value '{time_filter.start_or_end}'")
+
+            if time_filter.explicit:
+                target_dt = parse_graph_datetime(time_filter.datetime)
+            else:
+                target_dt = now + timedelta(minutes=time_filter.minutes)
+
+            self.conditions.append((time_filter.start_or_end, time_filter.before_or_after == BEFORE, target_dt))
 
-    return True
+    def matches(self, event):
+        """
+        Returns True if the event satisfies every compiled filter.
+
+        Args:
+            event (dict): Calendar event from Graph, with start/end dateTime.
+        """
+        for start_or_end, before, target_dt in self.conditions:
+            event_dt = parse_graph_datetime(event[start_or_end]['dateTime'])
+            if before:
+                if event_dt > target_dt:
+                    return False
+            else:
+                if event_dt < target_dt:
+                    return False
+        return True
+
+def filter_events(events, time_filters, now):
+    """
+    Returns the events that satisfy every supplied TimeFilter.
+
+    Args:
+        events (list): Calendar events from Graph, with start/end dateTime.
+        time_filters (list[TimeFilter]): constraints to apply.
+        now (datetime): reference time for relative (minutes-based) filters.
+
+    Raises:
+        ValueError: if a TimeFilter has invalid before_or_after / start_or_end.
+    """
+    compiled = CompiledTimeFilters(time_filters, now)
+    return [e for e in events if compiled.matches(e)]
+
+def event_matches_time_filters(event, time_filters, now):
+    """
+    Returns True if the event satisfies every supplied TimeFilter.
+
+    Args:
+        event (dict): Calendar event from Graph, with start/end dateTime.
+        time_filters (list[TimeFilter]): constraints to apply.
+        now (datetime): reference time for relative (minutes-based) filters.
+
+    Raises:
+        ValueError: if a TimeFilter has invalid before_or_after / start_or_end.
+
+    When matching many events against the same filters, use filter_events, which
+    only processes the filters once.
+    """
+    return CompiledTimeFilters(time_filters, now).matches(event)
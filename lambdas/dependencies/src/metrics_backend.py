@@ -0,0 +1,225 @@
+"""
+Module containing the backends through which the loneworker lambda functions report
+their metrics to CloudWatch.
+
+Each backend has emit(metrics, timestamp, operations, timings), reporting a dict of metric
+name to count under its namespace at the UTC datetime timestamp. operations, if given, holds
+the calls timed for each operation (see LoneWorkerManager.record_operation), as a dict of
+operation name to a dict of latency_ms and bytes (a value for each call) and statuses (a
+dict of the number of calls by HTTP status). These are reported as high resolution
+metrics with an Operation dimension: OperationLatency and OperationBytes, and
+OperationCalls with a further Status dimension. timings, if given, is a list of
+(name, dimensions, values) for other high resolution metrics in milliseconds, where
+dimensions is a dict of dimension name to value and values has a value for each time.
+"""
+import boto3
+import json
+import logging
+import sys
+
+logger = logging.getLogger(__name__)
+# Do not make the log level DEBUG or it explodes
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s.%(msecs)03d - %(levelname)s - %(message)s',
+                    datefmt='%Y-%m-%d %H:%M:%S')
+
+# Backend types, as set in the metrics_backend environment variable.
+CLOUDWATCH = "cloudwatch"
+EMF = "emf"
+
+# Metrics reported for each operation.
+METRIC_OPERATION_LATENCY = "OperationLatency"
+METRIC_OPERATION_BYTES = "OperationBytes"
+METRIC_OPERATION_CALLS = "OperationCalls"
+
+# Operation metrics are kept at one second resolution, so that a slow call stands out.
+HIGH_RESOLUTION = 1
+
+# CloudWatch accepts at most this many metrics, or values of one metric, in one Embedded
+# Metric Format record.
+MAX_EMF_METRICS = 100
+
+# CloudWatch accepts at most this many values for one metric, and this many metrics, in one
+# PutMetricData call.
+MAX_PUT_VALUES = 150
+MAX_PUT_METRICS = 1000
+
+def chunks(values, size):
+    """
+    Splits a list into lists of at most size items.
+    """
+    return [values[start:start + size] for start in range(0, len(values), size)]
+
+class CloudWatchBackend:
+    def __init__(self, namespace, client=None):
+        """
+        Initializes a backend calling the CloudWatch PutMetricData API.
+
+        Args:
+            namespace (str): CloudWatch namespace for the metrics
+            client: boto3 CloudWatch client; created if not given
+
+        Each emit is a blocking call to CloudWatch.
+        """
+        self.namespace = namespace
+        self.client = client or boto3.client('cloudwatch')
+
+    def emit(self, metrics, timestamp, operations=None, timings=None):
+        """
+        Reports metrics with one PutMetricData call (more if there are very many).
+        """
+        metric_data = []
+        for key, value in metrics.items():
+            metric_data.append({
+                'MetricName': key,
+                'Timestamp': timestamp,
+                'Value': value,
+                'Unit': 'Count'
+            })
+
+        for operation, entry in (operations or {}).items():
+            dimensions = [{'Name': 'Operation', 'Value': operation}]
+            for name, unit, values in ((METRIC_OPERATION_LATENCY, 'Milliseconds', entry["latency_ms"]),
+                                       (METRIC_OPERATION_BYTES, 'Bytes', entry["bytes"])):
+                for chunk in chunks(values, MAX_PUT_VALUES):
+                    metric_data.append({
+                        'MetricName': name,
+                        'Dimensions': dimensions,
+                        'Timestamp': timestamp,
+                        'Values': chunk,
+                        'Unit': unit,
+                        'StorageResolution': HIGH_RESOLUTION
+                    })
+            for status, count in entry["statuses"].items():
+                metric_data.append({
+                    'MetricName': METRIC_OPERATION_CALLS,
+                    'Dimensions': dimensions + [{'Name': 'Status', 'Value': status}],
+                    'Timestamp': timestamp,
+                    'Value': count,
+                    'Unit': 'Count',
+                    'StorageResolution': HIGH_RESOLUTION
+                })
+
+        for name, dimensions, values in timings or []:
+            for chunk in chunks(values, MAX_PUT_VALUES):
+                metric_data.append({
+                    'MetricName': name,
+                    'Dimensions': [{'Name': key, 'Value': value} for key, value in dimensions.items()],
+                    'Timestamp': timestamp,
+                    'Values': chunk,
+                    'Unit': 'Milliseconds',
+                    'StorageResolution': HIGH_RESOLUTION
+                })
+
+        logger.info("Putting %d metrics, %s", len(metric_data), metric_data)
+        for chunk in chunks(metric_data, MAX_PUT_METRICS):
+            self.client.put_metric_data(
+                Namespace=self.namespace,
+                MetricData=chunk
+            )
+
+class EmfBackend:
+    def __init__(self, namespace, stream=None):
+        """
+        Initializes a backend writing metrics as CloudWatch Embedded Metric Format records.
+
+        Args:
+            namespace (str): CloudWatch namespace for the metrics
+            stream (optional): Where records are written; standard output if not given
+
+        Lambda sends standard output to CloudWatch Logs, which extracts the metrics from
+        the records, so emitting costs no network call. The counts have no dimensions, and
+        the operation metrics the same dimensions, as with PutMetricData, so they are the
+        same metrics whichever backend reports them.
+        """
+        self.namespace = namespace
+        self.stream = stream
+
+    def emit(self, metrics, timestamp, operations=None, timings=None):
+        """
+        Writes metrics as one record per MAX_EMF_METRICS metrics, operations as
+        records for each operation and each of its statuses, and a record for each timing.
+        """
+        records = []
+        for chunk in chunks(list(metrics), MAX_EMF_METRICS):
+            records.append(self.record(timestamp, {}, [(name, "Count", metrics[name]) for name in chunk]))
+
+        for operation, entry in (operations or {}).items():
+            dimensions = {"Operation": operation}
+            for latencies, sizes in zip(chunks(entry["latency_ms"], MAX_EMF_METRICS),
+                                        chunks(entry["bytes"], MAX_EMF_METRICS)):
+                records.append(self.record(timestamp, dimensions, [
+                    (METRIC_OPERATION_LATENCY, "Milliseconds", latencies),
+                    (METRIC_OPERATION_BYTES, "Bytes", sizes)], HIGH_RESOLUTION))
+            for status, count in entry["statuses"].items():
+                records.append(self.record(timestamp, {**dimensions, "Status": status},
+                                           [(METRIC_OPERATION_CALLS, "Count", count)], HIGH_RESOLUTION))
+
+        for name, dimensions, values in timings or []:
+            for chunk in chunks(values, MAX_EMF_METRICS):
+                records.append(self.record(timestamp, dimensions, [(name, "Milliseconds", chunk)],
+                                           HIGH_RESOLUTION))
+
+        # Records must be written as whole lines, not through logging, which adds a prefix.
+        stream = self.stream or sys.stdout
+        for record in records:
+            stream.write(json.dumps(record) + "\n")
+        stream.flush()
+        logger.info("Wrote %d records in Embedded Metric Format", len(records))
+
+    def record(self, timestamp, dimensions, values, resolution=None):
+        """
+        Builds one Embedded Metric Format record.
+
+        Args:
+            timestamp (datetime): UTC time of the metrics
+            dimensions (dict): Dimension name to value, for every metric in the record
+            values (list): (name, unit, value) for each metric; a value may be a list
+            resolution (int, optional): Storage resolution in seconds, if not standard
+
+        Returns:
+            dict: The record
+        """
+        definitions = []
+        for name, unit, _ in values:
+            definition = {"Name": name, "Unit": unit}
+            if resolution is not None:
+                definition["StorageResolution"] = resolution
+            definitions.append(definition)
+        record = {
+            "_aws": {
+                "Timestamp": int(timestamp.timestamp() * 1000),
+                "CloudWatchMetrics": [{
+                    "Namespace": self.namespace,
+                    "Dimensions": [list(dimensions)],
+                    "Metrics": definitions,
+                }],
+            },
+        }
+        record.update(dimensions)
+        for name, _, value in values:
+            record[name] = value
+        return record
+
+def make_metrics_backend(backend_type, namespace, client=None):
+    """
+    Builds a metrics backend from a backend type string, as set in an environment variable.
+
+    Args:
+        backend_type (str): One of:
+            - "" or "cloudwatch": the PutMetricData API
+            - "emf": Embedded Metric Format records written to standard output
+        namespace (str): CloudWatch namespace for the metrics
+        client (optional): CloudWatch client, for a "cloudwatch" backend
+
+    Returns:
+        The backend
+
+    Raises:
+        ValueError: If the backend type is not recognised
+    """
+    if not backend_type or backend_type == CLOUDWATCH:
+        return CloudWatchBackend(namespace, client)
+    if backend_type == EMF:
+        return EmfBackend(namespace)
+    raise ValueError(f"Invalid metrics backend: {backend_type}")
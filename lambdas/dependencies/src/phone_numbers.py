@@ -0,0 +1,129 @@
+"""
+Module putting phone numbers into E.164 form, so that a caller's number and the
+numbers held for workers in contacts and the directory can be compared exactly.
+
+Numbers are written in many ways: "+447700900123", "07700 900123",
+"+44 (0)7700 900123" and "0044 7700 900123" are all the same number. The number plan
+says which national (trunk) prefixes stand for which country codes, and which prefix
+dials out internationally, so that each of these reduces to the same E.164 form.
+"""
+from functools import lru_cache
+import logging
+import re
+
+logger = logging.getLogger(__name__)
+# Do not make the log level DEBUG or it explodes
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s.%(msecs)03d - %(levelname)s - %(message)s',
+                    datefmt='%Y-%m-%d %H:%M:%S')
+
+# Defaults for the phone section of the configuration: numbers starting 0 are UK
+# numbers, and 00 starts an international number.
+DEFAULT_NATIONAL_PREFIXES = {"0": "+44"}
+DEFAULT_INTERNATIONAL_PREFIX = "00"
+
+# Characters people put in phone numbers that do not change the number.
+FORMATTING_CHARACTERS = " -().\t/"
+
+# A trunk prefix written in brackets after the country code, as in "+44 (0)7700 900123",
+# which is not dialled from abroad.
+BRACKETED_TRUNK_PREFIX = re.compile(r"\(\d\)")
+
+E164 = re.compile(r"\+[1-9]\d{6,14}")
+
+# Numbers whose variants are kept by each plan.
+VARIANTS_CACHE_SIZE = 1024
+
+class NumberPlan:
+    def __init__(self, national_prefixes=None, international_prefix=DEFAULT_INTERNATIONAL_PREFIX):
+        """
+        Initializes a number plan.
+
+        Args:
+            national_prefixes (dict, optional): Country code (e.g. "+44") for numbers
+                written with each national prefix (e.g. "0"); DEFAULT_NATIONAL_PREFIXES
+                if not given. The longest matching prefix is used.
+            international_prefix (str, optional): Prefix dialled before a country code
+                instead of "+"
+        """
+        self.national_prefixes = dict(DEFAULT_NATIONAL_PREFIXES if national_prefixes is None
+                                      else national_prefixes)
+        self.international_prefix = international_prefix
+        # Longest first, so that e.g. "01" is tried before "0".
+        self.prefix_order = sorted(self.national_prefixes, key=len, reverse=True)
+        self.cached_variants = lru_cache(maxsize=VARIANTS_CACHE_SIZE)(self.compute_variants)
+
+    @classmethod
+    def from_config(cls, phone_cfg):
+        """
+        Builds the number plan from the phone section of the configuration.
+        """
+        return cls(phone_cfg["national_prefixes"], phone_cfg["international_prefix"])
+
+    def normalise(self, number):
+        """
+        Puts a phone number into E.164 form.
+
+        Args:
+            number (str): Phone number as received or held
+
+        Returns:
+            str: The number in E.164 form, or (if it cannot be put in that form, e.g.
+                "anonymous") as given without formatting characters
+        """
+        number = number.strip()
+        international = number.startswith("+") or (
+            self.international_prefix and number.startswith(self.international_prefix))
+        if international:
+            number = BRACKETED_TRUNK_PREFIX.sub("", number)
+        number = "".join(c for c in number if c not in FORMATTING_CHARACTERS)
+
+        if number.startswith("+"):
+            e164 = number
+        elif self.international_prefix and number.startswith(self.international_prefix):
+            e164 = "+" + number[len(self.international_prefix):]
+        else:
+            prefix = next((prefix for prefix in self.prefix_order if number.startswith(prefix)), None)
+            if prefix is None:
+                return number
+            e164 = self.national_prefixes[prefix] + number[len(prefix):]
+
+        return e164 if E164.fullmatch(e164) else number
+
+    def variants(self, number):
+        """
+        Returns the forms in which a number may be held, for queries that can only
+        match it exactly.
+
+        Args:
+            number (str): Phone number, in any form
+
+        Returns:
+            list: The E.164 form, followed by its national form for each national
+                prefix standing for its country code
+
+        Results are kept, so that each number's variants are only worked out once.
+        """
+        return list(self.cached_variants(number))
+
+    def compute_variants(self, number):
+        """
+        Works out the variants of a number, as a tuple (see variants).
+        """
+        e164 = self.normalise(number)
+        variants = [e164]
+        if E164.fullmatch(e164):
+            for prefix in sorted(self.national_prefixes):
+                country_code = self.national_prefixes[prefix]
+                if e164.startswith(country_code):
+                    variants.append(prefix + e164[len(country_code):])
+        return tuple(variants)
+
+# The plan used where the configuration is not to hand.
+DEFAULT_PLAN = NumberPlan()
+
+def normalise_number(number, plan=DEFAULT_PLAN):
+    """
+    Puts a phone number into E.164 form where possible (see NumberPlan.normalise).
+    """
+    return plan.normalise(number)
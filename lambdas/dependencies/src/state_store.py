@@ -0,0 +1,281 @@
+"""
+Module containing the keyed stores used by the loneworker lambda functions to keep
+state between invocations (and, for shared stores, between containers).
+
+Each store maps a string key to a JSON-serialisable dict, via load and save. Entries
+that several functions update at once are read with load_versioned and written back
+with save_if, which fails with ConflictError if the entry changed in between.
+"""
+import copy
+import json
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+# Do not make the log level DEBUG or it explodes
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s.%(msecs)03d - %(levelname)s - %(message)s',
+                    datefmt='%Y-%m-%d %H:%M:%S')
+
+# S3 error codes for a conditional write that lost: the object changed since it was
+# read, or another conditional write to it was in progress.
+S3_CONFLICT_CODES = ("PreconditionFailed", "ConditionalRequestConflict")
+
+class ConflictError(RuntimeError):
+    """
+    Raised by save_if when the entry changed since it was loaded.
+    """
+
+class MemoryStore:
+    def __init__(self):
+        """
+        Initializes an in-memory store.
+
+        This is a stand-in for a shared store, useful for testing and for running
+        several users of the store in one process. Held in a warm container, it
+        also keeps state between invocations of that container.
+        """
+        self.entries = {}
+        self.versions = {}
+        self.lock = threading.Lock()
+
+    def load(self, key):
+        """
+        Loads an entry.
+
+        Args:
+            key (str): Key identifying the entry
+
+        Returns:
+            dict: The entry, or None if absent
+        """
+        with self.lock:
+            return self.entries.get(key)
+
+    def save(self, key, entry):
+        """
+        Saves an entry.
+
+        Args:
+            key (str): Key identifying the entry
+            entry (dict): The entry
+        """
+        with self.lock:
+            self.entries[key] = dict(entry)
+            self.versions[key] = self.versions.get(key, 0) + 1
+
+    def load_versioned(self, key):
+        """
+        Loads an entry, with its version for save_if.
+
+        Args:
+            key (str): Key identifying the entry
+
+        Returns:
+            tuple: (entry, version), both None if absent. The entry is a copy, so that
+                changes to it before a conflicting save_if do not reach the store.
+        """
+        with self.lock:
+            return copy.deepcopy(self.entries.get(key)), self.versions.get(key)
+
+    def save_if(self, key, entry, version):
+        """
+        Saves an entry if it is unchanged since it was loaded.
+
+        Args:
+            key (str): Key identifying the entry
+            entry (dict): The entry
+            version: Version returned by load_versioned; None if the entry was absent
+
+        Raises:
+            ConflictError: If the entry was saved (or first created) since it was loaded
+        """
+        with self.lock:
+            if self.versions.get(key) != version:
+                raise ConflictError(f"Entry {key} changed since it was loaded")
+            self.entries[key] = dict(entry)
+            self.versions[key] = self.versions.get(key, 0) + 1
+
+class FileStore:
+    def __init__(self, path):
+        """
+        Initializes a store held in a local JSON file.
+
+        Args:
+            path (str): Path to the file, which is created on first save
+
+        This is a stand-in for a shared store, for local runs and testing. On Lambda,
+        a file under /tmp keeps state between invocations of one container. An entry's
+        version is its JSON text, and save_if is only safe within one process.
+        """
+        self.path = path
+
+    def load(self, key):
+        """
+        Loads an entry, returning None if the file or entry is missing or unreadable.
+        """
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f).get(key)
+        except (OSError, ValueError) as e:
+            logger.info("Nothing read from %s: %s", self.path, e)
+            return None
+
+    def load_versioned(self, key):
+        """
+        Loads an entry, with its version for save_if; both None if absent.
+        """
+        entry = self.load(key)
+        return entry, None if entry is None else json.dumps(entry, sort_keys=True)
+
+    def save_if(self, key, entry, version):
+        """
+        Saves an entry if it is unchanged since it was loaded, raising ConflictError if not.
+        """
+        if self.load_versioned(key)[1] != version:
+            raise ConflictError(f"Entry {key} changed since it was loaded")
+        self.save(key, entry)
+
+    def save(self, key, entry):
+        """
+        Saves an entry, replacing the file atomically.
+        """
+        try:
+            with open(self.path, 'r') as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            entries = {}
+        entries[key] = entry
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(entries, f)
+        os.replace(tmp_path, self.path)
+
+class S3Store:
+    def __init__(self, s3, bucket, prefix):
+        """
+        Initializes a store held in S3, with one JSON object per entry.
+
+        Args:
+            s3: boto3 S3 client
+            bucket (str): Name of the bucket
+            prefix (str): Key prefix for the objects, e.g. "cache"
+
+        Unlike the file store, this is shared by every container of every function
+        with access to the bucket. Plain saves are last-writer-wins; save_if writes only
+        if the object's ETag is still the one loaded.
+        """
+        self.s3 = s3
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def object_key(self, key):
+        return f"{self.prefix}/{key}.json" if self.prefix else f"{key}.json"
+
+    def load(self, key):
+        """
+        Loads an entry, returning None if the object is missing.
+        """
+        try:
+            response = self.s3.get_object(Bucket=self.bucket, Key=self.object_key(key))
+        except self.s3.exceptions.NoSuchKey:
+            logger.info("No object %s in bucket %s", self.object_key(key), self.bucket)
+            return None
+        return json.loads(response['Body'].read())
+
+    def load_versioned(self, key):
+        """
+        Loads an entry, with its ETag as the version for save_if; both None if absent.
+        """
+        try:
+            response = self.s3.get_object(Bucket=self.bucket, Key=self.object_key(key))
+        except self.s3.exceptions.NoSuchKey:
+            logger.info("No object %s in bucket %s", self.object_key(key), self.bucket)
+            return None, None
+        return json.loads(response['Body'].read()), response['ETag']
+
+    def save(self, key, entry):
+        """
+        Saves an entry, replacing the object.
+        """
+        self.s3.put_object(Bucket=self.bucket, Key=self.object_key(key),
+                           Body=json.dumps(entry).encode(), ContentType="application/json")
+
+    def save_if(self, key, entry, version):
+        """
+        Saves an entry if it is unchanged since it was loaded, through an S3 conditional
+        write: If-Match on the loaded ETag, or If-None-Match if there was no object.
+
+        Raises:
+            ConflictError: If S3 refuses the write (412 Precondition Failed, or 409 if
+                another conditional write to the object was in progress)
+        """
+        condition = {"IfMatch": version} if version is not None else {"IfNoneMatch": "*"}
+        try:
+            self.s3.put_object(Bucket=self.bucket, Key=self.object_key(key),
+                               Body=json.dumps(entry).encode(), ContentType="application/json",
+                               **condition)
+        except self.s3.exceptions.ClientError as e:
+            if e.response.get('Error', {}).get('Code') in S3_CONFLICT_CODES:
+                raise ConflictError(f"Object {self.object_key(key)} changed since it was loaded")
+            raise
+
+def update(store, key, change, attempts):
+    """
+    Updates an entry that other functions may update at the same time.
+
+    Args:
+        store: The store
+        key (str): Key identifying the entry
+        change (callable): Called with the entry as loaded (or None), returning the
+            entry to save; called again with the entry as reloaded after a conflict
+        attempts (int): Number of times to try before giving up
+
+    Returns:
+        dict: The entry saved
+
+    Raises:
+        ConflictError: If the entry changed under every attempt
+    """
+    for attempt in range(1, attempts + 1):
+        entry, version = store.load_versioned(key)
+        entry = change(entry)
+        try:
+            store.save_if(key, entry, version)
+            return entry
+        except ConflictError:
+            if attempt == attempts:
+                raise
+            logger.info("Entry %s changed while being updated - reloading (attempt %d)", key, attempt)
+
+def make_state_store(store_type, s3=None):
+    """
+    Builds a store from a store type string, as set in an environment variable.
+
+    Args:
+        store_type (str): One of:
+            - "" or "none": no store
+            - "memory": an in-memory store
+            - "file:<path>": a local JSON file
+            - "s3:<bucket>/<prefix>": objects under a prefix in an S3 bucket
+        s3: boto3 S3 client, needed for an "s3:" store
+
+    Returns:
+        The store, or None for no store
+
+    Raises:
+        ValueError: If the store type is not recognised
+    """
+    if not store_type or store_type == "none":
+        return None
+    if store_type == "memory":
+        return MemoryStore()
+    if store_type.startswith("file:"):
+        return FileStore(store_type[len("file:"):])
+    if store_type.startswith("s3:"):
+        bucket, _, prefix = store_type[len("s3:"):].partition("/")
+        if not bucket or s3 is None:
+            raise ValueError(f"Invalid store type: {store_type}")
+        return S3Store(s3, bucket, prefix.strip("/"))
+    raise ValueError(f"Invalid store type: {store_type}")
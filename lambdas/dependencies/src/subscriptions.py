@@ -0,0 +1,110 @@
+"""
+Module managing the Graph change notification subscription on the shared calendar,
+used when the notification_url environment variable is set.
+
+The subscription's details, including the clientState secret that every notification
+must carry, are kept in a state store shared by the Check function (which creates and
+renews the subscription) and the Notify function (which checks notifications against it).
+"""
+from datetime import datetime, timedelta
+import hmac
+import logging
+import secrets
+
+logger = logging.getLogger(__name__)
+# Do not make the log level DEBUG or it explodes
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s.%(msecs)03d - %(levelname)s - %(message)s',
+                    datefmt='%Y-%m-%d %H:%M:%S')
+
+# Lifetime requested for a subscription. Graph allows up to 10080 minutes (7 days)
+# for Outlook events; asking for less leaves room for a few missed renewals.
+SUBSCRIPTION_LIFETIME_MIN = 4320
+
+# A subscription is renewed once it has less than this long left. The Check sweep,
+# which renews it, runs far more often than this.
+RENEW_BEFORE_HOURS = 24
+
+def subscription_key(username):
+    """
+    Returns the store key of the subscription record for a calendar.
+
+    Args:
+        username (str): The mailbox owning the calendar
+    """
+    return f"subscription-{username}"
+
+def ensure_subscription(manager, store, notification_url, now, renew=False):
+    """
+    Makes sure that there is a live subscription posting to notification_url.
+
+    Args:
+        manager (LoneWorkerManager): Manager instance for handling API calls
+        store: State store holding the subscription record
+        notification_url (str): The Notify function's URL
+        now (datetime): The current UTC time
+        renew (bool, optional): Renew the subscription even if it is not close to expiry
+            (e.g. because Graph asked for reauthorization)
+
+    Returns:
+        dict: The subscription record, with:
+            - id: The subscription ID
+            - client_state: The secret carried by its notifications
+            - notification_url: The URL it posts to
+            - expiration: Its (ISO format) expiry time
+
+    Raises:
+        RuntimeError: If a subscription request fails
+
+    The function:
+    - Leaves a subscription to the same URL alone unless it expires within RENEW_BEFORE_HOURS
+    - Renews it otherwise, keeping its clientState
+    - Creates a new subscription, with a new clientState, if there is none, the URL changed,
+      or the old one no longer exists
+    """
+    key = subscription_key(manager.username)
+    record = store.load(key)
+    expiration = now + timedelta(minutes=SUBSCRIPTION_LIFETIME_MIN)
+
+    if record is not None and record["id"] is not None and record["notification_url"] == notification_url:
+        if not renew and datetime.fromisoformat(record["expiration"]) - now > timedelta(hours=RENEW_BEFORE_HOURS):
+            logger.info("Subscription %s is current until %s", record["id"], record["expiration"])
+            return record
+        if manager.renew_subscription(record["id"], expiration) is not None:
+            record = dict(record, expiration=expiration.isoformat())
+            store.save(key, record)
+            return record
+
+    # The record is saved before the subscription is created, so that the Notify
+    # function accepts the notifications Graph may send as soon as it is created.
+    client_state = secrets.token_urlsafe(32)
+    store.save(key, {"id": None, "client_state": client_state, "notification_url": notification_url,
+                     "expiration": now.isoformat()})
+    subscription = manager.create_subscription(notification_url, client_state, expiration)
+    record = {
+        "id": subscription["id"],
+        "client_state": client_state,
+        "notification_url": notification_url,
+        "expiration": expiration.isoformat(),
+    }
+    store.save(key, record)
+    logger.info("Created subscription %s", record["id"])
+    return record
+
+def is_valid_notification(record, notification):
+    """
+    Checks that a notification comes from our subscription.
+
+    Args:
+        record (dict): The subscription record (see ensure_subscription), or None
+        notification (dict): A notification from the body Graph posted
+
+    Returns:
+        bool: True if the notification carries the subscription's clientState and,
+            once the subscription ID is known, its ID
+    """
+    if record is None:
+        return False
+    if record["id"] is not None and notification.get("subscriptionId") != record["id"]:
+        return False
+    return hmac.compare_digest(notification.get("clientState", ""), record["client_state"])
@@ -0,0 +1,231 @@
+"""
+Module containing the Microsoft Graph token cache shared by the loneworker lambda functions.
+
+Tokens are cached in memory with their expiry time, refreshed in a background thread
+shortly before they expire, and optionally written to a shared store so that other
+containers (and other functions) can pick them up rather than asking Entra for their own.
+"""
+import json
+import logging
+import threading
+import time
+
+import state_store
+
+logger = logging.getLogger(__name__)
+# Do not make the log level DEBUG or it explodes
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s.%(msecs)03d - %(levelname)s - %(message)s',
+                    datefmt='%Y-%m-%d %H:%M:%S')
+
+# A token within this many seconds of expiry is refreshed in the background while
+# the current one continues to be used.
+REFRESH_MARGIN_SEC = 300
+
+# A token within this many seconds of expiry is not used at all; callers wait for a
+# new one. This covers clock skew and the duration of the calls made with the token.
+EXPIRY_MARGIN_SEC = 60
+
+# The in-memory and file stores are the generic ones, holding token entries.
+MemoryTokenStore = state_store.MemoryStore
+FileTokenStore = state_store.FileStore
+
+class SsmTokenStore:
+    def __init__(self, ssm, prefix):
+        """
+        Initializes a token store held as SecureString parameters in AWS Parameter Store.
+
+        Args:
+            ssm (boto3.client): The boto3 SSM client
+            prefix (str): The app prefix; tokens are stored under /{prefix}/cache/
+
+        The cache lives below the configuration path rather than in it, so that the
+        non-recursive configuration read in get_params never sees it.
+        """
+        self.ssm = ssm
+        self.path = "/" + prefix.strip("/") + "/cache/graphtoken"
+
+    def _name(self, key):
+        # Parameter names only allow a limited character set.
+        safe_key = "".join(c if c.isalnum() or c in "-_." else "_" for c in key)
+        return f"{self.path}-{safe_key}"
+
+    def load(self, key):
+        """
+        Loads a token entry, returning None if the parameter is missing or unreadable.
+        """
+        try:
+            response = self.ssm.get_parameter(Name=self._name(key), WithDecryption=True)
+            return json.loads(response['Parameter']['Value'])
+        except Exception as e:
+            logger.info("No token read from Parameter Store: %s", e)
+            return None
+
+    def save(self, key, entry):
+        """
+        Saves a token entry as a SecureString parameter.
+        """
+        self.ssm.put_parameter(Name=self._name(key),
+                               Value=json.dumps(entry),
+                               Type="SecureString",
+                               Overwrite=True)
+
+def make_token_store(store_type, ssm=None, prefix=None):
+    """
+    Builds a token store from a store type string, as set in the token_store environment variable.
+
+    Args:
+        store_type (str): One of:
+            - "" or "none": no shared store (tokens are only cached in memory per container)
+            - "memory": an in-memory store (stand-in for a shared store)
+            - "file:<path>": a local JSON file (stand-in for a shared store)
+            - "ssm": SecureString parameters in AWS Parameter Store
+        ssm (boto3.client, optional): The boto3 SSM client, required for "ssm"
+        prefix (str, optional): The app prefix, required for "ssm"
+
+    Returns:
+        The token store, or None for no shared store
+
+    Raises:
+        ValueError: If the store type is not recognised
+    """
+    if store_type == "ssm":
+        return SsmTokenStore(ssm, prefix)
+    try:
+        return state_store.make_state_store(store_type)
+    except ValueError:
+        raise ValueError(f"Invalid token store type: {store_type}")
+
+class TokenProvider:
+    def __init__(self, fetch, key, store=None, refresh_margin_sec=REFRESH_MARGIN_SEC,
+                 expiry_margin_sec=EXPIRY_MARGIN_SEC):
+        """
+        Initializes a token provider that caches a token until shortly before it expires.
+
+        Args:
+            fetch (callable): Function taking no arguments that requests a new token from the
+                token endpoint, returning (access_token, expires_in_seconds)
+            key (str): Key identifying the credentials, used for entries in the shared store
+            store (optional): Shared token store (see make_token_store), or None
+            refresh_margin_sec (int, optional): Seconds before expiry at which to refresh in the background
+            expiry_margin_sec (int, optional): Seconds before expiry after which a token is no longer used
+        """
+        self.fetch = fetch
+        self.key = key
+        self.store = store
+        self.refresh_margin_sec = refresh_margin_sec
+        self.expiry_margin_sec = expiry_margin_sec
+
+        self.token = None
+        self.expires_at = 0
+        self.skip_store = False
+        self.lock = threading.Lock()
+        self.refresh_thread = None
+
+    def get_token(self):
+        """
+        Returns a valid access token, requesting a new one only if required.
+
+        Returns:
+            str: The access token
+
+        Raises:
+            RuntimeError: If a new token is needed and the token request fails
+
+        The function:
+        - Returns the cached token if it is not close to expiry
+        - Starts a background refresh if the cached token is usable but within the refresh margin
+        - Otherwise takes a token from the shared store, or requests a new one and waits for it
+        """
+        with self.lock:
+            remaining = self.expires_at - time.time()
+            if remaining > self.refresh_margin_sec:
+                return self.token
+            if remaining > self.expiry_margin_sec:
+                logger.info("Token expires in %d seconds - refreshing in background", remaining)
+                self._start_background_refresh()
+                return self.token
+
+            logger.info("No usable cached token - getting one before continuing")
+            if not self._load_from_store(self.expiry_margin_sec):
+                self._refresh()
+            return self.token
+
+    def invalidate(self):
+        """
+        Discards the cached token, so that the next get_token call gets a new one.
+
+        The shared store is not consulted on that call, in case it holds the same bad token.
+        """
+        with self.lock:
+            self.token = None
+            self.expires_at = 0
+            self.skip_store = True
+
+    def _load_from_store(self, min_remaining):
+        """
+        Takes the token from the shared store if it has at least min_remaining seconds left.
+        Must be called with the lock held.
+        """
+        if self.store is None:
+            return False
+        if self.skip_store:
+            self.skip_store = False
+            return False
+        entry = self.store.load(self.key)
+        if not entry or entry.get('expires_at', 0) - time.time() <= min_remaining:
+            return False
+        logger.info("Using token from shared store")
+        self.token = entry['access_token']
+        self.expires_at = entry['expires_at']
+        return True
+
+    def _refresh(self):
+        """
+        Requests a new token and saves it. Must be called with the lock held.
+        """
+        started = time.time()
+        token, expires_in = self.fetch()
+        self._save(token, started + int(expires_in))
+
+    def _save(self, token, expires_at):
+        """
+        Saves a token in the cache and the shared store. Must be called with the lock held.
+        """
+        self.token = token
+        self.expires_at = expires_at
+        if self.store is not None:
+            try:
+                self.store.save(self.key, {'access_token': self.token, 'expires_at': self.expires_at})
+            except Exception as e:
+                # The store is only an optimisation; carry on with the token we have.
+                logger.warning("Failed to save token to shared store: %s", e)
+
+    def _start_background_refresh(self):
+        """
+        Starts a thread to refresh the token unless one is already running.
+        Must be called with the lock held.
+        """
+        if self.refresh_thread is not None and self.refresh_thread.is_alive():
+            return
+        self.refresh_thread = threading.Thread(target=self._background_refresh, daemon=True)
+        self.refresh_thread.start()
+
+    def _background_refresh(self):
+        """
+        Thread body for a background refresh. Failures are logged; the next
+        get_token call tries again.
+        """
+        try:
+            with self.lock:
+                # Another container may already have refreshed the token.
+                if self._load_from_store(self.refresh_margin_sec):
+                    return
+            # The request is made without the lock, so callers keep using the current token meanwhile.
+            started = time.time()
+            token, expires_in = self.fetch()
+            with self.lock:
+                self._save(token, started + int(expires_in))
+            logger.info("Background token refresh complete")
+        except Exception as e:
+            logger.warning("Background token refresh failed: %s", e)
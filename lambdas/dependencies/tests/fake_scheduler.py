@@ -0,0 +1,60 @@
+"""
+Stand-in for the EventBridge Scheduler client, so that due run scheduling can be
+tested offline.
+
+It accepts the create_schedule calls EventBridgeScheduler makes, refuses duplicate
+names as the real service does, and delivers each schedule's input to a target
+callable once fire_due is called with a time at or after the schedule's.
+"""
+from datetime import datetime, timezone
+import json
+import re
+
+
+class ConflictException(Exception):
+    pass
+
+
+class FakeSchedulerClient:
+    def __init__(self):
+        self.schedules = {}
+
+        class Exceptions:
+            pass
+        self.exceptions = Exceptions()
+        self.exceptions.ConflictException = ConflictException
+
+    def create_schedule(self, Name, GroupName, ScheduleExpression, Target, ActionAfterCompletion,
+                        FlexibleTimeWindow, ScheduleExpressionTimezone="UTC"):
+        if (GroupName, Name) in self.schedules:
+            raise ConflictException(f"Schedule {Name} already exists")
+        match = re.fullmatch(r"at\((.+)\)", ScheduleExpression)
+        if match is None:
+            raise ValueError(f"Only one-off schedules are supported: {ScheduleExpression}")
+        assert ScheduleExpressionTimezone == "UTC"
+        self.schedules[(GroupName, Name)] = {
+            "when": datetime.fromisoformat(match.group(1)).replace(tzinfo=timezone.utc),
+            "target": Target,
+            "delete": ActionAfterCompletion == "DELETE",
+        }
+        return {"ScheduleArn": f"arn:aws:scheduler:::schedule/{GroupName}/{Name}"}
+
+    def fire_due(self, now, invoke):
+        """
+        Delivers the schedules due at now, in time order, deleting those marked for deletion.
+
+        Args:
+            now (datetime): The current UTC time
+            invoke (callable): Called with (target ARN, payload) for each schedule
+
+        Returns:
+            int: The number of schedules fired
+        """
+        due = sorted((schedule["when"], key) for key, schedule in self.schedules.items()
+                     if schedule["when"] <= now)
+        for _, key in due:
+            schedule = self.schedules[key]
+            if schedule["delete"]:
+                del self.schedules[key]
+            invoke(schedule["target"]["Arn"], json.loads(schedule["target"]["Input"]))
+        return len(due)
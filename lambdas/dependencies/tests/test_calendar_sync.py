@@ -0,0 +1,123 @@
+import os
+import sys
+import types
+import unittest
+from datetime import datetime, timedelta, timezone
+from unittest.mock import MagicMock
+
+# Add the local src directories to the include path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "../src"))
+# Dummy out boto3 so that loneworker_utils loads without trying to use boto3.
+dummy_boto3 = types.ModuleType("boto3")
+sys.modules["boto3"] = dummy_boto3
+
+import calendar_sync
+
+GRACE = timedelta(minutes=15)
+
+
+def _event(event_id, start, end):
+    fmt = lambda d: d.strftime("%Y-%m-%dT%H:%M:%S.0000000")
+    return {"id": event_id,
+            "start": {"dateTime": fmt(start), "timeZone": "Etc/GMT"},
+            "end": {"dateTime": fmt(end), "timeZone": "Etc/GMT"}}
+
+
+def _state(now, events, last_sweep, changed_ids=()):
+    return {
+        "window_start": (now - timedelta(hours=2)).isoformat(),
+        "window_end": (now + timedelta(hours=20)).isoformat(),
+        "last_sweep": last_sweep.isoformat() if last_sweep else None,
+        "delta_link": "https://delta1",
+        "events": {event["id"]: event for event in events},
+        "changed_ids": list(changed_ids),
+    }
+
+
+class TestSyncCalendar(unittest.TestCase):
+    def test_changes_accumulate_until_swept(self):
+        now = datetime.now(timezone.utc)
+        first = _event("first", now + timedelta(minutes=10), now + timedelta(minutes=70))
+        second = _event("second", now + timedelta(minutes=20), now + timedelta(minutes=80))
+        manager = MagicMock()
+        manager.get_calendar_delta.side_effect = [([second], [], "https://delta2")]
+        state = _state(now, [first], now - timedelta(minutes=5), changed_ids=["first"])
+
+        state, changed_ids = calendar_sync.sync_calendar(manager, state, now, 75)
+
+        self.assertEqual(changed_ids, {"first", "second"})
+        self.assertEqual(state["changed_ids"], ["first", "second"])
+        self.assertEqual(state["delta_link"], "https://delta2")
+
+    def test_removed_events_leave_changed_ids(self):
+        now = datetime.now(timezone.utc)
+        first = _event("first", now + timedelta(minutes=10), now + timedelta(minutes=70))
+        manager = MagicMock()
+        manager.get_calendar_delta.side_effect = [([], ["first"], "https://delta2")]
+        state = _state(now, [first], now - timedelta(minutes=5), changed_ids=["first"])
+
+        state, _ = calendar_sync.sync_calendar(manager, state, now, 75)
+
+        self.assertEqual(state["changed_ids"], [])
+        self.assertEqual(state["events"], {})
+
+
+class TestMergeSweep(unittest.TestCase):
+    def test_sweep_recorded_in_state_saved_meanwhile(self):
+        now = datetime.now(timezone.utc)
+        first = _event("first", now + timedelta(minutes=10), now + timedelta(minutes=70))
+        second = _event("second", now + timedelta(minutes=20), now + timedelta(minutes=80))
+        # Saved by a notification sync while the sweep ran: it found "second" changed.
+        saved = _state(now, [first, second], now - timedelta(minutes=30), changed_ids=["second"])
+        # The sweep left "first" to be looked at again.
+        swept = _state(now, [first], now - timedelta(minutes=1), changed_ids=["first"])
+        manager = MagicMock()
+        manager.get_calendar_delta.side_effect = [([], [], "https://delta2")]
+
+        state = calendar_sync.merge_sweep(manager, saved, swept, now, 75)
+
+        manager.get_calendar_delta.assert_called_once_with(delta_link="https://delta1")
+        self.assertEqual(state["last_sweep"], swept["last_sweep"])
+        self.assertEqual(state["changed_ids"], ["first", "second"])
+        self.assertEqual(state["delta_link"], "https://delta2")
+
+    def test_later_sweep_saved_meanwhile_kept(self):
+        now = datetime.now(timezone.utc)
+        saved = _state(now, [], now)
+        swept = _state(now, [], now - timedelta(minutes=1))
+        manager = MagicMock()
+        manager.get_calendar_delta.side_effect = [([], [], "https://delta2")]
+
+        state = calendar_sync.merge_sweep(manager, saved, swept, now, 75)
+
+        self.assertEqual(state["last_sweep"], now.isoformat())
+
+
+class TestSweepNeeded(unittest.TestCase):
+    def test_no_state_or_sweep(self):
+        now = datetime.now(timezone.utc)
+        self.assertTrue(calendar_sync.sweep_needed(None, GRACE, now))
+        self.assertTrue(calendar_sync.sweep_needed(_state(now, [], None), GRACE, now))
+
+    def test_nothing_due(self):
+        now = datetime.now(timezone.utc)
+        # Check-in grace ran out before the last sweep; check-out not yet.
+        event = _event("a", now - timedelta(minutes=40), now + timedelta(minutes=20))
+        state = _state(now, [event], now - timedelta(minutes=1))
+        self.assertFalse(calendar_sync.sweep_needed(state, GRACE, now))
+
+    def test_grace_ran_out_since_last_sweep(self):
+        now = datetime.now(timezone.utc)
+        event = _event("a", now - timedelta(minutes=15, seconds=30), now + timedelta(minutes=45))
+        state = _state(now, [event], now - timedelta(minutes=1))
+        self.assertTrue(calendar_sync.sweep_needed(state, GRACE, now))
+
+    def test_changes_since_last_sweep(self):
+        now = datetime.now(timezone.utc)
+        event = _event("a", now + timedelta(minutes=40), now + timedelta(minutes=100))
+        state = _state(now, [event], now - timedelta(minutes=1), changed_ids=["a"])
+        self.assertTrue(calendar_sync.sweep_needed(state, GRACE, now))
+
+
+if __name__ == '__main__':
+    unittest.main()
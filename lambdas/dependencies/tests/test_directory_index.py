@@ -0,0 +1,137 @@
+import os
+import sys
+import unittest
+from datetime import datetime, timedelta, timezone
+from unittest.mock import MagicMock
+
+# Add the local src directories to the include path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "../src"))
+
+import directory_index
+import state_store
+
+NOW = datetime(2026, 5, 10, 12, 0, tzinfo=timezone.utc)
+
+
+def _state(contacts=None, users=None):
+    return {"index_version": 0,
+            directory_index.CONTACTS: {"delta_link": "https://contacts", "entries": contacts or {}},
+            directory_index.USERS: {"delta_link": "https://users", "entries": users or {}}}
+
+
+def _publish(store, version, numbers, built_at=NOW):
+    store.save(directory_index.INDEX_KEY, {"version": version, "built_at": built_at.isoformat(),
+                                           "numbers": numbers})
+
+
+class TestBuildIndex(unittest.TestCase):
+    def test_numbers_normalised_and_merged(self):
+        state = _state(
+            contacts={"c1": {"displayName": "Worker (contact)", "mobilePhone": "07700 900123",
+                             "emailAddresses": [{"name": "W", "address": "Worker@Example.com"}]}},
+            users={"u1": {"displayName": "Worker", "mobilePhone": "+447700900123", "mail": "worker@example.com"},
+                   "u2": {"displayName": "Other", "mobilePhone": "+447700900456", "mail": "Other@Example.com"},
+                   "u3": {"displayName": "No phone", "mail": "nophone@example.com"}})
+
+        index = directory_index.build_index(state, 3, NOW)
+
+        self.assertEqual(index["version"], 3)
+        self.assertEqual(index["built_at"], NOW.isoformat())
+        self.assertEqual(index["numbers"], {
+            "+447700900123": {"addresses": ["worker@example.com"], "display_name": "Worker"},
+            "+447700900456": {"addresses": ["other@example.com"], "display_name": "Other"},
+        })
+
+    def test_entries_without_addresses_or_names(self):
+        state = _state(contacts={"c1": {"mobilePhone": "+447700900123", "emailAddresses": []}},
+                       users={"u1": {"mobilePhone": "+447700900456", "mail": None}})
+        numbers = directory_index.build_index(state, 1, NOW)["numbers"]
+        self.assertEqual(numbers["+447700900123"], {"addresses": [], "display_name": "UNKNOWN"})
+        self.assertEqual(numbers["+447700900456"], {"addresses": [], "display_name": "UNKNOWN"})
+
+
+class TestDirectoryIndex(unittest.TestCase):
+    NUMBERS = {"+447700900123": {"addresses": ["worker@example.com"], "display_name": "Worker"}}
+
+    def test_lookup(self):
+        store = state_store.MemoryStore()
+        _publish(store, 1, self.NUMBERS)
+        index = directory_index.DirectoryIndex(store)
+
+        self.assertEqual(index.lookup("+447700900123", now=NOW), (["worker@example.com"], "Worker"))
+        self.assertIsNone(index.lookup("+447700900999", now=NOW))
+
+    def test_no_index_published(self):
+        index = directory_index.DirectoryIndex(state_store.MemoryStore())
+        self.assertIsNone(index.lookup("+447700900123", now=NOW))
+
+    def test_old_index_not_used(self):
+        store = state_store.MemoryStore()
+        _publish(store, 1, self.NUMBERS, built_at=NOW - timedelta(hours=25))
+        index = directory_index.DirectoryIndex(store)
+        self.assertIsNone(index.lookup("+447700900123", now=NOW))
+
+    def test_old_index_recently_synced_used(self):
+        store = state_store.MemoryStore()
+        built = directory_index.build_index(_state(), 1, NOW - timedelta(days=3))
+        built["numbers"] = self.NUMBERS
+        directory_index.mark_synced(built, NOW - timedelta(minutes=30))
+        store.save(directory_index.INDEX_KEY, built)
+        index = directory_index.DirectoryIndex(store)
+        self.assertEqual(index.lookup("+447700900123", now=NOW), (["worker@example.com"], "Worker"))
+
+    def test_sync_of_same_version_loaded_in_background(self):
+        store = state_store.MemoryStore()
+        _publish(store, 1, self.NUMBERS, built_at=NOW - timedelta(hours=23))
+        index = directory_index.DirectoryIndex(store, reload_sec=0)
+        index.current()
+
+        synced = store.load(directory_index.INDEX_KEY)
+        directory_index.mark_synced(synced, NOW)
+        store.save(directory_index.INDEX_KEY, synced)
+        index.current()
+        index.reload_thread.join(timeout=5)
+        self.assertEqual(index.lookup("+447700900123", now=NOW + timedelta(hours=2)),
+                         (["worker@example.com"], "Worker"))
+
+    def test_loaded_once_until_reload_due(self):
+        store = MagicMock()
+        store.load.return_value = {"version": 1, "built_at": NOW.isoformat(), "numbers": self.NUMBERS}
+        index = directory_index.DirectoryIndex(store)
+
+        index.lookup("+447700900123", now=NOW)
+        index.lookup("+447700900123", now=NOW)
+        store.load.assert_called_once_with(directory_index.INDEX_KEY)
+
+    def test_newer_version_loaded_in_background(self):
+        store = state_store.MemoryStore()
+        _publish(store, 1, self.NUMBERS)
+        index = directory_index.DirectoryIndex(store, reload_sec=0)
+        index.lookup("+447700900123", now=NOW)
+
+        _publish(store, 2, {"+447700900123": {"addresses": ["new@example.com"], "display_name": "New"}})
+        # The reload is started by this lookup, which still uses version 1.
+        self.assertEqual(index.lookup("+447700900123", now=NOW), (["worker@example.com"], "Worker"))
+        index.reload_thread.join(timeout=5)
+        self.assertEqual(index.index["version"], 2)
+
+    def test_older_version_ignored(self):
+        store = state_store.MemoryStore()
+        _publish(store, 2, self.NUMBERS)
+        index = directory_index.DirectoryIndex(store, reload_sec=0)
+        index.current()
+
+        _publish(store, 1, {})
+        index.current()
+        index.reload_thread.join(timeout=5)
+        self.assertEqual(index.index["version"], 2)
+
+    def test_load_failure_ignored(self):
+        store = MagicMock()
+        store.load.side_effect = RuntimeError("unavailable")
+        index = directory_index.DirectoryIndex(store)
+        self.assertIsNone(index.lookup("+447700900123", now=NOW))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,151 @@
+import os
+import sys
+import threading
+import types
+import unittest
+from datetime import datetime, timedelta, timezone
+from unittest.mock import MagicMock
+
+# Add the local src directories to the include path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "../src"))
+# Dummy out boto3 so that loneworker_utils loads without trying to use boto3.
+dummy_boto3 = types.ModuleType("boto3")
+sys.modules["boto3"] = dummy_boto3
+
+import calendar_sync
+import due_scheduler
+import loneworker_utils
+from fake_scheduler import FakeSchedulerClient
+
+GRACE = timedelta(minutes=15)
+NOW = datetime(2026, 5, 10, 12, 0, tzinfo=timezone.utc)
+TARGET = "arn:aws:lambda:eu-west-2:123456789012:function:CheckFunction"
+ROLE = "arn:aws:iam::123456789012:role/scheduler"
+
+
+def _event(event_id, start, end, categories=()):
+    fmt = lambda d: d.strftime("%Y-%m-%dT%H:%M:%S.0000000")
+    return {"id": event_id, "categories": list(categories),
+            "start": {"dateTime": fmt(start), "timeZone": "Etc/GMT"},
+            "end": {"dateTime": fmt(end), "timeZone": "Etc/GMT"}}
+
+
+def _state(*events):
+    return {"events": {event["id"]: event for event in events}}
+
+
+class TestNextDue(unittest.TestCase):
+    def test_earliest_due_after_now(self):
+        state = _state(
+            # Check-in due 5 minutes ago (past), check-out due in 55 minutes.
+            _event("running", NOW - timedelta(minutes=20), NOW + timedelta(minutes=40)),
+            # Check-in due in 25 minutes.
+            _event("later", NOW + timedelta(minutes=10), NOW + timedelta(minutes=70)))
+        self.assertEqual(calendar_sync.next_due(state, GRACE, NOW), NOW + timedelta(minutes=25))
+
+    def test_skips_check_ins_already_made_or_flagged(self):
+        state = _state(
+            _event("checked-in", NOW + timedelta(minutes=10), NOW + timedelta(minutes=70),
+                   [loneworker_utils.CHECKED_IN]),
+            _event("flagged", NOW + timedelta(minutes=20), NOW + timedelta(minutes=30),
+                   [loneworker_utils.MISSED_CHECK_IN, loneworker_utils.MISSED_CHECK_OUT]))
+        self.assertEqual(calendar_sync.next_due(state, GRACE, NOW), NOW + timedelta(minutes=85))
+
+    def test_nothing_due(self):
+        self.assertIsNone(calendar_sync.next_due(_state(), GRACE, NOW))
+
+
+class TestInProcessScheduler(unittest.TestCase):
+    def test_runs_due_in_time_order_once(self):
+        payloads = []
+        scheduler = due_scheduler.InProcessScheduler(payloads.append)
+        scheduler.thread = MagicMock()  # No background thread: runs are made by run_due.
+        scheduler.schedule(NOW + timedelta(minutes=2), {"n": 2})
+        scheduler.schedule(NOW + timedelta(minutes=1), {"n": 1})
+        scheduler.schedule(NOW + timedelta(minutes=1), {"n": 1})
+        scheduler.schedule(NOW + timedelta(minutes=3), {"n": 3})
+
+        self.assertEqual(scheduler.run_due(NOW), 0)
+        self.assertEqual(scheduler.run_due(NOW + timedelta(minutes=2)), 2)
+        self.assertEqual(payloads, [{"n": 1}, {"n": 2}])
+
+    def test_background_thread_makes_runs(self):
+        ran = threading.Event()
+        scheduler = due_scheduler.InProcessScheduler(lambda payload: ran.set())
+        scheduler.schedule(datetime.now(timezone.utc) + timedelta(milliseconds=50), due_scheduler.DUE_PAYLOAD)
+        try:
+            self.assertTrue(ran.wait(5))
+        finally:
+            scheduler.stop()
+
+    def test_failed_run_does_not_stop_others(self):
+        payloads = []
+        def callback(payload):
+            payloads.append(payload)
+            raise RuntimeError("run failed")
+        scheduler = due_scheduler.InProcessScheduler(callback)
+        scheduler.thread = MagicMock()
+        scheduler.schedule(NOW, {"n": 1})
+        scheduler.schedule(NOW, {"n": 2})
+
+        self.assertEqual(scheduler.run_due(NOW), 2)
+        self.assertEqual(len(payloads), 2)
+
+
+class TestEventBridgeScheduler(unittest.TestCase):
+    def test_schedules_one_off_run(self):
+        client = FakeSchedulerClient()
+        scheduler = due_scheduler.make_scheduler(f"eventbridge:{TARGET},{ROLE}", client=client)
+        when = NOW + timedelta(minutes=15, seconds=1)
+
+        scheduler.schedule(when, due_scheduler.DUE_PAYLOAD)
+        scheduler.schedule(when, due_scheduler.DUE_PAYLOAD)
+
+        self.assertEqual(len(client.schedules), 1)
+        invoked = []
+        self.assertEqual(client.fire_due(when - timedelta(seconds=1), lambda *args: invoked.append(args)), 0)
+        self.assertEqual(client.fire_due(when, lambda *args: invoked.append(args)), 1)
+        self.assertEqual(invoked, [(TARGET, {"mode": "due"})])
+        self.assertEqual(client.schedules, {})
+
+    def test_make_scheduler(self):
+        self.assertIsNone(due_scheduler.make_scheduler(""))
+        self.assertIsNone(due_scheduler.make_scheduler("none"))
+        self.assertIsInstance(due_scheduler.make_scheduler("memory", callback=print),
+                              due_scheduler.InProcessScheduler)
+        for scheduler_type in ("memory", "eventbridge:", f"eventbridge:{TARGET}", "cron"):
+            with self.assertRaises(ValueError):
+                due_scheduler.make_scheduler(scheduler_type, client=FakeSchedulerClient())
+
+
+class TestScheduleNextDue(unittest.TestCase):
+    def test_schedules_next_due_once(self):
+        scheduler = MagicMock()
+        state = _state(_event("later", NOW + timedelta(minutes=10), NOW + timedelta(minutes=70)))
+
+        when = due_scheduler.schedule_next_due(scheduler, state, GRACE, NOW)
+        due_scheduler.schedule_next_due(scheduler, state, GRACE, NOW)
+
+        self.assertEqual(when, NOW + timedelta(minutes=25, seconds=1))
+        scheduler.schedule.assert_called_once_with(when, due_scheduler.DUE_PAYLOAD)
+        self.assertEqual(state["scheduled_due"], when.isoformat())
+
+    def test_reschedules_when_appointment_moves_earlier(self):
+        scheduler = MagicMock()
+        state = _state(_event("later", NOW + timedelta(minutes=10), NOW + timedelta(minutes=70)))
+        due_scheduler.schedule_next_due(scheduler, state, GRACE, NOW)
+
+        state["events"]["sooner"] = _event("sooner", NOW, NOW + timedelta(minutes=30))
+        when = due_scheduler.schedule_next_due(scheduler, state, GRACE, NOW)
+
+        self.assertEqual(when, NOW + timedelta(minutes=15, seconds=1))
+        self.assertEqual(scheduler.schedule.call_count, 2)
+
+    def test_nothing_to_schedule(self):
+        scheduler = MagicMock()
+        self.assertIsNone(due_scheduler.schedule_next_due(scheduler, _state(), GRACE, NOW))
+        scheduler.schedule.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+import os
+import sys
+import unittest
+from unittest.mock import MagicMock, patch
+
+# Add the local src directories to the include path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "../src"))
+
+import identity_cache
+import state_store
+
+
+class TestIdentityCache(unittest.TestCase):
+    def test_caches_identity_until_ttl(self):
+        cache = identity_cache.IdentityCache(ttl_sec=60, unknown_ttl_sec=10)
+        with patch("identity_cache.time.time", return_value=1000):
+            cache.put("+447700900123", ["worker@example.com"], "Worker")
+        with patch("identity_cache.time.time", return_value=1059):
+            self.assertEqual(cache.get("+447700900123"), (["worker@example.com"], "Worker"))
+        with patch("identity_cache.time.time", return_value=1060):
+            self.assertIsNone(cache.get("+447700900123"))
+
+    def test_unknown_numbers_cached_for_shorter_time(self):
+        cache = identity_cache.IdentityCache(ttl_sec=60, unknown_ttl_sec=10)
+        with patch("identity_cache.time.time", return_value=1000):
+            cache.put("+447700900999", [], "UNKNOWN")
+        with patch("identity_cache.time.time", return_value=1009):
+            self.assertEqual(cache.get("+447700900999"), ([], "UNKNOWN"))
+        with patch("identity_cache.time.time", return_value=1010):
+            self.assertIsNone(cache.get("+447700900999"))
+
+    def test_least_recently_used_dropped(self):
+        cache = identity_cache.IdentityCache(max_entries=2)
+        cache.put("a", ["a@example.com"], "A")
+        cache.put("b", ["b@example.com"], "B")
+        cache.get("a")
+        cache.put("c", ["c@example.com"], "C")
+
+        self.assertIsNone(cache.get("b"))
+        self.assertIsNotNone(cache.get("a"))
+        self.assertIsNotNone(cache.get("c"))
+
+    def test_invalidate(self):
+        store = state_store.MemoryStore()
+        cache = identity_cache.IdentityCache(store=store)
+        cache.put("a", ["a@example.com"], "A")
+        cache.invalidate("a")
+
+        self.assertIsNone(cache.get("a"))
+        self.assertIsNone(identity_cache.IdentityCache(store=store).get("a"))
+
+    def test_shared_store_fills_new_cache(self):
+        store = state_store.MemoryStore()
+        identity_cache.IdentityCache(store=store).put("a", ["a@example.com"], "A")
+
+        other = identity_cache.IdentityCache(store=store)
+        self.assertEqual(other.get("a"), (["a@example.com"], "A"))
+        self.assertIn("a", other.entries)
+
+    def test_store_failures_ignored(self):
+        store = MagicMock()
+        store.load.side_effect = RuntimeError("unavailable")
+        store.save.side_effect = RuntimeError("unavailable")
+        cache = identity_cache.IdentityCache(store=store)
+
+        self.assertIsNone(cache.get("a"))
+        cache.put("a", ["a@example.com"], "A")
+        self.assertEqual(cache.get("a"), (["a@example.com"], "A"))
+
+    def test_returned_addresses_are_copies(self):
+        cache = identity_cache.IdentityCache()
+        cache.put("a", ["a@example.com"], "A")
+        cache.get("a")[0].append("b@example.com")
+        self.assertEqual(cache.get("a"), (["a@example.com"], "A"))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,8 +2,10 @@ import datetime as dt
 import logging
 import os
 import sys
+import threading
 import types
 import unittest
+from collections import defaultdict
 from datetime import datetime, timedelta
 from unittest.mock import MagicMock, patch
 
@@ -98,6 +100,53 @@ class TestLoneworkerUtils(unittest.TestCase):
                 now)
 
 
+GRAPH_CFG = {"pool_size": 10, "connect_timeout_sec": 3.05, "read_timeout_sec": 10, "preconnect": False,
+             "max_retries": 4, "backoff_base_sec": 0.5, "backoff_max_sec": 8}
+
+
+class TestCompiledTimeFilters(unittest.TestCase):
+    def test_validates_when_compiled(self):
+        with self.assertRaises(ValueError):
+            loneworker_utils.CompiledTimeFilters(
+                [loneworker_utils.TimeFilter(minutes=10, before_or_after="invalid", start_or_end="start")],
+                datetime.now(dt.timezone.utc))
+
+    def test_filter_events_matches_per_event_function(self):
+        now = datetime.now(dt.timezone.utc)
+        time_filters = [
+            loneworker_utils.TimeFilter(minutes=-30, before_or_after="after", start_or_end="start"),
+            loneworker_utils.TimeFilter(minutes=30, before_or_after="before", start_or_end="end"),
+        ]
+        events = [_event(start, start + 20, now) for start in range(-60, 60, 5)]
+        expected = [e for e in events if loneworker_utils.event_matches_time_filters(e, time_filters, now)]
+        self.assertEqual(loneworker_utils.filter_events(events, time_filters, now), expected)
+        self.assertEqual(len(expected), 8)
+
+    def test_explicit_datetime_parsed_once(self):
+        now = datetime.now(dt.timezone.utc)
+        cutoff = (now + timedelta(minutes=1)).strftime("%Y-%m-%dT%H:%M:%S.0000000")
+        time_filters = [loneworker_utils.TimeFilter(datetime=cutoff, before_or_after="before", start_or_end="end")]
+        with patch("loneworker_utils.parse_graph_datetime", wraps=loneworker_utils.parse_graph_datetime) as parse:
+            compiled = loneworker_utils.CompiledTimeFilters(time_filters, now)
+            parse.assert_called_once_with(cutoff)
+            for offset in range(10):
+                compiled.matches(_event(-60, -offset, now))
+        self.assertEqual(parse.call_count, 11)
+
+    def test_parse_graph_datetime_is_cached(self):
+        loneworker_utils.parse_graph_datetime.cache_clear()
+        loneworker_utils.parse_graph_datetime("2026-05-10T14:00:00.0000000")
+        loneworker_utils.parse_graph_datetime("2026-05-10T14:00:00.0000000")
+        self.assertEqual(loneworker_utils.parse_graph_datetime.cache_info().hits, 1)
+
+
+def _make_cfg(app_cfg):
+    """Build a LambdaConfig stand-in returning app_cfg for the app and defaults for graph."""
+    cfg = MagicMock()
+    cfg.get_app_cfg.side_effect = lambda name: GRAPH_CFG if name == "graph" else app_cfg
+    return cfg
+
+
 def _make_manager(ignore_after_min=75):
     """Build a LoneWorkerManager with only the attributes get_calendar_events needs.
 
@@ -107,9 +156,16 @@ def _make_manager(ignore_after_min=75):
     mgr = loneworker_utils.LoneWorkerManager.__new__(loneworker_utils.LoneWorkerManager)
     mgr.calendar_view_url = "https://graph.microsoft.com/v1.0/users/x/calendar/calendarView"
     mgr.headers = {"Authorization": "Bearer test"}
-    mgr.cfg = MagicMock()
-    mgr.cfg.get_app_cfg.return_value = {"ignore_after_min": ignore_after_min}
+    mgr.cfg = _make_cfg({"ignore_after_min": ignore_after_min})
+    mgr.session = MagicMock()
+    mgr.deadline = loneworker_utils.Deadline()
+    mgr.calendar_windows = []
     mgr.app_type = "Connect"
+    mgr.metrics = defaultdict(int)
+    mgr.metrics_to_emit = defaultdict(int)
+    mgr.number_plan = loneworker_utils.phone_numbers.DEFAULT_PLAN
+    mgr.reset_operations()
+    mgr.timings_to_emit = {}
     return mgr
 
 
@@ -140,12 +196,12 @@ def _event_at(event_id, start_dt, end_dt):
 class TestGetCalendarEvents(unittest.TestCase):
     def test_uses_calendar_view_url_with_wide_window(self):
         mgr = _make_manager(ignore_after_min=75)
-        with patch("loneworker_utils.requests.get") as mock_get:
+        with patch.object(mgr.session, "request") as mock_get:
             mock_get.return_value = _ok_response([])
             loneworker_utils.LoneWorkerManager.get_calendar_events(mgr, [])
 
         call = mock_get.call_args
-        url = call.args[0]
+        url = call.args[1]
         params = call.kwargs["params"]
 
         self.assertTrue(url.endswith("/calendarView"), url)
@@ -164,7 +220,7 @@ class TestGetCalendarEvents(unittest.TestCase):
 
     def test_passes_auth_headers(self):
         mgr = _make_manager()
-        with patch("loneworker_utils.requests.get") as mock_get:
+        with patch.object(mgr.session, "request") as mock_get:
             mock_get.return_value = _ok_response([])
             loneworker_utils.LoneWorkerManager.get_calendar_events(mgr, [])
 
@@ -177,7 +233,7 @@ class TestGetCalendarEvents(unittest.TestCase):
             _event_at("a", now - timedelta(minutes=30), now + timedelta(minutes=30)),
             _event_at("b", now - timedelta(minutes=10), now + timedelta(minutes=50)),
         ]
-        with patch("loneworker_utils.requests.get") as mock_get:
+        with patch.object(mgr.session, "request") as mock_get:
             mock_get.return_value = _ok_response(events)
             result = loneworker_utils.LoneWorkerManager.get_calendar_events(mgr, [])
 
@@ -196,7 +252,7 @@ class TestGetCalendarEvents(unittest.TestCase):
             loneworker_utils.TimeFilter(minutes=-15, before_or_after="after", start_or_end="start"),
             loneworker_utils.TimeFilter(minutes=15, before_or_after="before", start_or_end="start"),
         ]
-        with patch("loneworker_utils.requests.get") as mock_get:
+        with patch.object(mgr.session, "request") as mock_get:
             mock_get.return_value = _ok_response(events)
             result = loneworker_utils.LoneWorkerManager.get_calendar_events(mgr, time_filters)
 
@@ -210,7 +266,7 @@ class TestGetCalendarEvents(unittest.TestCase):
                  _event_at("p2b", now, now + timedelta(minutes=30))]
 
         next_url = "https://graph.microsoft.com/v1.0/next-page-marker"
-        with patch("loneworker_utils.requests.get") as mock_get:
+        with patch.object(mgr.session, "request") as mock_get:
             mock_get.side_effect = [
                 _ok_response(page1, next_link=next_url),
                 _ok_response(page2),
@@ -220,17 +276,1037 @@ class TestGetCalendarEvents(unittest.TestCase):
         self.assertEqual([e["id"] for e in result], ["p1a", "p2a", "p2b"])
         # Second call must hit the nextLink with no extra params, since the
         # nextLink already encodes the original query state.
-        self.assertEqual(mock_get.call_args_list[1].args[0], next_url)
+        self.assertEqual(mock_get.call_args_list[1].args[1], next_url)
         self.assertIsNone(mock_get.call_args_list[1].kwargs["params"])
 
     def test_raises_on_http_error(self):
         mgr = _make_manager()
-        with patch("loneworker_utils.requests.get") as mock_get:
+        with patch.object(mgr.session, "request") as mock_get:
             response = MagicMock(status_code=500, text="boom")
             mock_get.return_value = response
             with self.assertRaises(RuntimeError):
                 loneworker_utils.LoneWorkerManager.get_calendar_events(mgr, [])
 
+    def test_reuses_window_within_invocation(self):
+        mgr = _make_manager()
+        now = datetime.now(dt.timezone.utc)
+        events = [
+            _event_at("early", now - timedelta(minutes=40), now - timedelta(minutes=20)),
+            _event_at("now", now - timedelta(minutes=5), now + timedelta(minutes=55)),
+        ]
+        start_filters = [
+            loneworker_utils.TimeFilter(minutes=-15, before_or_after="after", start_or_end="start"),
+        ]
+        with patch.object(mgr.session, "request") as mock_get:
+            mock_get.return_value = _ok_response(events)
+            first = loneworker_utils.LoneWorkerManager.get_calendar_events(mgr, [], now)
+            second = loneworker_utils.LoneWorkerManager.get_calendar_events(mgr, start_filters, now)
+
+        mock_get.assert_called_once()
+        self.assertEqual([e["id"] for e in first], ["early", "now"])
+        self.assertEqual([e["id"] for e in second], ["now"])
+
+    def test_refetches_window_not_covered(self):
+        mgr = _make_manager()
+        now = datetime.now(dt.timezone.utc)
+        with patch.object(mgr.session, "request") as mock_get:
+            mock_get.return_value = _ok_response([])
+            loneworker_utils.LoneWorkerManager.get_calendar_events(mgr, [], now)
+            loneworker_utils.LoneWorkerManager.get_calendar_events(mgr, [], now + timedelta(minutes=1))
+
+        self.assertEqual(mock_get.call_count, 2)
+
+    def test_filters_by_attendee(self):
+        mgr = _make_manager()
+        now = datetime.now(dt.timezone.utc)
+        events = [
+            _event_at("a", now - timedelta(minutes=5), now + timedelta(minutes=55)),
+            _event_at("b", now - timedelta(minutes=5), now + timedelta(minutes=55)),
+            _event_at("c", now - timedelta(minutes=60), now - timedelta(minutes=50)),
+        ]
+        events[0]["attendees"] = [{"emailAddress": {"address": "Billy@Example.com"}}]
+        events[2]["attendees"] = [{"emailAddress": {"address": "billy@example.com"}}]
+        start_filters = [
+            loneworker_utils.TimeFilter(minutes=-15, before_or_after="after", start_or_end="start"),
+        ]
+        with patch.object(mgr.session, "request") as mock_get:
+            mock_get.return_value = _ok_response(events)
+            result = loneworker_utils.LoneWorkerManager.get_calendar_events(
+                mgr, start_filters, now, attendees={"BILLY@example.com"})
+
+        self.assertEqual([e["id"] for e in result], ["a"])
+
+
+    def test_select_sent_and_respected_by_cache(self):
+        mgr = _make_manager()
+        now = datetime.now(dt.timezone.utc)
+        with patch.object(mgr.session, "request") as mock_get:
+            mock_get.return_value = _ok_response([])
+            loneworker_utils.LoneWorkerManager.get_calendar_events(
+                mgr, [], now, select=loneworker_utils.SELECT_CONNECT)
+            # Fewer fields can be served from the cache, more cannot.
+            loneworker_utils.LoneWorkerManager.get_calendar_events(mgr, [], now, select=("id", "start", "end"))
+            loneworker_utils.LoneWorkerManager.get_calendar_events(
+                mgr, [], now, select=loneworker_utils.SELECT_CHECK)
+
+        self.assertEqual(mock_get.call_count, 2)
+        first, second = mock_get.call_args_list
+        self.assertEqual(first.kwargs["params"]["$select"], "id,subject,start,end,location,categories,attendees")
+        self.assertIn("bodyPreview", second.kwargs["params"]["$select"])
+
+    def test_get_calendar_event(self):
+        mgr = _make_manager()
+        mgr.calendar_url = "https://graph.microsoft.com/v1.0/users/x/calendar/events"
+        with patch.object(mgr.session, "request") as mock_get:
+            mock_get.return_value = MagicMock(status_code=200)
+            mock_get.return_value.json.return_value = {"id": "abc", "body": {"content": "<body></body>"}}
+            event = loneworker_utils.LoneWorkerManager.get_calendar_event(mgr, "abc", ("body",))
+
+        self.assertEqual(event["body"]["content"], "<body></body>")
+        self.assertEqual(mock_get.call_args.args[1], mgr.calendar_url + "/abc")
+        self.assertEqual(mock_get.call_args.kwargs["params"], {"$select": "body"})
+
+
+class TestGetCalendarDelta(unittest.TestCase):
+    def _delta_manager(self):
+        mgr = _make_manager()
+        mgr.calendar_view_url = "https://graph.microsoft.com/v1.0/users/x/calendar/calendarView"
+        return mgr
+
+    def test_first_call_pages_to_delta_link(self):
+        mgr = self._delta_manager()
+        now = datetime.now(dt.timezone.utc)
+        pages = [
+            _ok_response([{"id": "a"}], next_link="https://next"),
+            _ok_response([{"id": "b"}, {"id": "c", "@removed": {"reason": "deleted"}}]),
+        ]
+        pages[1].json.return_value["@odata.deltaLink"] = "https://delta"
+        with patch.object(mgr.session, "request", side_effect=pages) as mock_get:
+            events, removed, delta_link = loneworker_utils.LoneWorkerManager.get_calendar_delta(
+                mgr, window_start=now, window_end=now + timedelta(hours=1))
+
+        self.assertEqual([e["id"] for e in events], ["a", "b"])
+        self.assertEqual(removed, ["c"])
+        self.assertEqual(delta_link, "https://delta")
+        first, second = mock_get.call_args_list
+        self.assertTrue(first.args[1].endswith("/calendarView/delta"))
+        self.assertIn("startDateTime", first.kwargs["params"])
+        self.assertEqual(second.args[1], "https://next")
+        self.assertIsNone(second.kwargs["params"])
+
+    def test_follows_delta_link(self):
+        mgr = self._delta_manager()
+        response = _ok_response([])
+        response.json.return_value["@odata.deltaLink"] = "https://delta2"
+        with patch.object(mgr.session, "request", return_value=response) as mock_get:
+            _, _, delta_link = loneworker_utils.LoneWorkerManager.get_calendar_delta(mgr, delta_link="https://delta1")
+
+        self.assertEqual(mock_get.call_args.args[1], "https://delta1")
+        self.assertEqual(delta_link, "https://delta2")
+
+    def test_expired_delta_link(self):
+        mgr = self._delta_manager()
+        with patch.object(mgr.session, "request", return_value=MagicMock(status_code=410, text="gone")):
+            with self.assertRaises(loneworker_utils.DeltaLinkExpired):
+                loneworker_utils.LoneWorkerManager.get_calendar_delta(mgr, delta_link="https://delta1")
+
+
+class TestGetDirectoryDelta(unittest.TestCase):
+    def _manager(self, *responses):
+        mgr = _make_manager()
+        mgr.contacts_url = "https://graph.microsoft.com/v1.0/users/x/contacts"
+        mgr.users_url = "https://graph.microsoft.com/v1.0/users"
+        mgr.session.request.side_effect = list(responses)
+        return mgr
+
+    def test_first_call_selects_fields_and_follows_pages(self):
+        first = _ok_response([{"id": "u1", "mobilePhone": "07700900123"}], next_link="https://next")
+        last = MagicMock(status_code=200)
+        last.json.return_value = {"value": [{"id": "u2", "@removed": {"reason": "deleted"}}],
+                                  "@odata.deltaLink": "https://delta"}
+        mgr = self._manager(first, last)
+
+        users, removed_ids, delta_link = mgr.get_directory_delta(loneworker_utils.directory_index.USERS)
+
+        self.assertEqual(users, [{"id": "u1", "mobilePhone": "07700900123"}])
+        self.assertEqual(removed_ids, ["u2"])
+        self.assertEqual(delta_link, "https://delta")
+        first_call = mgr.session.request.call_args_list[0]
+        self.assertEqual(first_call.args[1], "https://graph.microsoft.com/v1.0/users/delta")
+        self.assertEqual(first_call.kwargs["params"], {"$select": "id,displayName,mobilePhone,mail"})
+        self.assertEqual(mgr.session.request.call_args_list[1].args[1], "https://next")
+
+    def test_contacts_delta_link_reused(self):
+        response = MagicMock(status_code=200)
+        response.json.return_value = {"value": [], "@odata.deltaLink": "https://delta2"}
+        mgr = self._manager(response)
+
+        _, _, delta_link = mgr.get_directory_delta(loneworker_utils.directory_index.CONTACTS, "https://delta1")
+
+        self.assertEqual(delta_link, "https://delta2")
+        self.assertEqual(mgr.session.request.call_args.args[1], "https://delta1")
+        self.assertIsNone(mgr.session.request.call_args.kwargs["params"])
+
+    def test_expired_delta_link(self):
+        mgr = self._manager(MagicMock(status_code=410, text="syncStateNotFound"))
+        with self.assertRaises(loneworker_utils.DeltaLinkExpired):
+            mgr.get_directory_delta(loneworker_utils.directory_index.USERS, "https://delta1")
+
+
+class TestCalendarWindow(unittest.TestCase):
+    def _window(self, events):
+        now = datetime.now(dt.timezone.utc)
+        return loneworker_utils.CalendarWindow(now - timedelta(hours=1), now + timedelta(hours=1), events)
+
+    def _attended_by(self, event_id, *addresses):
+        return {"id": event_id, "attendees": [{"emailAddress": {"address": a}} for a in addresses]}
+
+    def test_attendee_events_in_window_order(self):
+        events = [
+            self._attended_by("1", "fred@example.com"),
+            self._attended_by("2", "billy@example.com", "Fred@Example.com"),
+            self._attended_by("3", "sue@example.com"),
+            self._attended_by("4", "BILLY@example.com", "billy@example.com"),
+        ]
+        window = self._window(events)
+
+        result = window.attendee_events(["billy@example.com", "fred@example.com"])
+
+        self.assertEqual([e["id"] for e in result], ["1", "2", "4"])
+        self.assertEqual(window.attendee_events(["nobody@example.com"]), [])
+
+    def test_index_built_once(self):
+        window = self._window([self._attended_by("1", "fred@example.com")])
+        with patch.object(loneworker_utils, "build_attendee_index",
+                          wraps=loneworker_utils.build_attendee_index) as build:
+            window.attendee_events(["fred@example.com"])
+            window.attendee_events(["billy@example.com"])
+
+        build.assert_called_once()
+
+    def test_event_without_attendees(self):
+        window = self._window([{"id": "1"}])
+        self.assertEqual(window.attendee_events(["fred@example.com"]), [])
+
+    def test_covers(self):
+        now = datetime.now(dt.timezone.utc)
+        window = loneworker_utils.CalendarWindow(now, now + timedelta(hours=1), [])
+        self.assertTrue(window.covers(now, now + timedelta(minutes=30)))
+        self.assertFalse(window.covers(now - timedelta(minutes=1), now + timedelta(minutes=30)))
+
+
+class TestManagerReuse(unittest.TestCase):
+    def setUp(self):
+        loneworker_utils.clear_managers()
+
+    def tearDown(self):
+        loneworker_utils.clear_managers()
+
+    def test_get_manager_reuses_cached_manager(self):
+        with patch("loneworker_utils.LoneWorkerManager") as mock_class:
+            first = loneworker_utils.get_manager("Connect", ["A"])
+            second = loneworker_utils.get_manager("Connect", ["B"])
+
+        mock_class.assert_called_once_with("Connect", ["A"], None)
+        self.assertIs(first, second)
+        second.start_invocation.assert_called_once_with(["B"], None)
+
+    def test_get_manager_caches_per_app_type(self):
+        with patch("loneworker_utils.LoneWorkerManager") as mock_class:
+            mock_class.side_effect = [MagicMock(), MagicMock()]
+            connect_mgr = loneworker_utils.get_manager("Connect")
+            check_mgr = loneworker_utils.get_manager("Check")
+
+        self.assertEqual(mock_class.call_count, 2)
+        self.assertIsNot(connect_mgr, check_mgr)
+
+    def _warm_manager(self, config_age):
+        mgr = loneworker_utils.LoneWorkerManager.__new__(loneworker_utils.LoneWorkerManager)
+        mgr.app_type = "Connect"
+        mgr.app_prefix = "test"
+        mgr.config_ttl_sec = 300
+        mgr.config_read_time = loneworker_utils.time.monotonic() - config_age
+        mgr.tenant, mgr.client_id, mgr.client_secret = "tenant", "id", "secret"
+        mgr.username = "user@example.com"
+        mgr.ssm = MagicMock()
+        mgr.cfg = _make_cfg({})
+        mgr.session = MagicMock()
+        mgr.deadline = loneworker_utils.Deadline()
+        mgr.token = None
+        mgr.token_provider = None
+        mgr.read_config = MagicMock()
+        mgr.metrics = {"Old": 3}
+        mgr.reset_operations()
+        mgr.timings_to_emit = {}
+        return mgr
+
+    def _token_response(self, token):
+        response = MagicMock(status_code=200)
+        response.json.return_value = {"access_token": token, "expires_in": 3599}
+        return response
+
+    def test_start_invocation_keeps_fresh_config_and_token(self):
+        mgr = self._warm_manager(config_age=10)
+        with patch.object(mgr.session, "request", return_value=self._token_response("tok")) as mock_post:
+            loneworker_utils.LoneWorkerManager.get_token(mgr)
+            mgr.start_invocation(["Checkins"])
+
+        mgr.read_config.assert_not_called()
+        mock_post.assert_called_once()
+        self.assertEqual(mgr.headers["Authorization"], "Bearer tok")
+        self.assertEqual(dict(mgr.metrics), {})
+        self.assertEqual(dict(mgr.metrics_to_emit), {"Checkins": 0, "GraphRetries": 0, "GraphRetryBackoffMs": 0,
+                                                      "CalendarConflicts": 0})
+
+    def test_start_invocation_rereads_stale_config(self):
+        mgr = self._warm_manager(config_age=301)
+        with patch.object(mgr.session, "request", return_value=self._token_response("tok")):
+            mgr.start_invocation()
+
+        mgr.read_config.assert_called_once()
+
+    def test_start_invocation_discards_token_when_credentials_change(self):
+        mgr = self._warm_manager(config_age=301)
+
+        def change_secret():
+            mgr.client_secret = "new secret"
+        mgr.read_config.side_effect = change_secret
+
+        with patch.object(mgr.session, "request") as mock_post:
+            mock_post.side_effect = [self._token_response("old"), self._token_response("new")]
+            loneworker_utils.LoneWorkerManager.get_token(mgr)
+            mgr.start_invocation()
+
+        self.assertEqual(mock_post.call_count, 2)
+        self.assertEqual(mgr.headers["Authorization"], "Bearer new")
+
+    def test_emit_metrics_uses_backend_once(self):
+        mgr = self._warm_manager(config_age=10)
+        mgr.metrics_backend = MagicMock()
+        mgr.init_metrics(["Checkins"])
+        mgr.increment_counter("Checkins")
+
+        mgr.emit_metrics()
+        mgr.emit_metrics()
+
+        mgr.metrics_backend.emit.assert_called_once()
+        emitted = mgr.metrics_backend.emit.call_args.args[0]
+        self.assertEqual(emitted["Checkins"], 1)
+        self.assertEqual(mgr.get_metrics()["Checkins"], 1)
+
+    def test_request_token_returns_expiry(self):
+        mgr = self._warm_manager(config_age=10)
+        with patch.object(mgr.session, "request", return_value=self._token_response("tok")):
+            token, expires_in = mgr.request_token()
+
+        self.assertEqual(token, "tok")
+        self.assertEqual(expires_in, 3599)
+
+
+class TestQueryWindow(unittest.TestCase):
+    NOW = datetime(2026, 5, 10, 12, 0, tzinfo=dt.timezone.utc)
+
+    def _window(self, time_filter_sets):
+        mgr = _make_manager(ignore_after_min=75)
+        return mgr.query_window(time_filter_sets, self.NOW)
+
+    def _minutes(self, window):
+        return tuple(int((w - self.NOW).total_seconds() // 60) for w in window)
+
+    def test_no_filters_gives_default_window(self):
+        self.assertEqual(self._minutes(self._window([[]])), (-75, 75))
+
+    def test_start_filters_narrow_window(self):
+        time_filters = [
+            loneworker_utils.TimeFilter(minutes=-15, before_or_after="after", start_or_end="start"),
+            loneworker_utils.TimeFilter(minutes=15, before_or_after="before", start_or_end="start"),
+        ]
+        self.assertEqual(self._minutes(self._window([time_filters])), (-16, 16))
+
+    def test_explicit_filter_narrows_window(self):
+        time_filters = [
+            loneworker_utils.TimeFilter(minutes=-15, before_or_after="after", start_or_end="end"),
+            loneworker_utils.TimeFilter(datetime="2026-05-10T12:05:00.0000000", before_or_after="before", start_or_end="end"),
+        ]
+        self.assertEqual(self._minutes(self._window([time_filters])), (-16, 6))
+
+    def test_window_limited_to_default(self):
+        time_filters = [
+            loneworker_utils.TimeFilter(minutes=-200, before_or_after="after", start_or_end="end"),
+        ]
+        self.assertEqual(self._minutes(self._window([time_filters])), (-75, 75))
+
+    def test_union_of_filter_sets(self):
+        checkin = [
+            loneworker_utils.TimeFilter(minutes=-75, before_or_after="after", start_or_end="start"),
+            loneworker_utils.TimeFilter(minutes=-15, before_or_after="before", start_or_end="start"),
+        ]
+        later = [
+            loneworker_utils.TimeFilter(minutes=10, before_or_after="after", start_or_end="start"),
+            loneworker_utils.TimeFilter(minutes=20, before_or_after="before", start_or_end="start"),
+        ]
+        self.assertEqual(self._minutes(self._window([checkin, later])), (-75, 21))
+
+    def test_empty_window(self):
+        time_filters = [
+            loneworker_utils.TimeFilter(minutes=10, before_or_after="after", start_or_end="start"),
+            loneworker_utils.TimeFilter(minutes=-10, before_or_after="before", start_or_end="end"),
+        ]
+        self.assertIsNone(self._window([time_filters]))
+
+    def test_get_calendar_events_skips_read_for_empty_window(self):
+        mgr = _make_manager()
+        time_filters = [
+            loneworker_utils.TimeFilter(minutes=10, before_or_after="after", start_or_end="start"),
+            loneworker_utils.TimeFilter(minutes=-10, before_or_after="before", start_or_end="end"),
+        ]
+        self.assertEqual(loneworker_utils.LoneWorkerManager.get_calendar_events(mgr, time_filters), [])
+        mgr.session.request.assert_not_called()
+
+
+class TestSession(unittest.TestCase):
+    def test_create_session_pools_connections(self):
+        session = loneworker_utils.create_session(4)
+        adapter = session.get_adapter("https://graph.microsoft.com/v1.0/users")
+        self.assertEqual(adapter._pool_maxsize, 4)
+
+    def test_calls_use_configured_timeouts(self):
+        mgr = _make_manager()
+        mgr.session.request.return_value = _ok_response([])
+        loneworker_utils.LoneWorkerManager.get_calendar_events(mgr, [])
+        self.assertEqual(mgr.session.request.call_args.kwargs["timeout"], (3.05, 10))
+
+    def test_preconnect_failure_is_ignored(self):
+        mgr = _make_manager()
+        mgr.session.head.side_effect = loneworker_utils.requests.ConnectionError("no route")
+        mgr.preconnect()
+        mgr.session.head.assert_called_once()
+
+
+def _context(remaining_ms):
+    """Build a Lambda context stand-in with the given remaining time."""
+    context = MagicMock()
+    context.get_remaining_time_in_millis.return_value = remaining_ms
+    return context
+
+
+def _status_response(status, retry_after=None):
+    response = MagicMock(status_code=status, text="")
+    response.headers = {"Retry-After": retry_after} if retry_after is not None else {}
+    return response
+
+
+def _batch_response(*items):
+    """Build a $batch response with (id, status, headers) sub-responses."""
+    response = MagicMock(status_code=200)
+    response.json.return_value = {"responses": [
+        {"id": request_id, "status": status, "headers": headers or {}, "body": {}}
+        for request_id, status, headers in items]}
+    return response
+
+
+class TestSendBatch(unittest.TestCase):
+    def _batch_manager(self, responses):
+        mgr = _make_manager()
+        mgr.username = "shared@example.com"
+        mgr.pending_patches = []
+        mgr.pending_merges = {}
+        mgr.session.request.side_effect = responses
+        return mgr
+
+    def _sent_ids(self, mgr):
+        return [[r["id"] for r in c.kwargs["json"]["requests"]] for c in mgr.session.request.call_args_list]
+
+    def test_queued_patches_sent_in_batches_of_twenty(self):
+        responses = [_batch_response(*[(str(i), 200, None) for i in range(start, min(start + 20, 46))])
+                     for start in (1, 21, 41)]
+        mgr = self._batch_manager(responses)
+        ids = [mgr.queue_calendar_patch(f"event{i}", {"categories": ["x"]}) for i in range(45)]
+
+        results = mgr.send_calendar_patches()
+
+        self.assertEqual([len(batch) for batch in self._sent_ids(mgr)], [20, 20, 5])
+        self.assertEqual(results, {request_id: 200 for request_id in ids})
+        first = mgr.session.request.call_args_list[0]
+        self.assertEqual(first.args[:2], ("POST", loneworker_utils.GRAPH_BATCH_URL))
+        request = first.kwargs["json"]["requests"][0]
+        self.assertEqual(request["method"], "PATCH")
+        self.assertEqual(request["url"], "/users/shared@example.com/calendar/events/event0")
+        self.assertEqual(request["body"], {"categories": ["x"]})
+        self.assertEqual(mgr.pending_patches, [])
+
+    def test_retries_only_throttled_requests(self):
+        mgr = self._batch_manager([
+            _batch_response(("1", 200, None), ("2", 429, {"Retry-After": "3"}), ("3", 404, None)),
+            _batch_response(("2", 200, None)),
+        ])
+        for i in range(3):
+            mgr.queue_calendar_patch(f"event{i}", {})
+
+        with patch("loneworker_utils.time.sleep") as mock_sleep:
+            results = mgr.send_calendar_patches()
+
+        self.assertEqual(results, {"1": 200, "2": 200, "3": 404})
+        self.assertEqual(self._sent_ids(mgr), [["1", "2", "3"], ["2"]])
+        mock_sleep.assert_called_once_with(3.0)
+
+    def test_dependent_of_throttled_request_retried_with_it(self):
+        mgr = self._batch_manager([
+            _batch_response(("1", 503, None), ("2", 424, None)),
+            _batch_response(("1", 200, None), ("2", 200, None)),
+        ])
+        first = mgr.queue_calendar_patch("event0", {})
+        mgr.queue_calendar_patch("event1", {}, depends_on=first)
+
+        with patch("loneworker_utils.time.sleep"):
+            results = mgr.send_calendar_patches()
+
+        self.assertEqual(results, {"1": 200, "2": 200})
+        self.assertEqual(self._sent_ids(mgr), [["1", "2"], ["1", "2"]])
+
+    def test_dependency_in_earlier_batch(self):
+        responses = [_batch_response(*[(str(i), 500 if i == 1 else 200, None) for i in range(1, 21)]),
+                     _batch_response(("22", 200, None))]
+        mgr = self._batch_manager(responses)
+        ids = [mgr.queue_calendar_patch(f"event{i}", {}) for i in range(20)]
+        mgr.queue_calendar_patch("event20", {}, depends_on=ids[0])
+        mgr.queue_calendar_patch("event21", {}, depends_on=ids[1])
+
+        results = mgr.send_calendar_patches()
+
+        # The failed dependency's dependent is not sent; the other is sent without dependsOn.
+        self.assertEqual(results["21"], loneworker_utils.STATUS_FAILED_DEPENDENCY)
+        self.assertEqual(results["22"], 200)
+        second = mgr.session.request.call_args_list[1].kwargs["json"]["requests"]
+        self.assertEqual([r["id"] for r in second], ["22"])
+        self.assertNotIn("dependsOn", second[0])
+
+    def test_gives_up_after_max_retries(self):
+        mgr = self._batch_manager([_batch_response(("1", 429, {"Retry-After": "0"}))] * 5)
+        mgr.queue_calendar_patch("event0", {})
+
+        with patch("loneworker_utils.time.sleep"):
+            results = mgr.send_calendar_patches()
+
+        self.assertEqual(results, {"1": 429})
+        self.assertEqual(mgr.session.request.call_count, 5)
+
+    def test_batch_failure_raises(self):
+        mgr = self._batch_manager([MagicMock(status_code=400, text="bad")])
+        mgr.queue_calendar_patch("event0", {})
+        with self.assertRaises(RuntimeError):
+            mgr.send_calendar_patches()
+
+    def test_nothing_queued(self):
+        mgr = self._batch_manager([])
+        self.assertEqual(mgr.send_calendar_patches(), {})
+        mgr.session.request.assert_not_called()
+
+
+class TestConditionalPatch(unittest.TestCase):
+    def _patch_manager(self, responses):
+        mgr = _make_manager()
+        mgr.calendar_url = "https://graph.microsoft.com/v1.0/users/x/calendar/events"
+        mgr.username = "x"
+        mgr.pending_patches = []
+        mgr.pending_merges = {}
+        mgr.session.request.side_effect = responses
+        return mgr
+
+    def _current(self, categories, etag):
+        response = MagicMock(status_code=200)
+        response.json.return_value = {"categories": categories, "@odata.etag": etag}
+        return response
+
+    def _merge(self, current):
+        if "Checked-In" in current["categories"]:
+            return None
+        return {"categories": current["categories"] + ["Checked-In"]}
+
+    def test_sends_if_match(self):
+        mgr = self._patch_manager([_status_response(200)])
+        self.assertTrue(mgr.patch_calendar_event("abc", {"categories": ["Checked-In"]}, etag="etag-1"))
+        self.assertEqual(mgr.session.request.call_args.kwargs["headers"]["If-Match"], "etag-1")
+        self.assertNotIn("If-Match", mgr.headers)
+
+    def test_merges_and_retries_after_conflict(self):
+        mgr = self._patch_manager([_status_response(412), self._current(["Red"], "etag-2"), _status_response(200)])
+
+        self.assertTrue(mgr.patch_calendar_event("abc", {"categories": ["Checked-In"]}, etag="etag-1",
+                                                 merge=self._merge))
+
+        patch_call = mgr.session.request.call_args_list[2]
+        self.assertEqual(patch_call.kwargs["json"], {"categories": ["Red", "Checked-In"]})
+        self.assertEqual(patch_call.kwargs["headers"]["If-Match"], "etag-2")
+        refetch = mgr.session.request.call_args_list[1]
+        self.assertEqual(refetch.args[:2], ("GET", mgr.calendar_url + "/abc"))
+        self.assertEqual(mgr.metrics[loneworker_utils.METRIC_CALENDAR_CONFLICTS], 1)
+
+    def test_no_update_needed_after_conflict(self):
+        mgr = self._patch_manager([_status_response(412), self._current(["Checked-In"], "etag-2")])
+        self.assertFalse(mgr.patch_calendar_event("abc", {"categories": ["Checked-In"]}, etag="etag-1",
+                                                  merge=self._merge))
+        self.assertEqual(mgr.session.request.call_count, 2)
+
+    def test_conflict_without_merge_raises(self):
+        mgr = self._patch_manager([_status_response(412)])
+        with self.assertRaises(RuntimeError):
+            mgr.patch_calendar_event("abc", {"categories": []}, etag="etag-1")
+
+    def test_gives_up_on_repeated_conflicts(self):
+        responses = [_status_response(412)]
+        for i in range(loneworker_utils.MAX_CONFLICT_RETRIES):
+            responses += [self._current([], f"etag-{i + 2}"), _status_response(412)]
+        mgr = self._patch_manager(responses)
+        with self.assertRaises(RuntimeError):
+            mgr.patch_calendar_event("abc", {"categories": []}, etag="etag-1", merge=self._merge)
+
+    def test_batched_conflict_merged_individually(self):
+        mgr = self._patch_manager([
+            _batch_response(("1", 200, None), ("2", 412, None)),
+            self._current(["Red"], "etag-2"),
+            _status_response(200),
+        ])
+        mgr.queue_calendar_patch("a", {"categories": ["Checked-In"]}, etag="etag-a")
+        mgr.queue_calendar_patch("b", {"categories": ["Checked-In"]}, etag="etag-b", merge=self._merge)
+
+        results = mgr.send_calendar_patches()
+
+        self.assertEqual(results, {"1": 200, "2": 200})
+        batch = mgr.session.request.call_args_list[0].kwargs["json"]["requests"]
+        self.assertEqual([r["headers"]["If-Match"] for r in batch], ["etag-a", "etag-b"])
+        retry = mgr.session.request.call_args_list[2]
+        self.assertEqual(retry.args[:2], ("PATCH", mgr.calendar_url + "/b"))
+        self.assertEqual(retry.kwargs["json"], {"categories": ["Red", "Checked-In"]})
+        self.assertEqual(mgr.pending_merges, {})
+
+
+class TestSubscriptions(unittest.TestCase):
+    def _manager(self, response):
+        mgr = _make_manager()
+        mgr.username = "loneworker@example.com"
+        mgr.subscriptions_url = "https://graph.microsoft.com/v1.0/subscriptions"
+        mgr.session.request.return_value = response
+        return mgr
+
+    def test_create_subscription(self):
+        response = MagicMock(status_code=201)
+        response.json.return_value = {"id": "sub-1"}
+        mgr = self._manager(response)
+        expiration = datetime(2026, 5, 10, 12, 0, tzinfo=dt.timezone.utc)
+
+        result = mgr.create_subscription("https://notify.example.com/", "secret", expiration)
+
+        self.assertEqual(result, {"id": "sub-1"})
+        call = mgr.session.request.call_args
+        self.assertEqual(call.args[:2], ("POST", mgr.subscriptions_url))
+        payload = call.kwargs["json"]
+        self.assertEqual(payload["resource"], "users/loneworker@example.com/events")
+        self.assertEqual(payload["notificationUrl"], "https://notify.example.com/")
+        self.assertEqual(payload["lifecycleNotificationUrl"], "https://notify.example.com/")
+        self.assertEqual(payload["clientState"], "secret")
+        self.assertEqual(payload["expirationDateTime"], "2026-05-10T12:00:00Z")
+
+    def test_create_subscription_failure_raises(self):
+        mgr = self._manager(MagicMock(status_code=400, text="validation failed"))
+        with self.assertRaises(RuntimeError):
+            mgr.create_subscription("https://notify.example.com/", "secret", datetime.now(dt.timezone.utc))
+
+    def test_renew_subscription(self):
+        response = MagicMock(status_code=200)
+        response.json.return_value = {"id": "sub-1"}
+        mgr = self._manager(response)
+
+        self.assertEqual(mgr.renew_subscription("sub-1", datetime.now(dt.timezone.utc)), {"id": "sub-1"})
+        call = mgr.session.request.call_args
+        self.assertEqual(call.args[:2], ("PATCH", f"{mgr.subscriptions_url}/sub-1"))
+        self.assertIn("expirationDateTime", call.kwargs["json"])
+
+    def test_renew_missing_subscription_returns_none(self):
+        mgr = self._manager(MagicMock(status_code=404, text="not found"))
+        self.assertIsNone(mgr.renew_subscription("sub-1", datetime.now(dt.timezone.utc)))
+
+
+class TestPhoneToEmail(unittest.TestCase):
+    CONNECT_CFG = {"identity_ttl_min": 60, "unknown_caller_ttl_min": 10, "identity_cache_size": 200}
+
+    def _manager(self, contacts, users):
+        mgr = _make_manager()
+        mgr.cfg = _make_cfg(self.CONNECT_CFG)
+        mgr.s3 = MagicMock()
+        mgr.identity_cache = None
+        mgr.directory_index = None
+        mgr.contacts_url = "https://graph.microsoft.com/v1.0/users/x/contacts"
+        mgr.users_url = "https://graph.microsoft.com/v1.0/users"
+        mgr.session.request.side_effect = lambda method, url, **kwargs: (
+            _ok_response(contacts) if url == mgr.contacts_url else _ok_response(users))
+        return mgr
+
+    def test_lookup_cached_per_number(self):
+        mgr = self._manager(
+            contacts=[{"displayName": "Worker", "emailAddresses": [{"address": "Worker@Example.com"}]}],
+            users=[])
+
+        first = mgr.phone_to_email("+447700900123")
+        second = mgr.phone_to_email("07700 900123")
+
+        self.assertEqual(first, (["worker@example.com"], "Worker"))
+        self.assertEqual(second, first)
+        self.assertEqual(mgr.session.request.call_count, 2)
+        self.assertEqual(mgr.metrics[loneworker_utils.METRIC_IDENTITY_CACHE_HITS], 1)
+
+    def test_queries_run_concurrently_and_merge_in_order(self):
+        mgr = self._manager(contacts=[], users=[])
+        responses = {
+            mgr.contacts_url: _ok_response([{"displayName": "Contact name",
+                                            "emailAddresses": [{"address": "Contact@Example.com"}]}]),
+            mgr.users_url: _ok_response([{"displayName": "User name", "mail": "User@Example.com"}]),
+        }
+        # Each query waits for the other to start, so they can only both finish if
+        # they run at the same time.
+        both_started = threading.Barrier(2, timeout=5)
+
+        def request(method, url, **kwargs):
+            both_started.wait()
+            return responses[url]
+        mgr.session.request.side_effect = request
+
+        addresses, display_name = mgr.lookup_phone_number("+447700900123")
+
+        self.assertEqual(addresses, ["contact@example.com", "user@example.com"])
+        self.assertEqual(display_name, "User name")
+        users_call = [call for call in mgr.session.request.call_args_list if call.args[1] == mgr.users_url][0]
+        self.assertEqual(users_call.kwargs["headers"]["ConsistencyLevel"], "eventual")
+        self.assertEqual(users_call.kwargs["params"]["$count"], "true")
+        contacts_call = [call for call in mgr.session.request.call_args_list if call.args[1] == mgr.contacts_url][0]
+        self.assertNotIn("$count", contacts_call.kwargs["params"])
+
+    def test_filter_matches_number_variants(self):
+        mgr = self._manager(contacts=[], users=[])
+        mgr.number_plan = loneworker_utils.phone_numbers.NumberPlan({"0": "+353"}, "00")
+
+        mgr.lookup_phone_number("+353 87 123 4567")
+
+        expected = "mobilePhone eq '+353871234567' or mobilePhone eq '0871234567'"
+        for call in mgr.session.request.call_args_list:
+            self.assertEqual(call.kwargs["params"]["$filter"], expected)
+
+    def test_failed_query_raises(self):
+        mgr = self._manager(contacts=[], users=[])
+        mgr.session.request.side_effect = lambda method, url, **kwargs: (
+            MagicMock(status_code=403, text="denied") if url == mgr.contacts_url else _ok_response([]))
+        with self.assertRaises(RuntimeError):
+            mgr.lookup_phone_number("+447700900123")
+
+    def test_unknown_number_cached(self):
+        mgr = self._manager(contacts=[], users=[])
+
+        self.assertEqual(mgr.phone_to_email("+447700900999"), ([], "UNKNOWN"))
+        self.assertEqual(mgr.phone_to_email("+447700900999"), ([], "UNKNOWN"))
+        self.assertEqual(mgr.session.request.call_count, 2)
+
+    def test_invalidate_identity(self):
+        mgr = self._manager(contacts=[], users=[{"displayName": "Worker", "mail": "worker@example.com"}])
+
+        mgr.phone_to_email("+447700900123")
+        mgr.invalidate_identity("07700900123")
+        mgr.phone_to_email("+447700900123")
+
+        self.assertEqual(mgr.session.request.call_count, 4)
+
+    def test_directory_index_used_before_graph(self):
+        mgr = self._manager(contacts=[], users=[])
+        store = loneworker_utils.state_store.MemoryStore()
+        store.save(loneworker_utils.directory_index.INDEX_KEY, {
+            "version": 1, "built_at": datetime.now(dt.timezone.utc).isoformat(),
+            "numbers": {"+447700900123": {"addresses": ["worker@example.com"], "display_name": "Worker"}}})
+        mgr.directory_index = loneworker_utils.directory_index.DirectoryIndex(store)
+
+        self.assertEqual(mgr.phone_to_email("07700 900123"), (["worker@example.com"], "Worker"))
+        mgr.session.request.assert_not_called()
+        self.assertEqual(mgr.metrics[loneworker_utils.METRIC_DIRECTORY_INDEX_HITS], 1)
+
+        # Numbers missing from the index are looked up in Graph.
+        self.assertEqual(mgr.phone_to_email("+447700900999"), ([], "UNKNOWN"))
+        self.assertEqual(mgr.session.request.call_count, 2)
+
+    def test_no_directory_index_without_store(self):
+        mgr = self._manager(contacts=[], users=[])
+        with patch.dict(os.environ, {"directory_index": ""}):
+            self.assertIsNone(mgr.get_directory_index())
+
+    def test_shared_store_from_environment(self):
+        mgr = self._manager(contacts=[], users=[])
+        with patch.dict(os.environ, {"identity_store": "memory"}):
+            cache = mgr.get_identity_cache()
+        self.assertIsInstance(cache.store, loneworker_utils.state_store.MemoryStore)
+        self.assertEqual(cache.ttl_sec, 3600)
+        self.assertEqual(cache.unknown_ttl_sec, 600)
+
+
+class TestGraphRequestRetries(unittest.TestCase):
+    def test_retries_throttled_request_honouring_retry_after(self):
+        mgr = _make_manager()
+        mgr.session.request.side_effect = [_status_response(429, "2"), _status_response(200)]
+        with patch("loneworker_utils.time.sleep") as mock_sleep:
+            response = mgr.graph_request("GET", "https://example.com")
+
+        self.assertEqual(response.status_code, 200)
+        mock_sleep.assert_called_once_with(2.0)
+        self.assertEqual(mgr.metrics[loneworker_utils.METRIC_GRAPH_RETRIES], 1)
+        self.assertEqual(mgr.metrics[loneworker_utils.METRIC_GRAPH_BACKOFF_MS], 2000)
+
+    def test_backs_off_with_jitter_without_retry_after(self):
+        mgr = _make_manager()
+        mgr.session.request.side_effect = [_status_response(503), _status_response(504), _status_response(200)]
+        with patch("loneworker_utils.time.sleep") as mock_sleep:
+            mgr.graph_request("GET", "https://example.com")
+
+        delays = [c.args[0] for c in mock_sleep.call_args_list]
+        self.assertEqual(len(delays), 2)
+        self.assertLessEqual(delays[0], 0.5)
+        self.assertLessEqual(delays[1], 1.0)
+
+    def test_gives_up_after_max_retries(self):
+        mgr = _make_manager()
+        mgr.session.request.return_value = _status_response(429, "0")
+        with patch("loneworker_utils.time.sleep"):
+            response = mgr.graph_request("GET", "https://example.com")
+
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(mgr.session.request.call_count, 5)
+
+    def test_does_not_retry_beyond_remaining_time(self):
+        mgr = _make_manager()
+        mgr.deadline = loneworker_utils.Deadline(_context(5000))
+        mgr.session.request.return_value = _status_response(429, "10")
+        with patch("loneworker_utils.time.sleep") as mock_sleep:
+            response = mgr.graph_request("GET", "https://example.com")
+
+        self.assertEqual(response.status_code, 429)
+        mock_sleep.assert_not_called()
+        self.assertEqual(mgr.metrics[loneworker_utils.METRIC_GRAPH_RETRIES], 0)
+
+    def test_does_not_retry_other_errors(self):
+        mgr = _make_manager()
+        mgr.session.request.return_value = _status_response(500)
+        response = mgr.graph_request("GET", "https://example.com")
+        self.assertEqual(response.status_code, 500)
+        mgr.session.request.assert_called_once()
+
+    def test_rejected_token_replaced_and_request_retried_once(self):
+        mgr = _make_manager()
+        mgr.token = "old"
+        mgr.headers = {"Authorization": "Bearer old", "Content-Type": "application/json"}
+        mgr.token_provider = MagicMock()
+        mgr.token_provider.get_token.return_value = "new"
+        mgr.session.request.side_effect = [_status_response(401), _status_response(200)]
+
+        response = mgr.graph_request("GET", "https://example.com", headers={**mgr.headers, "If-Match": "etag"})
+
+        self.assertEqual(response.status_code, 200)
+        mgr.token_provider.invalidate.assert_called_once()
+        retried_headers = mgr.session.request.call_args.kwargs["headers"]
+        self.assertEqual(retried_headers["Authorization"], "Bearer new")
+        self.assertEqual(retried_headers["If-Match"], "etag")
+
+    def test_rejected_new_token_not_retried_again(self):
+        mgr = _make_manager()
+        mgr.token = "old"
+        mgr.headers = {"Authorization": "Bearer old"}
+        mgr.token_provider = MagicMock()
+        mgr.token_provider.get_token.return_value = "new"
+        mgr.session.request.return_value = _status_response(401)
+
+        response = mgr.graph_request("GET", "https://example.com", headers=mgr.headers)
+
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(mgr.session.request.call_count, 2)
+        mgr.token_provider.invalidate.assert_called_once()
+
+    def test_send_email_not_retried_after_gateway_timeout(self):
+        mgr = _make_manager()
+        mgr.mail_url = "https://graph.microsoft.com/v1.0/users/x/sendMail"
+        mgr.cfg.get_email_recipients.return_value = ["team@example.com"]
+        mgr.session.request.return_value = _status_response(504)
+        with patch("loneworker_utils.time.sleep") as mock_sleep:
+            with self.assertRaises(RuntimeError):
+                mgr.send_email("emergency", "Subject", "Content")
+
+        mgr.session.request.assert_called_once()
+        mock_sleep.assert_not_called()
+
+    def test_send_email_retried_when_throttled(self):
+        mgr = _make_manager()
+        mgr.mail_url = "https://graph.microsoft.com/v1.0/users/x/sendMail"
+        mgr.cfg.get_email_recipients.return_value = ["team@example.com"]
+        mgr.session.request.side_effect = [_status_response(429, "0"), _status_response(202)]
+        with patch("loneworker_utils.time.sleep"):
+            mgr.send_email("emergency", "Subject", "Content")
+
+        self.assertEqual(mgr.session.request.call_count, 2)
+
+    def test_retry_after_http_date(self):
+        when = datetime.now(dt.timezone.utc) + timedelta(seconds=30)
+        delay = loneworker_utils.retry_after_sec(
+            _status_response(429, when.strftime("%a, %d %b %Y %H:%M:%S GMT")))
+        self.assertTrue(25 < delay <= 30, delay)
+
+    def test_retry_after_http_date_without_zone(self):
+        when = datetime.now(dt.timezone.utc) + timedelta(seconds=30)
+        delay = loneworker_utils.parse_retry_after(when.strftime("%a, %d %b %Y %H:%M:%S -0000"))
+        self.assertTrue(25 < delay <= 30, delay)
+
+    def test_retry_after_invalid(self):
+        self.assertIsNone(loneworker_utils.retry_after_sec(_status_response(429, "soon")))
+        self.assertIsNone(loneworker_utils.retry_after_sec(_status_response(429)))
+
+
+class FakeEvents:
+    """Stand-in for a boto3 client's event system, firing the handlers registered for a call."""
+    def __init__(self):
+        self.handlers = {}
+
+    def register(self, event_name, handler):
+        self.handlers[event_name] = handler
+
+    def call(self, service_id, name, status=200, content_length="42", error=None):
+        context = {}
+        model = MagicMock(service_model=MagicMock(service_id=service_id))
+        model.name = name
+        self.handlers["before-call"](model=model, context=context, params={})
+        if error is not None:
+            self.handlers["after-call-error"](context=context, exception=error)
+        else:
+            http_response = MagicMock(status_code=status, headers={"content-length": content_length})
+            self.handlers["after-call"](http_response=http_response, context=context, parsed={}, model=model)
+
+
+class TestOperations(unittest.TestCase):
+    def test_graph_request_records_each_attempt(self):
+        mgr = _make_manager()
+        throttled = _status_response(429, "0")
+        throttled.content = b""
+        ok = _status_response(200)
+        ok.content = b"x" * 100
+        mgr.session.request.side_effect = [throttled, ok]
+        with patch("loneworker_utils.time.sleep"):
+            mgr.graph_request("GET", "https://example.com", operation="Users")
+
+        summary = mgr.get_operation_summary()
+        self.assertEqual(summary["Users"]["calls"], 2)
+        self.assertEqual(summary["Users"]["bytes"], 100)
+        self.assertEqual(summary["Users"]["statuses"], {"429": 1, "200": 1})
+
+    def test_failed_request_recorded_with_status_zero(self):
+        mgr = _make_manager()
+        mgr.session.request.side_effect = loneworker_utils.requests.ConnectionError("refused")
+        with self.assertRaises(loneworker_utils.requests.ConnectionError):
+            mgr.graph_request("POST", "https://example.com", operation="SendMail")
+
+        self.assertEqual(mgr.get_operation_summary()["SendMail"]["statuses"], {"0": 1})
+
+    def test_aws_calls_recorded(self):
+        mgr = _make_manager()
+        client = MagicMock()
+        client.meta.events = FakeEvents()
+        mgr.instrument_client(client)
+
+        client.meta.events.call("SSM", "GetParametersByPath")
+        client.meta.events.call("S3", "GetObject", status=404, content_length="0")
+        client.meta.events.call("S3", "GetObject", error=RuntimeError("timed out"))
+
+        summary = mgr.get_operation_summary()
+        self.assertEqual(summary["SSM.GetParametersByPath"]["bytes"], 42)
+        self.assertEqual(summary["S3.GetObject"]["statuses"], {"404": 1, "0": 1})
+
+    def test_emitted_once_and_summarised(self):
+        mgr = _make_manager()
+        mgr.app_prefix = "test"
+        mgr.metrics_backend = MagicMock()
+        mgr.init_metrics([])
+        mgr.record_operation("Users", 0.3125, 2048, 200)
+        mgr.record_operation("Users", 0.1, 1024, 200)
+
+        mgr.emit_metrics()
+        mgr.record_operation("Token", 0.05, 500, 200)
+        mgr.init_metrics([])
+        mgr.emit_metrics()
+
+        first, second = [c.args[2] for c in mgr.metrics_backend.emit.call_args_list]
+        self.assertEqual(first, {"Users": {"latency_ms": [312.5, 100.0], "bytes": [2048, 1024],
+                                           "statuses": {"200": 2}}})
+        self.assertEqual(list(second), ["Token"])
+        self.assertEqual(mgr.get_operation_summary()["Users"],
+                         {"calls": 2, "total_ms": 412, "max_ms": 312, "bytes": 3072, "statuses": {"200": 2}})
+
+    def test_timings_emitted_and_kept_across_invocations(self):
+        mgr = _make_manager()
+        mgr.app_prefix = "test"
+        mgr.metrics_backend = MagicMock()
+        mgr.init_metrics([])
+        mgr.record_timing("CallLatency", 0.25, {"Phase": "Total", "Action": "CheckIn"})
+        mgr.record_timing("CallLatency", 0.5, {"Action": "CheckIn", "Phase": "Total"})
+        mgr.emit_metrics()
+        # Recorded after emission, so reported by the next invocation.
+        mgr.record_timing("CallLatency", 0.01, {"Action": "CheckIn", "Phase": "Metrics"})
+        mgr.init_metrics([])
+        mgr.emit_metrics()
+
+        first, second = [c.args[3] for c in mgr.metrics_backend.emit.call_args_list]
+        self.assertEqual(first, [("CallLatency", {"Action": "CheckIn", "Phase": "Total"}, [250.0, 500.0])])
+        self.assertEqual(second, [("CallLatency", {"Action": "CheckIn", "Phase": "Metrics"}, [10.0])])
+
+    def test_reset_discards_timings(self):
+        mgr = _make_manager()
+        mgr.record_operation("Users", 0.1, 1024, 200)
+        mgr.reset_operations()
+        self.assertEqual(mgr.get_operation_summary(), {})
+
+    def test_format_operation_summary(self):
+        summary = {"Users": {"calls": 1, "total_ms": 312, "max_ms": 312, "bytes": 2048, "statuses": {"200": 1}},
+                   "Contacts": {"calls": 2, "total_ms": 150, "max_ms": 100, "bytes": 10, "statuses": {"200": 1, "429": 1}}}
+        self.assertEqual(loneworker_utils.format_operation_summary(summary),
+                         "Users: 1 call, 312 ms (max 312), 2048 bytes, status 200x1; "
+                         "Contacts: 2 calls, 150 ms (max 100), 10 bytes, status 200x1,429x1")
+
+
+class TestDeadline(unittest.TestCase):
+    def test_unbounded(self):
+        deadline = loneworker_utils.Deadline()
+        self.assertIsNone(deadline.remaining_sec())
+        self.assertTrue(deadline.has_time(1000))
+        self.assertEqual(deadline.timeout(3, 10), (3, 10))
+
+    def test_from_context(self):
+        deadline = loneworker_utils.Deadline(_context(5000))
+        self.assertAlmostEqual(deadline.remaining_sec(), 5, places=1)
+        self.assertTrue(deadline.has_time(3))
+        self.assertFalse(deadline.has_time(4.5))
+
+    def test_budget_tighter_than_context(self):
+        deadline = loneworker_utils.Deadline(_context(30000), budget_sec=8)
+        self.assertAlmostEqual(deadline.remaining_sec(), 8, places=1)
+
+    def test_timeout_limited_by_remaining_time(self):
+        deadline = loneworker_utils.Deadline(_context(5000))
+        connect_timeout, read_timeout = deadline.timeout(3.05, 10)
+        self.assertEqual(connect_timeout, 3.05)
+        self.assertAlmostEqual(read_timeout, 4, places=1)
+
+    def test_timeout_raises_when_expired(self):
+        deadline = loneworker_utils.Deadline(_context(500))
+        with self.assertRaises(loneworker_utils.DeadlineExceeded):
+            deadline.timeout(3, 10)
+
+    def test_graph_request_uses_deadline_timeout(self):
+        mgr = _make_manager()
+        mgr.deadline = loneworker_utils.Deadline(_context(2500))
+        mgr.session.request.return_value = _ok_response([])
+        mgr.graph_request("GET", "https://example.com")
+        _, read_timeout = mgr.session.request.call_args.kwargs["timeout"]
+        self.assertLessEqual(read_timeout, 1.5)
+
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,153 @@
+import io
+import json
+import os
+import sys
+import types
+import unittest
+from datetime import datetime, timezone
+from unittest.mock import MagicMock
+
+# Add the local src directories to the include path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "../src"))
+# Dummy out boto3 so that metrics_backend loads without trying to use boto3.
+sys.modules.setdefault("boto3", types.ModuleType("boto3"))
+
+import metrics_backend
+
+NAMESPACE = "loneworker/Connect"
+TIMESTAMP = datetime(2026, 5, 10, 12, 0, tzinfo=timezone.utc)
+OPERATIONS = {"Users": {"latency_ms": [312.5, 100.0], "bytes": [2048, 1024], "statuses": {"200": 2}}}
+
+
+class TestCloudWatchBackend(unittest.TestCase):
+    def test_puts_counts(self):
+        client = MagicMock()
+        backend = metrics_backend.make_metrics_backend("cloudwatch", NAMESPACE, client=client)
+
+        backend.emit({"Calls": 1, "Errors": 0}, TIMESTAMP)
+
+        client.put_metric_data.assert_called_once_with(Namespace=NAMESPACE, MetricData=[
+            {'MetricName': "Calls", 'Timestamp': TIMESTAMP, 'Value': 1, 'Unit': 'Count'},
+            {'MetricName': "Errors", 'Timestamp': TIMESTAMP, 'Value': 0, 'Unit': 'Count'},
+        ])
+
+    def test_puts_operations_at_high_resolution(self):
+        client = MagicMock()
+        backend = metrics_backend.CloudWatchBackend(NAMESPACE, client=client)
+
+        backend.emit({}, TIMESTAMP, OPERATIONS)
+
+        dimensions = [{'Name': 'Operation', 'Value': "Users"}]
+        self.assertEqual(client.put_metric_data.call_args.kwargs["MetricData"], [
+            {'MetricName': "OperationLatency", 'Dimensions': dimensions, 'Timestamp': TIMESTAMP,
+             'Values': [312.5, 100.0], 'Unit': 'Milliseconds', 'StorageResolution': 1},
+            {'MetricName': "OperationBytes", 'Dimensions': dimensions, 'Timestamp': TIMESTAMP,
+             'Values': [2048, 1024], 'Unit': 'Bytes', 'StorageResolution': 1},
+            {'MetricName': "OperationCalls", 'Dimensions': dimensions + [{'Name': 'Status', 'Value': "200"}],
+             'Timestamp': TIMESTAMP, 'Value': 2, 'Unit': 'Count', 'StorageResolution': 1},
+        ])
+
+    def test_splits_many_values(self):
+        client = MagicMock()
+        backend = metrics_backend.CloudWatchBackend(NAMESPACE, client=client)
+        count = metrics_backend.MAX_PUT_VALUES + 1
+
+        backend.emit({}, TIMESTAMP, {"Users": {"latency_ms": [1.0] * count, "bytes": [1] * count,
+                                               "statuses": {"200": count}}})
+
+        metric_data = client.put_metric_data.call_args.kwargs["MetricData"]
+        self.assertEqual([len(m.get('Values', [])) for m in metric_data],
+                         [metrics_backend.MAX_PUT_VALUES, 1, metrics_backend.MAX_PUT_VALUES, 1, 0])
+
+    def test_puts_timings(self):
+        client = MagicMock()
+        backend = metrics_backend.CloudWatchBackend(NAMESPACE, client=client)
+
+        backend.emit({}, TIMESTAMP, timings=[("CallLatency", {"Action": "CheckIn", "Phase": "Total"}, [812.5])])
+
+        self.assertEqual(client.put_metric_data.call_args.kwargs["MetricData"], [
+            {'MetricName': "CallLatency", 'Timestamp': TIMESTAMP, 'Values': [812.5], 'Unit': 'Milliseconds',
+             'Dimensions': [{'Name': 'Action', 'Value': "CheckIn"}, {'Name': 'Phase', 'Value': "Total"}],
+             'StorageResolution': 1},
+        ])
+
+    def test_is_default(self):
+        backend = metrics_backend.make_metrics_backend("", NAMESPACE, client=MagicMock())
+        self.assertIsInstance(backend, metrics_backend.CloudWatchBackend)
+
+
+class TestEmfBackend(unittest.TestCase):
+    def _records(self, stream):
+        return [json.loads(line) for line in stream.getvalue().splitlines()]
+
+    def test_writes_record(self):
+        stream = io.StringIO()
+        backend = metrics_backend.EmfBackend(NAMESPACE, stream=stream)
+
+        backend.emit({"Calls": 1, "Errors": 0}, TIMESTAMP)
+
+        self.assertEqual(self._records(stream), [{
+            "_aws": {
+                "Timestamp": int(TIMESTAMP.timestamp() * 1000),
+                "CloudWatchMetrics": [{
+                    "Namespace": NAMESPACE,
+                    "Dimensions": [[]],
+                    "Metrics": [{"Name": "Calls", "Unit": "Count"}, {"Name": "Errors", "Unit": "Count"}],
+                }],
+            },
+            "Calls": 1,
+            "Errors": 0,
+        }])
+
+    def test_splits_large_sets(self):
+        stream = io.StringIO()
+        backend = metrics_backend.EmfBackend(NAMESPACE, stream=stream)
+        metrics = {f"Metric{i}": i for i in range(metrics_backend.MAX_EMF_METRICS + 1)}
+
+        backend.emit(metrics, TIMESTAMP)
+
+        records = self._records(stream)
+        self.assertEqual([len(r["_aws"]["CloudWatchMetrics"][0]["Metrics"]) for r in records],
+                         [metrics_backend.MAX_EMF_METRICS, 1])
+        self.assertEqual(records[1][f"Metric{metrics_backend.MAX_EMF_METRICS}"], metrics_backend.MAX_EMF_METRICS)
+
+    def test_writes_operation_records(self):
+        stream = io.StringIO()
+        backend = metrics_backend.EmfBackend(NAMESPACE, stream=stream)
+
+        backend.emit({}, TIMESTAMP, OPERATIONS)
+
+        timings, calls = self._records(stream)
+        self.assertEqual(timings["_aws"]["CloudWatchMetrics"][0]["Dimensions"], [["Operation"]])
+        self.assertEqual(timings["_aws"]["CloudWatchMetrics"][0]["Metrics"], [
+            {"Name": "OperationLatency", "Unit": "Milliseconds", "StorageResolution": 1},
+            {"Name": "OperationBytes", "Unit": "Bytes", "StorageResolution": 1}])
+        self.assertEqual((timings["Operation"], timings["OperationLatency"], timings["OperationBytes"]),
+                         ("Users", [312.5, 100.0], [2048, 1024]))
+        self.assertEqual(calls["_aws"]["CloudWatchMetrics"][0]["Dimensions"], [["Operation", "Status"]])
+        self.assertEqual((calls["Operation"], calls["Status"], calls["OperationCalls"]), ("Users", "200", 2))
+
+    def test_writes_timing_records(self):
+        stream = io.StringIO()
+        backend = metrics_backend.EmfBackend(NAMESPACE, stream=stream)
+
+        backend.emit({}, TIMESTAMP, timings=[("CallLatency", {"Action": "CheckIn", "Phase": "Total"}, [812.5])])
+
+        record, = self._records(stream)
+        self.assertEqual(record["_aws"]["CloudWatchMetrics"][0]["Dimensions"], [["Action", "Phase"]])
+        self.assertEqual(record["_aws"]["CloudWatchMetrics"][0]["Metrics"],
+                         [{"Name": "CallLatency", "Unit": "Milliseconds", "StorageResolution": 1}])
+        self.assertEqual((record["Action"], record["Phase"], record["CallLatency"]), ("CheckIn", "Total", [812.5]))
+
+    def test_selected_by_type(self):
+        backend = metrics_backend.make_metrics_backend("emf", NAMESPACE)
+        self.assertIsInstance(backend, metrics_backend.EmfBackend)
+        self.assertEqual(backend.namespace, NAMESPACE)
+
+    def test_invalid_type(self):
+        with self.assertRaises(ValueError):
+            metrics_backend.make_metrics_backend("statsd", NAMESPACE)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+import os
+import sys
+import unittest
+
+# Add the local src directories to the include path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "../src"))
+
+import phone_numbers
+
+
+class TestNormalise(unittest.TestCase):
+    def test_forms_of_one_number_match(self):
+        for number in ("+447700900123", "07700 900123", "07700-900-123", "0044 7700 900123",
+                       "+44 (0)7700 900123", "+44 7700 900123", " (07700) 900123 "):
+            self.assertEqual(phone_numbers.normalise_number(number), "+447700900123", number)
+
+    def test_other_country_codes_kept(self):
+        self.assertEqual(phone_numbers.normalise_number("+33 6 12 34 56 78"), "+33612345678")
+        self.assertEqual(phone_numbers.normalise_number("00353 87 123 4567"), "+353871234567")
+
+    def test_configured_national_prefixes(self):
+        plan = phone_numbers.NumberPlan({"0": "+353"}, "00")
+        self.assertEqual(plan.normalise("087 123 4567"), "+353871234567")
+        # The longest matching prefix is used.
+        plan = phone_numbers.NumberPlan({"0": "+44", "01481": "+441481"}, "00")
+        self.assertEqual(plan.normalise("01481 123456"), "+441481123456")
+
+    def test_configured_international_prefix(self):
+        plan = phone_numbers.NumberPlan({"1": "+1"}, "011")
+        self.assertEqual(plan.normalise("011 44 7700 900123"), "+447700900123")
+        self.assertEqual(plan.normalise("1 (202) 555-0100"), "+12025550100")
+
+    def test_numbers_not_in_e164_form_kept(self):
+        self.assertEqual(phone_numbers.normalise_number("anonymous"), "anonymous")
+        self.assertEqual(phone_numbers.normalise_number("123"), "123")
+        self.assertEqual(phone_numbers.normalise_number(""), "")
+
+    def test_from_config(self):
+        plan = phone_numbers.NumberPlan.from_config({"national_prefixes": {"0": "+353"},
+                                                     "international_prefix": "00"})
+        self.assertEqual(plan.normalise("087 123 4567"), "+353871234567")
+
+
+class TestVariants(unittest.TestCase):
+    def test_variants_of_home_number(self):
+        self.assertEqual(phone_numbers.DEFAULT_PLAN.variants("07700 900123"),
+                         ["+447700900123", "07700900123"])
+
+    def test_variants_of_foreign_number(self):
+        self.assertEqual(phone_numbers.DEFAULT_PLAN.variants("+33612345678"), ["+33612345678"])
+
+    def test_variants_of_unrecognised_number(self):
+        self.assertEqual(phone_numbers.DEFAULT_PLAN.variants("anonymous"), ["anonymous"])
+
+    def test_variants_worked_out_once(self):
+        plan = phone_numbers.NumberPlan()
+        plan.variants("+447700900123")
+        plan.variants("+447700900123").append("changed")
+        self.assertEqual(plan.cached_variants.cache_info().misses, 1)
+        self.assertEqual(plan.variants("+447700900123"), ["+447700900123", "07700900123"])
+
+
+if __name__ == '__main__':
+    unittest.main()
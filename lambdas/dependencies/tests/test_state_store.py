@@ -0,0 +1,147 @@
+import os
+import sys
+import tempfile
+import unittest
+from unittest.mock import MagicMock
+
+# Add the local src directories to the include path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "../src"))
+
+import state_store
+
+
+class TestStateStore(unittest.TestCase):
+    def test_memory_store_round_trip(self):
+        store = state_store.MemoryStore()
+        self.assertIsNone(store.load("k"))
+        store.save("k", {"a": 1})
+        self.assertEqual(store.load("k"), {"a": 1})
+
+    def test_memory_store_conditional_save(self):
+        store = state_store.MemoryStore()
+        entry, version = store.load_versioned("k")
+        self.assertIsNone(entry)
+        store.save_if("k", {"a": 1}, version)
+        with self.assertRaises(state_store.ConflictError):
+            # Created since it was loaded.
+            store.save_if("k", {"a": 2}, version)
+
+        entry, version = store.load_versioned("k")
+        entry["a"] = 3
+        store.save("k", {"a": 4})
+        with self.assertRaises(state_store.ConflictError):
+            store.save_if("k", entry, version)
+        self.assertEqual(store.load("k"), {"a": 4})
+
+    def test_file_store_round_trip(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "state.json")
+            store = state_store.make_state_store(f"file:{path}")
+            self.assertIsNone(store.load("k"))
+            store.save("k", {"a": 1})
+            store.save("other", {"b": 2})
+            self.assertEqual(state_store.FileStore(path).load("k"), {"a": 1})
+            self.assertEqual(state_store.FileStore(path).load("other"), {"b": 2})
+
+    def test_file_store_conditional_save(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            store = state_store.FileStore(os.path.join(tmpdir, "state.json"))
+            _, version = store.load_versioned("k")
+            store.save_if("k", {"a": 1}, version)
+            _, version = store.load_versioned("k")
+            store.save("k", {"a": 2})
+            with self.assertRaises(state_store.ConflictError):
+                store.save_if("k", {"a": 3}, version)
+            self.assertEqual(store.load("k"), {"a": 2})
+
+    def test_s3_store_round_trip(self):
+        objects = {}
+
+        class NoSuchKey(Exception):
+            pass
+
+        s3 = MagicMock()
+        s3.exceptions.NoSuchKey = NoSuchKey
+
+        def get_object(Bucket, Key):
+            if (Bucket, Key) not in objects:
+                raise NoSuchKey(Key)
+            body = MagicMock()
+            body.read.return_value = objects[(Bucket, Key)]
+            return {"Body": body}
+
+        s3.get_object.side_effect = get_object
+        s3.put_object.side_effect = lambda Bucket, Key, Body, ContentType: objects.__setitem__((Bucket, Key), Body)
+
+        store = state_store.make_state_store("s3:my-bucket/cache", s3)
+        self.assertIsNone(store.load("k"))
+        store.save("k", {"a": 1})
+        self.assertEqual(store.load("k"), {"a": 1})
+        self.assertIn(("my-bucket", "cache/k.json"), objects)
+
+    def test_s3_store_conditional_save(self):
+        class ClientError(Exception):
+            def __init__(self, code):
+                self.response = {"Error": {"Code": code}}
+
+        s3 = MagicMock()
+        s3.exceptions.NoSuchKey = type("NoSuchKey", (Exception,), {})
+        s3.exceptions.ClientError = ClientError
+        body = MagicMock()
+        body.read.return_value = b'{"a": 1}'
+        s3.get_object.return_value = {"Body": body, "ETag": '"etag-1"'}
+        store = state_store.S3Store(s3, "my-bucket", "cache")
+
+        entry, version = store.load_versioned("k")
+        self.assertEqual((entry, version), ({"a": 1}, '"etag-1"'))
+        store.save_if("k", {"a": 2}, version)
+        self.assertEqual(s3.put_object.call_args.kwargs["IfMatch"], '"etag-1"')
+        store.save_if("new", {"a": 1}, None)
+        self.assertEqual(s3.put_object.call_args.kwargs["IfNoneMatch"], "*")
+
+        s3.put_object.side_effect = ClientError("PreconditionFailed")
+        with self.assertRaises(state_store.ConflictError):
+            store.save_if("k", {"a": 2}, version)
+        s3.put_object.side_effect = ClientError("AccessDenied")
+        with self.assertRaises(ClientError):
+            store.save_if("k", {"a": 2}, version)
+
+    def test_update_retries_after_conflict(self):
+        store = state_store.MemoryStore()
+        store.save("k", {"count": 1})
+        calls = []
+
+        def change(entry):
+            calls.append(entry["count"])
+            if len(calls) == 1:
+                # Another writer saves while this one works.
+                store.save("k", {"count": 10})
+            return {"count": entry["count"] + 1}
+
+        self.assertEqual(state_store.update(store, "k", change, 3), {"count": 11})
+        self.assertEqual(calls, [1, 10])
+        self.assertEqual(store.load("k"), {"count": 11})
+
+    def test_update_gives_up(self):
+        store = state_store.MemoryStore()
+
+        def change(entry):
+            store.save("k", {"other": True})
+            return {"mine": True}
+
+        with self.assertRaises(state_store.ConflictError):
+            state_store.update(store, "k", change, 2)
+
+    def test_make_state_store(self):
+        self.assertIsNone(state_store.make_state_store(""))
+        self.assertIsNone(state_store.make_state_store("none"))
+        self.assertIsInstance(state_store.make_state_store("memory"), state_store.MemoryStore)
+        with self.assertRaises(ValueError):
+            state_store.make_state_store("redis")
+        with self.assertRaises(ValueError):
+            # An S3 store needs a client.
+            state_store.make_state_store("s3:my-bucket/cache")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+import os
+import sys
+import unittest
+from datetime import datetime, timedelta, timezone
+from unittest.mock import MagicMock
+
+# Add the local src directories to the include path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "../src"))
+
+import state_store
+import subscriptions
+
+URL = "https://notify.example.com/"
+NOW = datetime(2026, 5, 10, 12, 0, tzinfo=timezone.utc)
+
+
+def _record(expiration, url=URL):
+    return {"id": "sub-1", "client_state": "secret", "notification_url": url,
+            "expiration": expiration.isoformat()}
+
+
+class TestEnsureSubscription(unittest.TestCase):
+    def setUp(self):
+        self.store = state_store.MemoryStore()
+        self.key = subscriptions.subscription_key("loneworker@example.com")
+        self.manager = MagicMock()
+        self.manager.username = "loneworker@example.com"
+        self.manager.create_subscription.return_value = {"id": "sub-2"}
+        self.manager.renew_subscription.return_value = {"id": "sub-1"}
+
+    def test_creates_subscription(self):
+        record = subscriptions.ensure_subscription(self.manager, self.store, URL, NOW)
+
+        self.assertEqual(record["id"], "sub-2")
+        url, client_state, expiration = self.manager.create_subscription.call_args.args
+        self.assertEqual(url, URL)
+        self.assertEqual(record["client_state"], client_state)
+        self.assertEqual(expiration, NOW + timedelta(minutes=subscriptions.SUBSCRIPTION_LIFETIME_MIN))
+        self.assertEqual(self.store.load(self.key), record)
+
+    def test_leaves_current_subscription_alone(self):
+        self.store.save(self.key, _record(NOW + timedelta(days=2)))
+
+        record = subscriptions.ensure_subscription(self.manager, self.store, URL, NOW)
+
+        self.assertEqual(record["id"], "sub-1")
+        self.manager.renew_subscription.assert_not_called()
+        self.manager.create_subscription.assert_not_called()
+
+    def test_renews_subscription_close_to_expiry(self):
+        self.store.save(self.key, _record(NOW + timedelta(hours=2)))
+
+        record = subscriptions.ensure_subscription(self.manager, self.store, URL, NOW)
+
+        self.manager.renew_subscription.assert_called_once()
+        self.manager.create_subscription.assert_not_called()
+        self.assertEqual(record["client_state"], "secret")
+        self.assertGreater(datetime.fromisoformat(record["expiration"]), NOW + timedelta(days=2))
+
+    def test_recreates_missing_subscription(self):
+        self.store.save(self.key, _record(NOW + timedelta(hours=2)))
+        self.manager.renew_subscription.return_value = None
+
+        record = subscriptions.ensure_subscription(self.manager, self.store, URL, NOW)
+
+        self.assertEqual(record["id"], "sub-2")
+        self.assertNotEqual(record["client_state"], "secret")
+
+    def test_recreates_subscription_when_url_changes(self):
+        self.store.save(self.key, _record(NOW + timedelta(days=2), url="https://old.example.com/"))
+
+        subscriptions.ensure_subscription(self.manager, self.store, URL, NOW)
+
+        self.manager.renew_subscription.assert_not_called()
+        self.manager.create_subscription.assert_called_once()
+
+    def test_record_saved_before_creation(self):
+        # Graph may send notifications before the create call returns.
+        def create(url, client_state, expiration):
+            self.assertEqual(self.store.load(self.key)["client_state"], client_state)
+            return {"id": "sub-2"}
+        self.manager.create_subscription.side_effect = create
+
+        subscriptions.ensure_subscription(self.manager, self.store, URL, NOW)
+
+
+class TestIsValidNotification(unittest.TestCase):
+    def test_checks_client_state_and_id(self):
+        record = _record(NOW)
+        self.assertTrue(subscriptions.is_valid_notification(
+            record, {"subscriptionId": "sub-1", "clientState": "secret"}))
+        self.assertFalse(subscriptions.is_valid_notification(
+            record, {"subscriptionId": "sub-1", "clientState": "wrong"}))
+        self.assertFalse(subscriptions.is_valid_notification(
+            record, {"subscriptionId": "sub-2", "clientState": "secret"}))
+        self.assertFalse(subscriptions.is_valid_notification(
+            record, {"subscriptionId": "sub-1"}))
+        self.assertFalse(subscriptions.is_valid_notification(
+            None, {"subscriptionId": "sub-1", "clientState": "secret"}))
+
+    def test_accepts_any_id_while_subscription_is_created(self):
+        record = dict(_record(NOW), id=None)
+        self.assertTrue(subscriptions.is_valid_notification(
+            record, {"subscriptionId": "sub-9", "clientState": "secret"}))
+
+
+if __name__ == '__main__':
+    unittest.main()
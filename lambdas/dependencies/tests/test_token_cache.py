@@ -0,0 +1,87 @@
+import os
+import sys
+import tempfile
+import unittest
+from unittest.mock import MagicMock
+
+# Add the local src directories to the include path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "../src"))
+
+import token_cache
+
+
+class TestTokenProvider(unittest.TestCase):
+    def _provider(self, store=None, lifetimes=(3599,)):
+        """Build a provider whose fetch returns tok1, tok2, ... with the given lifetimes."""
+        responses = [(f"tok{i + 1}", lifetime) for i, lifetime in enumerate(lifetimes)]
+        fetch = MagicMock(side_effect=responses)
+        return token_cache.TokenProvider(fetch, key="tenant-client", store=store), fetch
+
+    def test_caches_token_until_near_expiry(self):
+        provider, fetch = self._provider()
+        self.assertEqual(provider.get_token(), "tok1")
+        self.assertEqual(provider.get_token(), "tok1")
+        fetch.assert_called_once()
+
+    def test_refreshes_synchronously_when_expired(self):
+        provider, fetch = self._provider(lifetimes=(30, 3599))
+        # 30 seconds is inside the expiry margin, so the first token is never reused.
+        self.assertEqual(provider.get_token(), "tok1")
+        self.assertEqual(provider.get_token(), "tok2")
+        self.assertEqual(fetch.call_count, 2)
+
+    def test_refreshes_in_background_within_refresh_margin(self):
+        provider, fetch = self._provider(lifetimes=(200, 3599))
+        self.assertEqual(provider.get_token(), "tok1")
+        # Still usable, so the caller gets it straight away while a refresh runs.
+        self.assertEqual(provider.get_token(), "tok1")
+        provider.refresh_thread.join(timeout=5)
+        self.assertEqual(provider.get_token(), "tok2")
+        self.assertEqual(fetch.call_count, 2)
+
+    def test_background_refresh_failure_keeps_current_token(self):
+        fetch = MagicMock(side_effect=[("tok1", 200), RuntimeError("Authentication failed")])
+        provider = token_cache.TokenProvider(fetch, key="k")
+        provider.get_token()
+        self.assertEqual(provider.get_token(), "tok1")
+        provider.refresh_thread.join(timeout=5)
+        self.assertEqual(provider.token, "tok1")
+
+    def test_shared_store_avoids_second_fetch(self):
+        store = token_cache.MemoryTokenStore()
+        first, first_fetch = self._provider(store=store)
+        second, second_fetch = self._provider(store=store)
+
+        self.assertEqual(first.get_token(), "tok1")
+        self.assertEqual(second.get_token(), "tok1")
+        first_fetch.assert_called_once()
+        second_fetch.assert_not_called()
+
+    def test_invalidate_bypasses_store(self):
+        store = token_cache.MemoryTokenStore()
+        provider, fetch = self._provider(store=store, lifetimes=(3599, 3599))
+        provider.get_token()
+        provider.invalidate()
+        self.assertEqual(provider.get_token(), "tok2")
+        self.assertEqual(store.load("tenant-client")["access_token"], "tok2")
+
+    def test_file_store_round_trip(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "tokens.json")
+            store = token_cache.make_token_store(f"file:{path}")
+            self.assertIsNone(store.load("k"))
+            store.save("k", {"access_token": "abc", "expires_at": 123})
+            self.assertEqual(token_cache.FileTokenStore(path).load("k"),
+                             {"access_token": "abc", "expires_at": 123})
+
+    def test_make_token_store(self):
+        self.assertIsNone(token_cache.make_token_store(""))
+        self.assertIsNone(token_cache.make_token_store("none"))
+        self.assertIsInstance(token_cache.make_token_store("memory"), token_cache.MemoryTokenStore)
+        self.assertIsInstance(token_cache.make_token_store("ssm", MagicMock(), "app"), token_cache.SsmTokenStore)
+        with self.assertRaises(ValueError):
+            token_cache.make_token_store("redis")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -23,7 +23,7 @@ else
 fi
 
 # Build the packages
-for TARGET in dependencies ConnectFunction CheckFunction MetricsFunction
+for TARGET in dependencies ConnectFunction CheckFunction NotifyFunction DirectoryFunction MetricsFunction
 do
     pushd lambdas/${TARGET}
 
@@ -11,7 +11,7 @@ find . -type d -name "__pycache__" -exec rm -rf {} +
 find . -type d -name "venv" -exec rm -rf {} +
 
 # Build the packages
-for TARGET in dependencies ConnectFunction CheckFunction MetricsFunction
+for TARGET in dependencies ConnectFunction CheckFunction NotifyFunction DirectoryFunction MetricsFunction
 do
     echo "  Removing build directories and any temporary venvs for ${TARGET}"
     pushd lambdas/${TARGET} > /dev/null
@@ -18,7 +18,7 @@ bash scripts/cfg_push.sh
 # commands on the same function need to be separated by a second or two for reasons,
 # and so we jump back and forth between doing things on each function and doing things
 # on the dependency layer so that things do not fail.
-for TARGET in dependencies ConnectFunction CheckFunction MetricsFunction
+for TARGET in dependencies ConnectFunction CheckFunction NotifyFunction DirectoryFunction MetricsFunction
 do
     echo "Uploading ${TARGET} to S3"
     aws s3 cp build/${TARGET}.zip s3://${BUCKET_NAME}/lambdas/${TARGET}
@@ -30,11 +30,18 @@ then
     exit 0
 fi
 
+# The NotifyFunction only exists if change notifications are enabled.
+NOTIFY_TARGET=""
+if aws lambda get-function --function-name NotifyFunction > /dev/null 2>&1
+then
+    NOTIFY_TARGET=NotifyFunction
+fi
+
 # Get list of dependency layers ready for deletion later. We do this before we later create a new layer.
 LAYER_NUMBERS=$(aws lambda list-layer-versions --layer-name ${LAYER_NAME} | jq -r '.LayerVersions | map(.Version) | sort | join(" ")')
 echo "Current list of layer numbers: ${LAYER_NUMBERS}"
 
-for TARGET in ConnectFunction CheckFunction MetricsFunction
+for TARGET in ConnectFunction CheckFunction DirectoryFunction MetricsFunction ${NOTIFY_TARGET}
 do
     echo "Forcing ${TARGET} code to the new version  "
     aws lambda update-function-code \
@@ -46,7 +53,7 @@ done
 echo "Update dependency layer version"
 VERSION=$(aws lambda publish-layer-version --layer-name ${LAYER_NAME} --content S3Bucket=${BUCKET_NAME},S3Key=lambdas/dependencies | jq ".LayerVersionArn" -r)
 
-for TARGET in ConnectFunction CheckFunction
+for TARGET in ConnectFunction CheckFunction DirectoryFunction ${NOTIFY_TARGET}
 do
     echo "  Updating dependencies for ${TARGET} to ${VERSION}"
     aws lambda update-function-configuration --function-name ${TARGET} --layers ${VERSION}
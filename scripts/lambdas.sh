@@ -9,7 +9,9 @@ cd "$(dirname "$0")/.."
 source scripts/utils.sh
 
 STACK_NAME="${APP}-lambdas"
-create_or_update_stack ${STACK_NAME} "lambdas.yaml"  "--capabilities CAPABILITY_AUTO_EXPAND CAPABILITY_NAMED_IAM"
+# Set NOTIFICATIONS=true to use Graph change notifications (see the NotifyFunction README).
+create_or_update_stack ${STACK_NAME} "lambdas.yaml"  "--capabilities CAPABILITY_AUTO_EXPAND CAPABILITY_NAMED_IAM" \
+    "ParameterKey=notifications,ParameterValue=${NOTIFICATIONS:-false}"
 
 export DATE=$(date -u "+%Y%m%dT%H:%M:%SZ")
 echo ${DATE}
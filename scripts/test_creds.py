@@ -3,10 +3,15 @@
 # work on the shared mailbox.
 import requests
 import os
+import sys
 from urllib.parse import quote
 import json
 import jwt
 
+# Phone numbers are matched as the lambdas match them.
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "../lambdas/dependencies/src"))
+import phone_numbers
+
 # Get some credentials
 def get_token(client_id, client_secret, tenant_id, scope):
     url = f"https://login.microsoftonline.com/{tenant_id}/oauth2/v2.0/token"
@@ -39,21 +44,18 @@ def get_calendar_events(user):
     response.raise_for_status()
     return response.json()
 
+def number_filter(number):
+    # Matches the number in each form it may be held in (with the default number plan).
+    variants = phone_numbers.DEFAULT_PLAN.variants(number)
+    return " or ".join(f"mobilePhone eq '{variant}'" for variant in variants)
+
 def get_contacts(user, number):
-    # number must be E164
+    # number may be in any form; see phone_numbers
     encoded_user = quote(user)
     url = f"https://graph.microsoft.com/v1.0/users/{encoded_user}/contacts"
 
-    clauses = [f"mobilePhone eq '{number}'"]
-
-    prefix = "+44"
-    if number.startswith(prefix):
-        alt_number = "0" + number[len(prefix):]
-        clauses.append(f"mobilePhone eq '{alt_number}'")
-    filter = " or ".join(clauses)
-
     params = {
-        '$filter': filter
+        '$filter': number_filter(number)
     }
 
     print(url)
@@ -63,21 +65,11 @@ def get_contacts(user, number):
     return response.json()
 
 def get_users(user, number):
-    # number must be E164
+    # number may be in any form; see phone_numbers
     # Nonsense with the count and consistency stuff is a quirk of the graph API
     url = "https://graph.microsoft.com/v1.0/users"
-    filter = f"mobilePhone eq '{number}'"
-
-    clauses = [f"mobilePhone eq '{number}'"]
-
-    prefix = "+44"
-    if number.startswith(prefix):
-        alt_number = "0" + number[len(prefix):]
-        clauses.append(f"mobilePhone eq '{alt_number}'")
-    filter = " or ".join(clauses)
-
     params = {
-        '$filter': filter,
+        '$filter': number_filter(number),
         '$count': 'true'
     }
     print(url)